@@ -1,45 +1,158 @@
+import random
 import torch
-from torch.utils.data import Dataset
+import torch.distributed as dist
+from torch.utils.data import Dataset, IterableDataset, get_worker_info
 import numpy as np
 import nibabel as nib
 from pathlib import Path
 from typing import Tuple
 from loguru import logger
-from utils.patch import get_random_patch
+from utils.patch import get_random_patch, get_weighted_patch
+from utils.sampling_index import SAMPLING_INDEX_FILENAME, load_sampling_index
+from utils.volume_cache import load_cached_volume
+from utils.chunked_store import ChannelView, open_chunked
+from utils.profiling import disable_profiling, profile_stage
+
+
+def seed_worker(worker_id: int):
+    # torch attribue une graine distincte à chaque worker ; on la propage à random (get_random_patch) et NumPy
+    worker_seed = torch.initial_seed() % 2**32
+    random.seed(worker_seed)
+    np.random.seed(worker_seed)
+    # Le profiler n'est actif que dans le processus principal (voir utils/profiling.py::disable_profiling)
+    disable_profiling()
 
 
 class CtPetGanPatchDataset(Dataset):
-    def __init__(self, root_dir: Path, patch_size=(128, 128, 128), mode: str = "random"):
+    def __init__(self, root_dir: Path, patch_size=(128, 128, 128), mode: str = "random", storage: str = "nifti"):
         self.root_dir = root_dir
         self.patch_size = patch_size
         self.mode = mode
-        self.patients = sorted([p for p in self.root_dir.iterdir() if p.is_dir()])
+        self.storage = storage
+        # Dossiers cachés ignorés : sorties temporaires (.<patient>.tmp) laissées par un prétraitement interrompu
+        self.patients = sorted([p for p in self.root_dir.iterdir() if p.is_dir() and not p.name.startswith(".")])
+        self._sampling_indices = {}
+
+        if self.storage not in ("nifti", "npy", "zarr"):
+            logger.error(f"Unknown storage: {self.storage}. Supported storages are 'nifti', 'npy' and 'zarr'.")
+            raise ValueError(f"Unknown storage: {self.storage}. Supported storages are 'nifti', 'npy' and 'zarr'.")
 
     def __len__(self):
         return len(self.patients)
 
-    def __getitem__(self, idx):
+    def load_volume(self, path: Path) -> np.ndarray:
+        if self.storage == "npy":
+            # Memmap : seules les pages touchées par le patch sont lues sur le disque
+            return load_cached_volume(path)
+        if self.storage == "zarr":
+            # Blocs compressés : seuls les blocs recouverts par le patch sont décompressés
+            return open_chunked(path)
+        return nib.load(path).get_fdata(dtype=np.float32)
+
+    def load_volumes(self, idx) -> Tuple[np.ndarray, np.ndarray]:
         patient_dir = self.patients[idx]
         baseline_dir = patient_dir / "baseline"
         normal_dir = patient_dir / "normal"
 
-        pet_baseline = nib.load(baseline_dir / "PET_preprocessed.nii.gz").get_fdata().astype(np.float32)
-        pet_normal = nib.load(normal_dir / "PET_preprocessed.nii.gz").get_fdata().astype(np.float32)
+        pet_baseline = self.load_volume(baseline_dir / "PET_preprocessed.nii.gz")
+        pet_normal = self.load_volume(normal_dir / "PET_preprocessed.nii.gz")
 
-        input_tensor = pet_baseline[None, ...]
-        target_tensor = pet_normal[None, ...]
+        if self.storage == "zarr":
+            return ChannelView(pet_baseline), ChannelView(pet_normal)
+        return pet_baseline[None, ...], pet_normal[None, ...]
 
+    def sampling_index(self, idx) -> dict:
+        if idx not in self._sampling_indices:
+            index_path = self.patients[idx] / SAMPLING_INDEX_FILENAME
+            if not index_path.exists():
+                logger.error(f"Missing sampling index: {index_path}")
+                raise FileNotFoundError(f"Sampling index not found: {index_path}. Run utils/sampling_index.py first.")
+            self._sampling_indices[idx] = load_sampling_index(index_path)
+        return self._sampling_indices[idx]
+
+    def extract_patch(self, input_tensor: np.ndarray, target_tensor: np.ndarray, idx: int = None) -> Tuple[np.ndarray, np.ndarray]:
         if self.mode == "random":
-            input_patch, target_patch = get_random_patch(input_tensor, target_tensor, self.patch_size)
+            return get_random_patch(input_tensor, target_tensor, self.patch_size)
+        elif self.mode == "weighted":
+            return get_weighted_patch(input_tensor, target_tensor, self.patch_size, self.sampling_index(idx))
         elif self.mode == "segmentation":
             segmentation_dir = self.root_dir / "segmentation_output"
             logger.error("Segmentation mode is not implemented yet.")
             raise NotImplementedError("Segmentation mode is not implemented yet.")
         else :
-            logger.error(f"Unknown mode: {self.mode}. Supported modes are 'random' and 'segmentation'.")
-            raise ValueError(f"Unknown mode: {self.mode}. Supported modes are 'random' and 'segmentation'.")
-        
-        return torch.tensor(input_patch, dtype=torch.float32), torch.tensor(target_patch, dtype=torch.float32)
+            logger.error(f"Unknown mode: {self.mode}. Supported modes are 'random', 'weighted' and 'segmentation'.")
+            raise ValueError(f"Unknown mode: {self.mode}. Supported modes are 'random', 'weighted' and 'segmentation'.")
+
+    def __getitem__(self, idx):
+        with profile_stage("dataset.getitem"):
+            with profile_stage("dataset.load_volumes"):
+                input_tensor, target_tensor = self.load_volumes(idx)
+            input_patch, target_patch = self.extract_patch(input_tensor, target_tensor, idx)
+
+            return torch.tensor(input_patch, dtype=torch.float32), torch.tensor(target_patch, dtype=torch.float32)
+
+
+class CtPetGanPatchQueue(IterableDataset):
+    """File de patchs : garde `max_volumes` patients en mémoire, tire `samples_per_volume` patchs
+    par patient chargé et mélange les patchs entre patients. Une époque compte `samples_per_epoch` patchs."""
+
+    def __init__(self, dataset: CtPetGanPatchDataset, samples_per_volume: int = 16, max_volumes: int = 4, samples_per_epoch: int = None, shuffle: bool = True):
+        if samples_per_volume < 1 or max_volumes < 1:
+            raise ValueError("samples_per_volume and max_volumes must be at least 1.")
+
+        self.dataset = dataset
+        self.samples_per_volume = samples_per_volume
+        self.max_volumes = max_volumes
+        self.samples_per_epoch = samples_per_epoch or len(dataset) * samples_per_volume
+        self.shuffle = shuffle
+
+        # Lu ici, dans le processus principal : les workers lancés en spawn n'ont pas de groupe de processus
+        self.rank, self.world_size = 0, 1
+        if dist.is_available() and dist.is_initialized():
+            self.rank, self.world_size = dist.get_rank(), dist.get_world_size()
+
+    def __len__(self):
+        # Patchs produits par ce rang : en DDP, chaque rang produit samples_per_epoch / world_size patchs
+        return self.samples_per_epoch // self.world_size
+
+    def __iter__(self):
+        worker_info = get_worker_info()
+        worker_id = worker_info.id if worker_info is not None else 0
+        num_workers = worker_info.num_workers if worker_info is not None else 1
+
+        shard, num_shards = self.rank * num_workers + worker_id, self.world_size * num_workers
+
+        samples_per_rank = len(self)
+        num_samples = samples_per_rank // num_workers
+        if worker_id < samples_per_rank % num_workers:
+            num_samples += 1
+
+        # Chaque worker ne charge que sa part de la cohorte ; une part vide (cohorte plus petite
+        # que le nombre de workers) reprend un patient pour garder le même nombre de pas par rang
+        all_indices = list(range(len(self.dataset)))
+        if not all_indices:
+            return
+        indices = all_indices[shard::num_shards] or [all_indices[shard % len(all_indices)]]
+        volumes_per_round = min(self.max_volumes, len(indices))
 
+        produced = 0
+        position = len(indices)
+        while produced < num_samples:
+            patches = []
+            for _ in range(volumes_per_round):
+                if position == len(indices):
+                    if self.shuffle:
+                        random.shuffle(indices)
+                    position = 0
+                idx = indices[position]
+                position += 1
+                with profile_stage("dataset.load_volumes"):
+                    input_tensor, target_tensor = self.dataset.load_volumes(idx)
+                patches.extend(self.dataset.extract_patch(input_tensor, target_tensor, idx) for _ in range(self.samples_per_volume))
 
+            if self.shuffle:
+                random.shuffle(patches)
 
+            for input_patch, target_patch in patches[:num_samples - produced]:
+                yield torch.tensor(input_patch, dtype=torch.float32), torch.tensor(target_patch, dtype=torch.float32)
+            produced += len(patches)
@@ -0,0 +1,245 @@
+from pathlib import Path
+import csv
+import json
+import time
+import argparse
+import torch
+import numpy as np
+import torch.nn.functional as F
+from loguru import logger
+
+from inference.sliding_window import load_generator, load_input_volume, sliding_window_inference
+from utils.chunked_store import chunked_path_for
+from utils.physiological_masking import ORGAN_LABELS, SEGMENTATION_SUBDIR, load_organ_labels
+
+
+METRIC_FIELDS = ["mae", "psnr", "ssim", "organ_suvmax_err", "organ_suvmean_err", "lesion_mae_suv", "lesion_suvmax_err", "lesion_voxels"]
+
+
+def held_out_patients(root_dir: Path, patients_file: Path = None, val_fraction: float = 0.1) -> list[Path]:
+    """Patients d'évaluation : liste explicite (un nom par ligne) ou dernière fraction de la cohorte triée."""
+    patients = sorted(p for p in Path(root_dir).iterdir() if p.is_dir() and not p.name.startswith("."))
+    if patients_file is not None:
+        names = {line.strip() for line in Path(patients_file).read_text().splitlines() if line.strip()}
+        return [p for p in patients if p.name in names]
+    num_held_out = max(1, int(round(len(patients) * val_fraction)))
+    return patients[-num_held_out:]
+
+
+def _volume_path(path: Path) -> Path:
+    # Même volume en stockage par blocs si utils/chunked_store.py l'a converti
+    chunked_path = chunked_path_for(path)
+    return chunked_path if chunked_path.exists() else path
+
+
+def _box_mean(volume: torch.Tensor, window: int) -> torch.Tensor:
+    return F.avg_pool3d(volume, window, stride=1)
+
+
+def _ssim_slab(prediction: np.ndarray, target: np.ndarray, data_range: float, window: int) -> tuple[float, int]:
+    # SSIM local sur fenêtre cubique uniforme, sans padding : seules les positions valides de la tranche
+    x = torch.from_numpy(np.ascontiguousarray(prediction, dtype=np.float32))[None, None]
+    y = torch.from_numpy(np.ascontiguousarray(target, dtype=np.float32))[None, None]
+    c1, c2 = (0.01 * data_range) ** 2, (0.03 * data_range) ** 2
+
+    mu_x, mu_y = _box_mean(x, window), _box_mean(y, window)
+    var_x = _box_mean(x * x, window) - mu_x ** 2
+    var_y = _box_mean(y * y, window) - mu_y ** 2
+    cov = _box_mean(x * y, window) - mu_x * mu_y
+
+    ssim_map = ((2 * mu_x * mu_y + c1) * (2 * cov + c2)) / ((mu_x ** 2 + mu_y ** 2 + c1) * (var_x + var_y + c2))
+    return float(ssim_map.sum(dtype=torch.float64)), ssim_map.numel()
+
+
+def evaluate_volume(prediction: np.ndarray, target, input_volume=None, labels: np.ndarray = None, lesion_mask=None, slab: int = 16,
+                    data_range: float = 1.0, suv_scale: float = 20.0, lesion_threshold: float = 2.5, ssim_window: int = 7) -> dict:
+    """Métriques accumulées tranche par tranche (axe 0) : aucune copie float64 du volume entier.
+
+    Les volumes sont normalisés (mode "scale") : SUV = valeur x `suv_scale`. Sans `lesion_mask`,
+    la région lésionnelle est l'entrée au-dessus de `lesion_threshold` SUV hors organes étiquetés.
+    """
+    depth = prediction.shape[0]
+    num_labels = len(ORGAN_LABELS) + 1
+    abs_error_sum, sq_error_sum, count = 0.0, 0.0, 0
+    ssim_sum, ssim_count = 0.0, 0
+    organ_sum = {"prediction": np.zeros(num_labels), "target": np.zeros(num_labels)}
+    organ_max = {"prediction": np.full(num_labels, -np.inf), "target": np.full(num_labels, -np.inf)}
+    organ_count = np.zeros(num_labels, dtype=np.int64)
+    lesion_abs_sum, lesion_count = 0.0, 0
+    lesion_max = {"prediction": -np.inf, "target": -np.inf}
+
+    half = ssim_window // 2
+    for start in range(0, depth, slab):
+        stop = min(start + slab, depth)
+        pred = np.asarray(prediction[start:stop], dtype=np.float32)
+        targ = np.asarray(target[start:stop], dtype=np.float32)
+        error = pred - targ
+
+        abs_error_sum += float(np.abs(error).sum(dtype=np.float64))
+        sq_error_sum += float(np.square(error).sum(dtype=np.float64))
+        count += error.size
+
+        # Fenêtre SSIM : les centres de la tranche plus un bord de `half` voxels ; chaque centre n'est compté qu'une fois
+        first_center, last_center = max(start, half), min(stop, depth - half)
+        if last_center > first_center and min(pred.shape[1:]) >= ssim_window:
+            s, n = _ssim_slab(
+                prediction[first_center - half:last_center + half],
+                target[first_center - half:last_center + half],
+                data_range, ssim_window,
+            )
+            ssim_sum += s
+            ssim_count += n
+
+        organ_labels = None
+        if labels is not None:
+            organ_labels = np.asarray(labels[start:stop]).astype(np.intp, copy=False)
+            flat_labels = organ_labels.ravel()
+            organ_count += np.bincount(flat_labels, minlength=num_labels)[:num_labels]
+            for name, values in (("prediction", pred), ("target", targ)):
+                organ_sum[name] += np.bincount(flat_labels, weights=values.ravel(), minlength=num_labels)[:num_labels]
+                np.maximum.at(organ_max[name], flat_labels, values.ravel())
+
+        if lesion_mask is not None:
+            lesion = np.asarray(lesion_mask[start:stop]) > 0
+        elif input_volume is not None:
+            lesion = np.asarray(input_volume[start:stop], dtype=np.float32) * suv_scale > lesion_threshold
+            if organ_labels is not None:
+                lesion &= organ_labels == 0
+        else:
+            lesion = None
+        if lesion is not None and lesion.any():
+            lesion_abs_sum += float(np.abs(error[lesion]).sum(dtype=np.float64))
+            lesion_count += int(lesion.sum())
+            lesion_max["prediction"] = max(lesion_max["prediction"], float(pred[lesion].max()))
+            lesion_max["target"] = max(lesion_max["target"], float(targ[lesion].max()))
+
+    mse = sq_error_sum / count
+    metrics = {
+        "mae": abs_error_sum / count,
+        "psnr": float(10 * np.log10(data_range ** 2 / mse)) if mse > 0 else float("inf"),
+        "ssim": ssim_sum / ssim_count if ssim_count else float("nan"),
+        "organ_suvmax_err": float("nan"),
+        "organ_suvmean_err": float("nan"),
+        "lesion_mae_suv": lesion_abs_sum / lesion_count * suv_scale if lesion_count else float("nan"),
+        "lesion_suvmax_err": abs(lesion_max["prediction"] - lesion_max["target"]) * suv_scale if lesion_count else float("nan"),
+        "lesion_voxels": lesion_count,
+    }
+
+    if labels is not None:
+        suvmax_errors, suvmean_errors = [], []
+        for organ, label in ORGAN_LABELS.items():
+            if organ_count[label] == 0:
+                metrics[f"{organ}_suvmax_err"] = metrics[f"{organ}_suvmean_err"] = float("nan")
+                continue
+            suvmax_err = abs(organ_max["prediction"][label] - organ_max["target"][label]) * suv_scale
+            suvmean_err = abs(organ_sum["prediction"][label] - organ_sum["target"][label]) / organ_count[label] * suv_scale
+            metrics[f"{organ}_suvmax_err"] = float(suvmax_err)
+            metrics[f"{organ}_suvmean_err"] = float(suvmean_err)
+            suvmax_errors.append(suvmax_err)
+            suvmean_errors.append(suvmean_err)
+        if suvmax_errors:
+            metrics["organ_suvmax_err"] = float(np.mean(suvmax_errors))
+            metrics["organ_suvmean_err"] = float(np.mean(suvmean_errors))
+    return metrics
+
+
+def evaluate_patient(generator: torch.nn.Module, patient_dir: Path, patch_size=(128, 128, 128), overlap: float = 0.25, tile_batch_size: int = 4,
+                     device: torch.device = torch.device("cpu"), mask_subdir: str = SEGMENTATION_SUBDIR, **metric_kwargs) -> dict:
+    """Prédiction complète par tuiles, puis métriques par tranches (evaluate_volume).
+
+    Adaptation délibérée : les métriques ne sont pas accumulées tuile par tuile, car les tuiles se
+    chevauchent et ne sont définitives qu'après la fusion gaussienne. Le pic mémoire est celui de
+    sliding_window_inference (sortie et poids float32), sans copie float64 pour les métriques.
+    """
+    input_volume, _, _ = load_input_volume(_volume_path(patient_dir / "baseline" / "PET_preprocessed.nii.gz"))
+    target_volume, _, _ = load_input_volume(_volume_path(patient_dir / "normal" / "PET_preprocessed.nii.gz"))
+
+    start_time = time.perf_counter()
+    prediction = sliding_window_inference(input_volume, generator, patch_size, overlap, tile_batch_size, device)
+    inference_s = time.perf_counter() - start_time
+
+    # Masques hors de la grille du PET prétraité (ex. grille native du CT) : métriques correspondantes ignorées,
+    # plutôt qu'une erreur qui arrêterait le rang 0 pendant l'entraînement
+    labels = None
+    mask_dir = patient_dir / mask_subdir
+    try:
+        labels = load_organ_labels(mask_dir) if mask_dir.exists() else None
+    except FileNotFoundError:
+        pass
+    if labels is None:
+        logger.warning(f"No organ masks in {mask_dir}; organ metrics skipped for {patient_dir.name}.")
+    elif tuple(labels.shape) != tuple(prediction.shape):
+        logger.warning(f"Organ labels in {mask_dir} have shape {labels.shape}, expected {prediction.shape}; organ metrics skipped for {patient_dir.name}.")
+        labels = None
+
+    lesion_mask = None
+    lesion_path = patient_dir / "lesion_mask.nii.gz"
+    if lesion_path.exists():
+        lesion_mask, _, _ = load_input_volume(lesion_path)
+        if tuple(lesion_mask.shape) != tuple(prediction.shape):
+            logger.warning(f"{lesion_path} has shape {lesion_mask.shape}, expected {prediction.shape}; lesions taken from the SUV threshold for {patient_dir.name}.")
+            lesion_mask = None
+
+    start_time = time.perf_counter()
+    metrics = evaluate_volume(prediction, target_volume, input_volume, labels, lesion_mask, **metric_kwargs)
+    metrics.update({"patient": patient_dir.name, "inference_s": inference_s, "metrics_s": time.perf_counter() - start_time})
+    return metrics
+
+
+def write_results(results: list[dict], output_dir: Path) -> dict:
+    output_dir.mkdir(parents=True, exist_ok=True)
+    fields = ["patient"] + METRIC_FIELDS + sorted({key for row in results for key in row} - set(METRIC_FIELDS) - {"patient"})
+    with open(output_dir / "per_patient.csv", "w", newline="") as f:
+        writer = csv.DictWriter(f, fieldnames=fields)
+        writer.writeheader()
+        writer.writerows(results)
+
+    # Moyennes sur les patients, valeurs manquantes (NaN) ignorées
+    summary = {"num_patients": len(results)}
+    for field in fields[1:]:
+        values = np.array([row.get(field, np.nan) for row in results], dtype=np.float64)
+        values = values[np.isfinite(values)]
+        summary[field] = float(values.mean()) if values.size else None
+    with open(output_dir / "summary.json", "w") as f:
+        json.dump(summary, f, indent=4)
+    return summary
+
+
+def evaluate_cohort(generator: torch.nn.Module, patient_dirs: list[Path], output_dir: Path, **kwargs) -> dict:
+    start_time = time.perf_counter()
+    results = []
+    for patient_dir in patient_dirs:
+        metrics = evaluate_patient(generator, patient_dir, **kwargs)
+        logger.info(f"{patient_dir.name}: MAE {metrics['mae']:.4f} | PSNR {metrics['psnr']:.2f} dB | SSIM {metrics['ssim']:.4f}")
+        results.append(metrics)
+
+    summary = write_results(results, output_dir)
+    logger.info(
+        f"Evaluation on {len(results)} patients in {time.perf_counter() - start_time:.1f}s: "
+        f"MAE {summary['mae']:.4f} | PSNR {summary['psnr']:.2f} dB | SSIM {summary['ssim']:.4f} -> {output_dir}"
+    )
+    return summary
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Evaluate Generator3D on held-out patients (whole-volume metrics).")
+    parser.add_argument("--weights", type=Path, required=True, help="Checkpoint or generator state_dict.")
+    parser.add_argument("--data_root", type=Path, default=Path("data/processed"))
+    parser.add_argument("--patients", type=Path, default=None, help="File listing held-out patient names, one per line.")
+    parser.add_argument("--val_fraction", type=float, default=0.1, help="Without --patients: last fraction of the sorted cohort.")
+    parser.add_argument("--output_dir", type=Path, default=Path("outputs/evaluation"))
+    parser.add_argument("--patch_size", type=int, nargs=3, default=(128, 128, 128))
+    parser.add_argument("--overlap", type=float, default=0.25)
+    parser.add_argument("--tile_batch_size", type=int, default=4)
+    parser.add_argument("--mask_subdir", default=SEGMENTATION_SUBDIR, help="Organ masks directory inside each patient directory.")
+    parser.add_argument("--suv_scale", type=float, default=20.0, help="scale_max used by the preprocessing normalization.")
+    parser.add_argument("--lesion_threshold", type=float, default=2.5, help="SUV threshold for lesions when no lesion_mask.nii.gz exists.")
+    args = parser.parse_args()
+
+    device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
+    generator = load_generator(args.weights, device)
+    evaluate_cohort(
+        generator, held_out_patients(args.data_root, args.patients, args.val_fraction), args.output_dir,
+        patch_size=tuple(args.patch_size), overlap=args.overlap, tile_batch_size=args.tile_batch_size, device=device,
+        mask_subdir=args.mask_subdir, suv_scale=args.suv_scale, lesion_threshold=args.lesion_threshold,
+    )
@@ -0,0 +1,201 @@
+from pathlib import Path
+import json
+import time
+import uuid
+import queue
+import argparse
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import torch
+import numpy as np
+import nibabel as nib
+from loguru import logger
+
+from inference.sliding_window import load_generator, load_input_volume, sliding_window_inference
+from models.optimization import COMPILE_MODES, optimize_for_inference
+
+
+class InferenceService:
+    """Service d'inférence longue durée : le générateur est chargé une seule fois.
+
+    Les travaux (NIfTI d'entrée -> NIfTI de sortie) traversent trois étapes en pipeline,
+    chacune sur son thread : décodage du travail suivant, calcul du travail courant et
+    encodage gzip du travail précédent se chevauchent. Les travaux terminés restent consultables
+    `job_ttl` secondes, et au plus `max_finished_jobs` sont conservés.
+    """
+
+    def __init__(self, weights_path: Path, device: torch.device, patch_size=(128, 128, 128), overlap: float = 0.5, tile_batch_size: int = 4, max_pending: int = 2, compile: bool = False, compile_backend: str = "inductor", compile_mode: str = "default",
+                 job_ttl: float = 3600.0, max_finished_jobs: int = 1000):
+        # BatchNorm toujours fusionné : le service ne fait que de l'inférence
+        self.generator = optimize_for_inference(load_generator(weights_path, device), compile, compile_backend, compile_mode)
+        self.compiled = compile
+        self.device = device
+        self.patch_size = patch_size
+        self.overlap = overlap
+        self.tile_batch_size = tile_batch_size
+
+        self.jobs = {}
+        self.job_ttl = job_ttl
+        self.max_finished_jobs = max_finished_jobs
+        self._jobs_lock = threading.Lock()
+        self._decode_queue = queue.Queue()
+        # Files bornées entre étapes : au plus `max_pending` volumes décodés en mémoire
+        self._compute_queue = queue.Queue(maxsize=max_pending)
+        self._encode_queue = queue.Queue(maxsize=max_pending)
+
+        self._threads = [
+            threading.Thread(target=self._decode_loop, name="decode", daemon=True),
+            threading.Thread(target=self._compute_loop, name="compute", daemon=True),
+            threading.Thread(target=self._encode_loop, name="encode", daemon=True),
+        ]
+        for thread in self._threads:
+            thread.start()
+
+    def submit(self, input_path: Path, output_path: Path) -> str:
+        job_id = uuid.uuid4().hex
+        with self._jobs_lock:
+            self._prune_jobs()
+            self.jobs[job_id] = {"input": str(input_path), "output": str(output_path), "status": "queued", "submitted": time.time()}
+        self._decode_queue.put((job_id, Path(input_path), Path(output_path)))
+        logger.info(f"Job {job_id} queued: {input_path} -> {output_path}")
+        return job_id
+
+    def status(self, job_id: str) -> dict:
+        with self._jobs_lock:
+            return dict(self.jobs.get(job_id, {"status": "unknown"}))
+
+    def _prune_jobs(self):
+        # Appelé sous _jobs_lock : seuls les travaux terminés (done/failed) sont oubliés, les plus anciens d'abord
+        finished = sorted((job["finished"], job_id) for job_id, job in self.jobs.items() if "finished" in job)
+        expired = time.time() - self.job_ttl
+        excess = len(finished) - self.max_finished_jobs
+        for i, (finished_at, job_id) in enumerate(finished):
+            if finished_at >= expired and i >= excess:
+                break
+            del self.jobs[job_id]
+
+    def _update(self, job_id: str, **fields):
+        with self._jobs_lock:
+            self.jobs[job_id].update(fields)
+
+    def _fail(self, job_id: str, stage: str, error: Exception):
+        logger.exception(f"Job {job_id} failed during {stage}: {error}")
+        self._update(job_id, status="failed", error=f"{stage}: {type(error).__name__}: {error}", finished=time.time())
+
+    def _decode_loop(self):
+        while True:
+            job_id, input_path, output_path = self._decode_queue.get()
+            try:
+                self._update(job_id, status="decoding")
+                volume, affine, header = load_input_volume(input_path)
+                self._compute_queue.put((job_id, (affine, header), volume, output_path))
+            except Exception as e:
+                self._fail(job_id, "decode", e)
+
+    def _compute_loop(self):
+        while True:
+            job_id, geometry, volume, output_path = self._compute_queue.get()
+            try:
+                self._update(job_id, status="running")
+                start_time = time.perf_counter()
+                prediction = sliding_window_inference(volume, self.generator, self.patch_size, self.overlap, self.tile_batch_size, self.device, pad_last_batch=self.compiled)
+                self._update(job_id, compute_s=time.perf_counter() - start_time)
+                del volume
+                self._encode_queue.put((job_id, geometry, prediction, output_path))
+            except Exception as e:
+                self._fail(job_id, "compute", e)
+
+    def _encode_loop(self):
+        while True:
+            job_id, geometry, prediction, output_path = self._encode_queue.get()
+            try:
+                self._update(job_id, status="encoding")
+                affine, header = geometry
+                header = header.copy()
+                header.set_data_dtype(np.float32)
+                header["scl_slope"] = 1.0
+                header["scl_inter"] = 0.0
+                output_path.parent.mkdir(parents=True, exist_ok=True)
+
+                # Écriture puis renommage : le fichier de sortie n'apparaît que complet
+                tmp_path = output_path.with_name(".tmp-" + output_path.name)
+                nib.save(nib.Nifti1Image(prediction, affine, header), str(tmp_path))
+                tmp_path.replace(output_path)
+
+                self._update(job_id, status="done", finished=time.time())
+                logger.success(f"Job {job_id} done: {output_path}")
+            except Exception as e:
+                self._fail(job_id, "encode", e)
+
+
+def make_handler(service: InferenceService):
+    class InferenceRequestHandler(BaseHTTPRequestHandler):
+
+        def _send_json(self, code: int, payload: dict):
+            body = json.dumps(payload).encode()
+            self.send_response(code)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def do_POST(self):
+            if self.path != "/jobs":
+                self._send_json(404, {"error": "not found"})
+                return
+            try:
+                length = int(self.headers.get("Content-Length", 0))
+                request = json.loads(self.rfile.read(length))
+                if not isinstance(request, dict):
+                    raise ValueError(f"got {type(request).__name__}")
+                input_path, output_path = Path(request["input"]), Path(request["output"])
+            except (ValueError, KeyError, TypeError) as e:
+                self._send_json(400, {"error": f"expected JSON with 'input' and 'output': {e}"})
+                return
+            if not input_path.exists():
+                self._send_json(400, {"error": f"input not found: {input_path}"})
+                return
+            self._send_json(202, {"job_id": service.submit(input_path, output_path)})
+
+        def do_GET(self):
+            if self.path == "/health":
+                self._send_json(200, {"status": "ok"})
+            elif self.path.startswith("/jobs/"):
+                job = service.status(self.path.rsplit("/", 1)[-1])
+                self._send_json(404 if job["status"] == "unknown" else 200, job)
+            else:
+                self._send_json(404, {"error": "not found"})
+
+        def log_message(self, format, *args):
+            logger.debug(f"{self.address_string()} {format % args}")
+
+    return InferenceRequestHandler
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Long-running Generator3D inference service (local HTTP).")
+    parser.add_argument("--weights", type=Path, required=True, help="Checkpoint or generator state_dict.")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8765)
+    parser.add_argument("--patch_size", type=int, nargs=3, default=(128, 128, 128))
+    parser.add_argument("--overlap", type=float, default=0.5)
+    parser.add_argument("--tile_batch_size", type=int, default=4)
+    parser.add_argument("--max_pending", type=int, default=2, help="Decoded/predicted volumes buffered between stages.")
+    parser.add_argument("--compile", action="store_true", help="torch.compile the generator (first job pays the compilation).")
+    parser.add_argument("--compile_backend", default="inductor")
+    parser.add_argument("--compile_mode", choices=COMPILE_MODES, default="default")
+    parser.add_argument("--job_ttl", type=float, default=3600, help="Seconds a finished job stays queryable.")
+    parser.add_argument("--max_finished_jobs", type=int, default=1000, help="Finished jobs kept at most, oldest evicted first.")
+    args = parser.parse_args()
+
+    device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
+    service = InferenceService(args.weights, device, tuple(args.patch_size), args.overlap, args.tile_batch_size, args.max_pending, args.compile, args.compile_backend, args.compile_mode,
+                               args.job_ttl, args.max_finished_jobs)
+
+    server = ThreadingHTTPServer((args.host, args.port), make_handler(service))
+    logger.info(f"Inference service listening on http://{args.host}:{args.port} (POST /jobs, GET /jobs/<id>)")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        logger.info("Shutting down inference service.")
+        server.server_close()
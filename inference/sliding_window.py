@@ -0,0 +1,173 @@
+from pathlib import Path
+import time
+import argparse
+import torch
+import numpy as np
+import nibabel as nib
+from typing import Tuple
+from loguru import logger
+
+from models.generator import Generator3D
+from models.optimization import COMPILE_MODES, optimize_for_inference
+from utils.chunked_store import CHUNKED_SUFFIX, chunked_affine_header, open_chunked
+
+
+def gaussian_importance_map(patch_size: Tuple[int, int, int], sigma_scale: float = 0.125) -> np.ndarray:
+    # Poids maximal au centre du patch, faible sur les bords : masque les artefacts de couture
+    axes = []
+    for size in patch_size:
+        coords = np.arange(size, dtype=np.float32) - (size - 1) / 2
+        sigma = max(size * sigma_scale, 1e-3)
+        axes.append(np.exp(-0.5 * (coords / sigma) ** 2))
+
+    weights = axes[0][:, None, None] * axes[1][None, :, None] * axes[2][None, None, :]
+    weights /= weights.max()
+    return np.maximum(weights, 1e-3).astype(np.float32)
+
+
+def tile_starts(size: int, patch: int, overlap: float) -> list[int]:
+    # Le dernier patch est aligné sur le bord du volume : toutes les tuiles ont la même forme
+    if size <= patch:
+        return [0]
+    step = max(1, int(round(patch * (1 - overlap))))
+    starts = list(range(0, size - patch, step))
+    starts.append(size - patch)
+    return starts
+
+
+def sliding_window_inference(volume: np.ndarray, generator: torch.nn.Module, patch_size=(128, 128, 128), overlap: float = 0.5, tile_batch_size: int = 4, device: torch.device = torch.device("cpu"), sigma_scale: float = 0.125, pad_last_batch: bool = False) -> np.ndarray:
+    """Applique le générateur sur tout le volume par tuiles chevauchantes, fusionnées par pondération gaussienne.
+
+    `volume` peut être un ndarray, un memmap ou tout tableau découpable : seules les tuiles
+    sont lues. La sortie et les poids sont alloués une seule fois, en float32.
+    `pad_last_batch` complète le dernier lot avec des tuiles vides pour garder une forme
+    d'entrée constante (évite une recompilation avec un générateur torch.compile).
+    """
+    original_shape = volume.shape
+    pad = [(0, max(p - s, 0)) for s, p in zip(original_shape, patch_size)]
+    if any(after for _, after in pad):
+        volume = np.pad(np.asarray(volume, dtype=np.float32), pad, mode="constant")
+    shape = volume.shape
+
+    output = np.zeros(shape, dtype=np.float32)
+    weight_sum = np.zeros(shape, dtype=np.float32)
+    importance = gaussian_importance_map(patch_size, sigma_scale)
+
+    pd, ph, pw = patch_size
+    tiles = [
+        (d, h, w)
+        for d in tile_starts(shape[0], pd, overlap)
+        for h in tile_starts(shape[1], ph, overlap)
+        for w in tile_starts(shape[2], pw, overlap)
+    ]
+
+    generator.eval()
+    with torch.inference_mode():
+        for batch_start in range(0, len(tiles), tile_batch_size):
+            batch_tiles = tiles[batch_start:batch_start + tile_batch_size]
+            batch = np.stack([
+                np.asarray(volume[d:d + pd, h:h + ph, w:w + pw], dtype=np.float32)
+                for d, h, w in batch_tiles
+            ])[:, None]
+            if pad_last_batch and len(batch_tiles) < tile_batch_size:
+                batch = np.concatenate([batch, np.zeros((tile_batch_size - len(batch_tiles), *batch.shape[1:]), dtype=np.float32)])
+
+            prediction = generator(torch.from_numpy(batch).to(device)).float().cpu().numpy()
+
+            for (d, h, w), tile_prediction in zip(batch_tiles, prediction[:, 0]):
+                output[d:d + pd, h:h + ph, w:w + pw] += tile_prediction * importance
+                weight_sum[d:d + pd, h:h + ph, w:w + pw] += importance
+
+    output /= weight_sum
+    return output[:original_shape[0], :original_shape[1], :original_shape[2]]
+
+
+def load_generator(weights_path: Path, device: torch.device = torch.device("cpu")) -> Generator3D:
+    state = torch.load(weights_path, map_location=device, weights_only=False)
+    # Checkpoint complet (training/checkpoint.py) ou state_dict seul
+    if "generator" in state:
+        state = state["generator"]
+
+    generator = Generator3D(in_channels=1).to(device)
+    generator.load_state_dict(state)
+    generator.eval()
+    logger.info(f"Loaded generator weights from {weights_path}")
+    return generator
+
+
+def load_input_volume(input_path: Path):
+    """(volume, affine, header) ; un volume .zarr n'est pas lu en entier, les tuiles le lisent bloc par bloc."""
+    if Path(input_path).name.endswith(CHUNKED_SUFFIX):
+        volume = open_chunked(input_path)
+        return (volume, *chunked_affine_header(volume))
+    image = nib.load(input_path)
+    return image.get_fdata(dtype=np.float32), image.affine, image.header
+
+
+def predict_volume(generator: torch.nn.Module, input_path: Path, output_path: Path, patch_size=(128, 128, 128), overlap: float = 0.5, tile_batch_size: int = 4, device: torch.device = torch.device("cpu"), pad_last_batch: bool = False):
+    logger.info(f"Running inference on {input_path}")
+    start_time = time.perf_counter()
+
+    volume, affine, header = load_input_volume(input_path)
+    prediction = sliding_window_inference(volume, generator, patch_size, overlap, tile_batch_size, device, pad_last_batch=pad_last_batch)
+
+    header = header.copy()
+    header.set_data_dtype(np.float32)
+    header["scl_slope"] = 1.0
+    header["scl_inter"] = 0.0
+    nib.save(nib.Nifti1Image(prediction, affine, header), str(output_path))
+
+    logger.info(f"Prediction saved to {output_path} in {time.perf_counter() - start_time:.1f}s")
+
+
+def benchmark_inference(generator: torch.nn.Module, volume_shape=(256, 256, 320), patch_size=(128, 128, 128), overlap: float = 0.5, tile_batch_size: int = 4, repeats: int = 3, device: torch.device = torch.device("cpu"), pad_last_batch: bool = False) -> float:
+    volume = np.random.rand(*volume_shape).astype(np.float32)
+    sliding_window_inference(volume, generator, patch_size, overlap, tile_batch_size, device, pad_last_batch=pad_last_batch)  # échauffement
+
+    start_time = time.perf_counter()
+    for _ in range(repeats):
+        sliding_window_inference(volume, generator, patch_size, overlap, tile_batch_size, device, pad_last_batch=pad_last_batch)
+    seconds_per_volume = (time.perf_counter() - start_time) / repeats
+
+    volumes_per_minute = 60.0 / seconds_per_volume
+    logger.info(
+        f"Inference benchmark {volume_shape} (overlap {overlap}, tile batch {tile_batch_size}, {device}): "
+        f"{seconds_per_volume:.1f}s/volume, {volumes_per_minute:.2f} volumes/min"
+    )
+    return volumes_per_minute
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Whole-volume sliding-window inference with Generator3D.")
+    parser.add_argument("--weights", type=Path, help="Checkpoint or generator state_dict.")
+    parser.add_argument("--input", type=Path, help="Preprocessed PET volume (.nii.gz or chunked .zarr).")
+    parser.add_argument("--output", type=Path)
+    parser.add_argument("--patch_size", type=int, nargs=3, default=(128, 128, 128))
+    parser.add_argument("--overlap", type=float, default=0.5)
+    parser.add_argument("--tile_batch_size", type=int, default=4)
+    parser.add_argument("--threads", type=int, default=None, help="torch intra-op threads on CPU.")
+    parser.add_argument("--benchmark", action="store_true", help="Measure CPU throughput in volumes/min on a synthetic volume.")
+    parser.add_argument("--fold_batchnorm", action="store_true", help="Fold BatchNorm3d into the preceding convolutions.")
+    parser.add_argument("--compile", action="store_true", help="torch.compile the (folded) generator; implies --fold_batchnorm.")
+    parser.add_argument("--compile_backend", default="inductor")
+    parser.add_argument("--compile_mode", choices=COMPILE_MODES, default="default")
+    args = parser.parse_args()
+    if not args.benchmark and (args.weights is None or args.input is None or args.output is None):
+        parser.error("--weights, --input and --output are required unless --benchmark is set.")
+
+    if args.threads:
+        torch.set_num_threads(args.threads)
+    device = torch.device("cuda" if torch.cuda.is_available() and not args.benchmark else "cpu")
+    patch_size = tuple(args.patch_size)
+
+    if args.weights is not None:
+        generator = load_generator(args.weights, device)
+    else:
+        generator = Generator3D(in_channels=1).to(device).eval()
+    if args.fold_batchnorm or args.compile:
+        generator = optimize_for_inference(generator, args.compile, args.compile_backend, args.compile_mode)
+
+    if args.benchmark:
+        benchmark_inference(generator, patch_size=patch_size, overlap=args.overlap, tile_batch_size=args.tile_batch_size, device=device, pad_last_batch=args.compile)
+    else:
+        predict_volume(generator, args.input, args.output, patch_size, args.overlap, args.tile_batch_size, device, pad_last_batch=args.compile)
@@ -0,0 +1,41 @@
+import contextlib
+import torch.nn as nn
+from torch.utils.checkpoint import checkpoint
+
+
+@contextlib.contextmanager
+def frozen_batchnorm_stats(layers):
+    # Le recalcul du backward repasse les BatchNorm en mode train : sans restauration, leurs
+    # statistiques courantes seraient mises à jour deux fois par pas
+    batchnorms = [m for layer in layers for m in layer.modules() if isinstance(m, nn.modules.batchnorm._BatchNorm) and m.track_running_stats]
+    saved = [(m.running_mean.clone(), m.running_var.clone(), m.num_batches_tracked.clone()) for m in batchnorms]
+    try:
+        yield
+    finally:
+        for m, (running_mean, running_var, num_batches_tracked) in zip(batchnorms, saved):
+            m.running_mean.copy_(running_mean)
+            m.running_var.copy_(running_var)
+            m.num_batches_tracked.copy_(num_batches_tracked)
+
+
+def _run_layers(layers):
+    def forward(x):
+        for layer in layers:
+            x = layer(x)
+        return x
+    return forward
+
+
+def checkpoint_sequential_frozen_bn(sequential: nn.Sequential, segments: int, x):
+    """Comme torch.utils.checkpoint.checkpoint_sequential, mais le recalcul ne touche pas aux
+    statistiques courantes des BatchNorm : le modèle d'évaluation est le même avec ou sans checkpointing.
+
+    Le dernier segment n'est pas checkpointé (ses activations servent tout de suite au backward).
+    """
+    layers = list(sequential)
+    segment_size = max(1, -(-len(layers) // segments))
+    chunks = [layers[i:i + segment_size] for i in range(0, len(layers), segment_size)]
+
+    for chunk in chunks[:-1]:
+        x = checkpoint(_run_layers(chunk), x, use_reentrant=False, context_fn=lambda chunk=chunk: (contextlib.nullcontext(), frozen_batchnorm_stats(chunk)))
+    return _run_layers(chunks[-1])(x)
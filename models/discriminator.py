@@ -1,22 +1,30 @@
 import torch
 import torch.nn as nn
+from models.checkpointing import checkpoint_sequential_frozen_bn
 
 class Discriminator3D(nn.Module):
     
-    def __init__(self, in_channels=3, features=32):
+    def __init__(self, in_channels=3, features=32, use_checkpointing=False, checkpoint_segments=2):
         super().__init__()
+        self.use_checkpointing = use_checkpointing
+        self.checkpoint_segments = checkpoint_segments
+        # Pas d'activation sur place si une frontière de segment peut tomber juste avant elle
+        inplace = not use_checkpointing
         self.model = nn.Sequential(
             nn.Conv3d(in_channels, features, 4, 2, 1),
-            nn.LeakyReLU(0.2, inplace=True),
+            nn.LeakyReLU(0.2, inplace=inplace),
             
             nn.Conv3d(features, features*2, 4, 2, 1),
             nn.BatchNorm3d(features*2),
-            nn.LeakyReLU(0.2, inplace=True),
+            nn.LeakyReLU(0.2, inplace=inplace),
 
             nn.Conv3d(features*2, 1, 4, 1, 1),
             nn.Sigmoid()
         )
 
     def forward(self, x, y):
-        return self.model(torch.cat([x, y], dim=1))
+        x = torch.cat([x, y], dim=1)
+        if self.use_checkpointing and self.training and torch.is_grad_enabled():
+            return checkpoint_sequential_frozen_bn(self.model, self.checkpoint_segments, x)
+        return self.model(x)
 
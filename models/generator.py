@@ -1,28 +1,38 @@
+import torch
 import torch.nn as nn
+from models.checkpointing import checkpoint_sequential_frozen_bn
 
 class Generator3D(nn.Module):
 
-    def __init__(self, in_channels=1, out_channels=1, features=32):
+    def __init__(self, in_channels=1, out_channels=1, features=32, use_checkpointing=False, checkpoint_segments=2):
         super().__init__()
+        # Checkpointing par segments : seules les entrées des segments sont gardées, le reste est recalculé au backward
+        self.use_checkpointing = use_checkpointing
+        self.checkpoint_segments = checkpoint_segments
+        # Pas d'activation sur place si une frontière de segment peut tomber juste avant elle
+        inplace = not use_checkpointing
         self.encoder = nn.Sequential(
             nn.Conv3d(in_channels, features, kernel_size=4, stride=2, padding=1),
             nn.BatchNorm3d(features),
-            nn.ReLU(inplace=True),
+            nn.ReLU(inplace=inplace),
 
             nn.Conv3d(features, features*2, kernel_size=4, stride=2, padding=1),
             nn.BatchNorm3d(features*2),
-            nn.ReLU(inplace=True),
+            nn.ReLU(inplace=inplace),
         )
         self.decoder = nn.Sequential(
             nn.ConvTranspose3d(features*2, features, kernel_size=4, stride=2, padding=1),
             nn.BatchNorm3d(features),
-            nn.ReLU(inplace=True),
+            nn.ReLU(inplace=inplace),
 
             nn.ConvTranspose3d(features, out_channels, kernel_size=4, stride=2, padding=1),
             nn.Tanh(),
         )
 
     def forward(self, x):
+        if self.use_checkpointing and self.training and torch.is_grad_enabled():
+            x = checkpoint_sequential_frozen_bn(self.encoder, self.checkpoint_segments, x)
+            return checkpoint_sequential_frozen_bn(self.decoder, self.checkpoint_segments, x)
         x = self.encoder(x)
         x = self.decoder(x)
         return x
@@ -0,0 +1,250 @@
+import copy
+import time
+import argparse
+import torch
+import torch.nn as nn
+from loguru import logger
+from torch.nn.utils.fusion import fuse_conv_bn_eval
+
+from models.discriminator import Discriminator3D
+from models.generator import Generator3D
+
+
+COMPILE_MODES = ["default", "reduce-overhead", "max-autotune"]
+AUTOCAST_DTYPES = {
+    "fp32": None,
+    "bf16": torch.bfloat16,
+    "fp16": torch.float16,
+}
+
+
+def fold_batchnorm(model: nn.Module) -> nn.Module:
+    """Copie du modèle pour l'inférence, chaque BatchNorm3d fusionné dans la convolution qui le précède.
+
+    Les statistiques courantes du BatchNorm sont intégrées aux poids : le modèle renvoyé
+    n'est valable qu'en mode eval. Le modèle d'origine n'est pas modifié.
+    """
+    folded = copy.deepcopy(model).eval()
+    num_folded = 0
+    for module in folded.modules():
+        if not isinstance(module, nn.Sequential):
+            continue
+        for i in range(len(module) - 1):
+            conv, bn = module[i], module[i + 1]
+            if isinstance(conv, (nn.Conv3d, nn.ConvTranspose3d)) and isinstance(bn, nn.BatchNorm3d):
+                module[i] = fuse_conv_bn_eval(conv, bn, transpose=isinstance(conv, nn.ConvTranspose3d))
+                module[i + 1] = nn.Identity()
+                num_folded += 1
+
+    logger.info(f"Folded {num_folded} BatchNorm3d layers into their convolutions.")
+    return folded
+
+
+def compile_model(model: nn.Module, backend: str = "inductor", mode: str = "default", dynamic: bool = False) -> nn.Module:
+    # dynamic=False : une seule forme de patch attendue ; les appelants gardent des lots de taille fixe
+    logger.info(f"Compiling {type(model).__name__} (backend: {backend}, mode: {mode})")
+    return torch.compile(model, backend=backend, mode=mode, dynamic=dynamic)
+
+
+def optimize_for_inference(model: nn.Module, compile: bool = False, backend: str = "inductor", mode: str = "default") -> nn.Module:
+    model = fold_batchnorm(model)
+    return compile_model(model, backend, mode) if compile else model
+
+
+def unwrap_model(model: nn.Module) -> nn.Module:
+    # Module d'origine d'un modèle compilé : ses state_dict n'ont pas le préfixe "_orig_mod."
+    return getattr(model, "_orig_mod", model)
+
+
+def _train_step(generator: nn.Module, discriminator: nn.Module, opt_G, opt_D, input_tensor: torch.Tensor, target_tensor: torch.Tensor,
+                autocast_dtype: torch.dtype = None, scaler_D=None, scaler_G=None):
+    # Même découpage que training/train.py : autocast sur les modèles, pertes en float32
+    bce_loss, l1_loss = nn.BCELoss(), nn.L1Loss()
+    device_type = input_tensor.device.type
+    scaler_D = scaler_D or torch.amp.GradScaler(device_type, enabled=False)
+    scaler_G = scaler_G or torch.amp.GradScaler(device_type, enabled=False)
+
+    def autocast():
+        return torch.autocast(device_type=device_type, dtype=autocast_dtype, enabled=autocast_dtype is not None)
+
+    with torch.no_grad(), autocast():
+        fake = generator(input_tensor)
+    with autocast():
+        real_pred = discriminator(input_tensor, target_tensor)
+        fake_pred = discriminator(input_tensor, fake)
+    loss_D = (bce_loss(real_pred.float(), torch.ones_like(real_pred, dtype=torch.float32)) + bce_loss(fake_pred.float(), torch.zeros_like(fake_pred, dtype=torch.float32))) * 0.5
+    opt_D.zero_grad()
+    scaler_D.scale(loss_D).backward()
+    scaler_D.step(opt_D)
+    scaler_D.update()
+
+    with autocast():
+        fake = generator(input_tensor)
+        fake_pred = discriminator(input_tensor, fake)
+    loss_G = bce_loss(fake_pred.float(), torch.ones_like(fake_pred, dtype=torch.float32)) + 100 * l1_loss(fake.float(), target_tensor)
+    opt_G.zero_grad()
+    scaler_G.scale(loss_G).backward()
+    scaler_G.step(opt_G)
+    scaler_G.update()
+
+
+def _time_steps(step, warmup: int, repeats: int) -> float:
+    for _ in range(warmup):
+        step()
+    start_time = time.perf_counter()
+    for _ in range(repeats):
+        step()
+    return (time.perf_counter() - start_time) / repeats
+
+
+def benchmark_compile(patch_size=(128, 128, 128), batch_size: int = 1, backend: str = "inductor", mode: str = "default", warmup: int = 2, repeats: int = 5) -> dict:
+    """Compare le temps d'un pas d'entraînement D+G et d'une inférence, en eager et compilé, sur CPU."""
+    device = torch.device("cpu")
+    input_tensor = torch.rand(batch_size, 1, *patch_size, device=device)
+    target_tensor = torch.rand(batch_size, 1, *patch_size, device=device)
+    results = {}
+
+    for compiled in (False, True):
+        torch.manual_seed(0)
+        generator = Generator3D(in_channels=1).to(device)
+        discriminator = Discriminator3D(in_channels=2).to(device)
+        opt_G = torch.optim.Adam(generator.parameters(), lr=2e-4, betas=(0.5, 0.999))
+        opt_D = torch.optim.Adam(discriminator.parameters(), lr=2e-4, betas=(0.5, 0.999))
+        if compiled:
+            generator = compile_model(generator, backend, mode)
+            discriminator = compile_model(discriminator, backend, mode)
+
+        # La première itération compilée inclut la compilation : absorbée par l'échauffement
+        train_s = _time_steps(lambda: _train_step(generator, discriminator, opt_G, opt_D, input_tensor, target_tensor), warmup, repeats)
+
+        inference_model = fold_batchnorm(unwrap_model(generator))
+        if compiled:
+            inference_model = compile_model(inference_model, backend, mode)
+        with torch.inference_mode():
+            inference_s = _time_steps(lambda: inference_model(input_tensor), warmup, repeats)
+
+        label = "compiled" if compiled else "eager"
+        results[label] = {"train_step_s": train_s, "inference_s": inference_s}
+        logger.info(f"{label:>8}: train step {train_s * 1000:.0f} ms | folded inference {inference_s * 1000:.0f} ms ({patch_size}, batch {batch_size})")
+
+    logger.info(
+        f"Speedup: train x{results['eager']['train_step_s'] / results['compiled']['train_step_s']:.2f}, "
+        f"inference x{results['eager']['inference_s'] / results['compiled']['inference_s']:.2f}"
+    )
+    return results
+
+
+def benchmark_precision(patch_size=(128, 128, 128), batch_size: int = 2, precisions=None, warmup: int = 2, repeats: int = 5, device: torch.device = torch.device("cpu")) -> list[dict]:
+    """Débit d'un pas D+G (voxels/s) pour chaque précision, en format mémoire contigu et channels_last_3d.
+
+    Par défaut : fp32 et bf16 sur CPU, fp32, bf16 et fp16 (avec GradScaler) sur GPU.
+    """
+    if precisions is None:
+        precisions = list(AUTOCAST_DTYPES) if device.type == "cuda" else ["fp32", "bf16"]
+    voxels_per_step = batch_size * patch_size[0] * patch_size[1] * patch_size[2]
+    rows = []
+
+    for precision in precisions:
+        for channels_last in (False, True):
+            memory_format = torch.channels_last_3d if channels_last else torch.contiguous_format
+            torch.manual_seed(0)
+            generator = Generator3D(in_channels=1).to(device, memory_format=memory_format)
+            discriminator = Discriminator3D(in_channels=2).to(device, memory_format=memory_format)
+            opt_G = torch.optim.Adam(generator.parameters(), lr=2e-4, betas=(0.5, 0.999))
+            opt_D = torch.optim.Adam(discriminator.parameters(), lr=2e-4, betas=(0.5, 0.999))
+            scaler_D = torch.amp.GradScaler(device.type, enabled=precision == "fp16")
+            scaler_G = torch.amp.GradScaler(device.type, enabled=precision == "fp16")
+            input_tensor = torch.rand(batch_size, 1, *patch_size, device=device).contiguous(memory_format=memory_format)
+            target_tensor = torch.rand(batch_size, 1, *patch_size, device=device).contiguous(memory_format=memory_format)
+
+            def step():
+                _train_step(generator, discriminator, opt_G, opt_D, input_tensor, target_tensor, AUTOCAST_DTYPES[precision], scaler_D, scaler_G)
+                if device.type == "cuda":
+                    torch.cuda.synchronize(device)
+
+            step_s = _time_steps(step, warmup, repeats)
+            rows.append({"precision": precision, "channels_last": channels_last, "step_s": step_s, "voxels_per_s": voxels_per_step / step_s})
+
+    logger.info(f"{'precision':>9} | {'channels_last':>13} | {'step (ms)':>9} | {'Mvoxels/s':>9} | {'speedup':>7}")
+    for row in rows:
+        logger.info(
+            f"{row['precision']:>9} | {str(row['channels_last']):>13} | {row['step_s'] * 1000:>9.0f} | "
+            f"{row['voxels_per_s'] / 1e6:>9.2f} | x{row['voxels_per_s'] / rows[0]['voxels_per_s']:>6.2f}"
+        )
+    return rows
+
+
+def _saved_activation_bytes(step) -> int:
+    # Tenseurs gardés pour le backward hors segments checkpointés (stockages distincts comptés une fois)
+    storages = {}
+
+    def pack(tensor):
+        storage = tensor.untyped_storage()
+        storages[storage.data_ptr()] = storage.nbytes()
+        return tensor
+
+    with torch.autograd.graph.saved_tensors_hooks(pack, lambda tensor: tensor):
+        step()
+    return sum(storages.values())
+
+
+def benchmark_checkpointing(patch_sizes=((64, 64, 64), (96, 96, 96), (128, 128, 128)), batch_size: int = 2, segments: int = 2, warmup: int = 1, repeats: int = 3, device: torch.device = torch.device("cpu")) -> list[dict]:
+    """Tableau mémoire/débit d'un pas D+G, sans et avec checkpointing des activations.
+
+    Sur CPU, la mémoire est celle des activations gardées pour le backward ; sur GPU,
+    le pic alloué (torch.cuda.max_memory_allocated).
+    """
+    rows = []
+    for patch_size in patch_sizes:
+        input_tensor = torch.rand(batch_size, 1, *patch_size, device=device)
+        target_tensor = torch.rand(batch_size, 1, *patch_size, device=device)
+        for use_checkpointing in (False, True):
+            torch.manual_seed(0)
+            generator = Generator3D(in_channels=1, use_checkpointing=use_checkpointing, checkpoint_segments=segments).to(device)
+            discriminator = Discriminator3D(in_channels=2, use_checkpointing=use_checkpointing, checkpoint_segments=segments).to(device)
+            opt_G = torch.optim.Adam(generator.parameters(), lr=2e-4, betas=(0.5, 0.999))
+            opt_D = torch.optim.Adam(discriminator.parameters(), lr=2e-4, betas=(0.5, 0.999))
+
+            def step():
+                _train_step(generator, discriminator, opt_G, opt_D, input_tensor, target_tensor)
+
+            if device.type == "cuda":
+                torch.cuda.reset_peak_memory_stats(device)
+                step()
+                memory_bytes = torch.cuda.max_memory_allocated(device)
+            else:
+                memory_bytes = _saved_activation_bytes(step)
+            step_s = _time_steps(step, warmup, repeats)
+            rows.append({"patch_size": patch_size, "checkpointing": use_checkpointing, "memory_mb": memory_bytes / 2**20, "step_s": step_s})
+
+    logger.info(f"{'patch':>15} | {'checkpointing':>13} | {'memory (MB)':>11} | {'step (ms)':>9} | {'memory saved':>12} | {'recompute cost':>14}")
+    for baseline, checkpointed in zip(rows[::2], rows[1::2]):
+        for row in (baseline, checkpointed):
+            saved = 1 - row["memory_mb"] / baseline["memory_mb"]
+            cost = row["step_s"] / baseline["step_s"] - 1
+            logger.info(
+                f"{'x'.join(map(str, row['patch_size'])):>15} | {str(row['checkpointing']):>13} | {row['memory_mb']:>11.0f} | "
+                f"{row['step_s'] * 1000:>9.0f} | {saved:>12.1%} | {cost:>+14.1%}"
+            )
+    return rows
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Generator3D/Discriminator3D benchmarks: eager vs torch.compile, precision/memory format throughput, or activation checkpointing memory/throughput.")
+    parser.add_argument("--benchmark", choices=["compile", "precision", "checkpointing"], default="compile")
+    parser.add_argument("--patch_size", type=int, nargs=3, default=(128, 128, 128))
+    parser.add_argument("--batch_size", type=int, default=1)
+    parser.add_argument("--backend", default="inductor")
+    parser.add_argument("--mode", choices=COMPILE_MODES, default="default")
+    parser.add_argument("--segments", type=int, default=2)
+    parser.add_argument("--repeats", type=int, default=5)
+    args = parser.parse_args()
+
+    if args.benchmark == "compile":
+        benchmark_compile(tuple(args.patch_size), args.batch_size, args.backend, args.mode, repeats=args.repeats)
+    elif args.benchmark == "precision":
+        device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
+        benchmark_precision(tuple(args.patch_size), args.batch_size, repeats=args.repeats, device=device)
+    else:
+        device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
+        benchmark_checkpointing(batch_size=args.batch_size, segments=args.segments, repeats=args.repeats, device=device)
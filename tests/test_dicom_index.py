@@ -0,0 +1,62 @@
+import pytest
+
+pytest.importorskip("pydicom")
+pytest.importorskip("loguru")
+
+from utils.dicom_index import classify_series, open_index
+
+
+def _add_series(conn, patient, series_uid, study_uid, modality, series_date, acquisition_time, num_files=2):
+    for i in range(num_files):
+        conn.execute(
+            "INSERT INTO files (path, patient, mtime, size, series_instance_uid, study_instance_uid, modality, series_date, "
+            "acquisition_time, instance_number) VALUES (?, ?, 0, 0, ?, ?, ?, ?, ?, ?)",
+            (f"{patient}/{series_uid}/{i}.dcm", patient, series_uid, study_uid, modality, series_date, acquisition_time, i + 1),
+        )
+
+
+def _timepoints(conn):
+    return {row["series_instance_uid"]: row["timepoint"] for row in conn.execute("SELECT series_instance_uid, timepoint FROM series")}
+
+
+@pytest.fixture
+def conn():
+    conn = open_index(":memory:")
+    yield conn
+    conn.close()
+
+
+def test_ac_and_nac_series_share_their_session(conn):
+    # Visite 1 : CT puis TEP AC et NAC (heures d'acquisition différentes) ; visite 2 : autre étude
+    _add_series(conn, "P1", "ct1", "study1", "CT", "20240110", "090500")
+    _add_series(conn, "P1", "pet_ac1", "study1", "PT", "20240110", "091000")
+    _add_series(conn, "P1", "pet_nac1", "study1", "PT", "20240110", "091230")
+    _add_series(conn, "P1", "ct2", "study2", "CT", "20240410", "140000")
+    _add_series(conn, "P1", "pet_ac2", "study2", "PT", "20240410", "140600")
+    _add_series(conn, "P1", "pet_nac2", "study2", "PT", "20240410", "140745")
+    classify_series(conn)
+
+    assert _timepoints(conn) == {
+        "ct1": "baseline", "pet_ac1": "baseline", "pet_nac1": "baseline",
+        "ct2": "normal", "pet_ac2": "normal", "pet_nac2": "normal",
+    }
+
+
+def test_same_day_studies_are_separate_sessions(conn):
+    _add_series(conn, "P2", "pet_a", "study1", "PT", "20240110", "080000")
+    _add_series(conn, "P2", "pet_b", "study2", "PT", "20240110", "081500")
+    _add_series(conn, "P2", "ct_b", "study2", "CT", "20240110", "080100")
+    classify_series(conn)
+
+    # Le CT suit son étude, même s'il est plus proche dans le temps de la première session
+    assert _timepoints(conn) == {"pet_a": "baseline", "pet_b": "normal", "ct_b": "normal"}
+
+
+def test_series_without_study_uid_are_clustered_in_time(conn):
+    _add_series(conn, "P3", "pet_ac1", "", "PT", "20240110", "091000")
+    _add_series(conn, "P3", "pet_nac1", "", "PT", "20240110", "091500")
+    _add_series(conn, "P3", "pet_ac2", "", "PT", "20240110", "150000")
+    _add_series(conn, "P3", "ct2", "", "CT", "20240110", "145500")
+    classify_series(conn)
+
+    assert _timepoints(conn) == {"pet_ac1": "baseline", "pet_nac1": "baseline", "pet_ac2": "normal", "ct2": "normal"}
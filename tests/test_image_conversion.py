@@ -0,0 +1,54 @@
+import pytest
+
+np = pytest.importorskip("numpy")
+pytest.importorskip("nibabel")
+pytest.importorskip("SimpleITK")
+pytest.importorskip("ants")
+
+from utils.image_conversion import (
+    _ants_to_nib_via_file,
+    _nib_to_ants_via_file,
+    ants_to_nib,
+    benchmark_ants_conversion,
+    check_ants_conversion_parity,
+    nib_to_ants,
+    synthetic_nifti,
+)
+
+
+@pytest.fixture(scope="module")
+def oblique_image():
+    # Petit volume : axes obliques, voxels anisotropes, orientation LPS
+    return synthetic_nifti(shape=(24, 20, 16), spacing=(2.04, 1.5, 3.27))
+
+
+def test_nib_to_ants_matches_file_round_trip(oblique_image):
+    in_memory = nib_to_ants(oblique_image)
+    via_file = _nib_to_ants_via_file(oblique_image)
+
+    np.testing.assert_allclose(in_memory.numpy(), via_file.numpy(), atol=1e-5)
+    np.testing.assert_allclose(in_memory.spacing, via_file.spacing, atol=1e-4)
+    np.testing.assert_allclose(in_memory.origin, via_file.origin, atol=1e-4)
+    np.testing.assert_allclose(in_memory.direction, via_file.direction, atol=1e-4)
+
+
+def test_ants_to_nib_matches_file_round_trip(oblique_image):
+    ants_img = _nib_to_ants_via_file(oblique_image)
+    in_memory = ants_to_nib(ants_img)
+    via_file = _ants_to_nib_via_file(ants_img)
+
+    np.testing.assert_allclose(in_memory.get_fdata(), via_file.get_fdata(), atol=1e-5)
+    np.testing.assert_allclose(in_memory.affine, via_file.affine, atol=1e-4)
+
+
+def test_round_trip_preserves_affine(oblique_image):
+    back = ants_to_nib(nib_to_ants(oblique_image))
+
+    np.testing.assert_allclose(back.affine, oblique_image.affine, atol=1e-4)
+    np.testing.assert_array_equal(back.get_fdata(dtype=np.float32), oblique_image.get_fdata(dtype=np.float32))
+
+
+def test_parity_check_and_benchmark_run_without_patient_data(oblique_image):
+    assert check_ants_conversion_parity(oblique_image)
+    timings = benchmark_ants_conversion(oblique_image, repeats=1)
+    assert set(timings) == {"nib_to_ants", "nib_to_ants_via_file", "ants_to_nib", "ants_to_nib_via_file"}
@@ -0,0 +1,92 @@
+import math
+import torch
+import torch.nn.functional as F
+from typing import Tuple
+
+
+class BatchAugmenter:
+    """Augmentation des lots CT/PET directement sur le device d'entraînement.
+
+    Retournements, rotations de 90° et petite transformation affine sont composés en une
+    matrice par échantillon, appliquée en un seul affine_grid/grid_sample sur l'entrée et la
+    cible concaténées : les deux reçoivent exactement la même géométrie. Le facteur et le
+    décalage d'intensité sont eux aussi communs à l'entrée et à la cible d'un même échantillon.
+    Tous les tirages passent par un torch.Generator dédié, sauvegardé dans les checkpoints.
+    """
+
+    def __init__(self, device: torch.device, seed: int = 0, flip_prob: float = 0.5, rot90_prob: float = 0.5,
+                 max_rotation_deg: float = 10.0, max_scale: float = 0.1, max_translation: float = 0.05,
+                 intensity_scale: float = 0.1, intensity_shift: float = 0.05):
+        self.device = device
+        self.flip_prob = flip_prob
+        self.rot90_prob = rot90_prob
+        self.max_rotation = math.radians(max_rotation_deg)
+        self.max_scale = max_scale
+        self.max_translation = max_translation
+        self.intensity_scale = intensity_scale
+        self.intensity_shift = intensity_shift
+
+        self.generator = torch.Generator(device=device)
+        self.generator.manual_seed(seed)
+
+    def _uniform(self, shape, low: float, high: float) -> torch.Tensor:
+        return torch.rand(shape, generator=self.generator, device=self.device) * (high - low) + low
+
+    def _rotation(self, angles: torch.Tensor, axis_a: int, axis_b: int) -> torch.Tensor:
+        # Rotation (B, 3, 3) dans le plan (axis_a, axis_b) des coordonnées normalisées
+        rotation = torch.eye(3, device=self.device).repeat(angles.shape[0], 1, 1)
+        cos, sin = torch.cos(angles), torch.sin(angles)
+        rotation[:, axis_a, axis_a] = cos
+        rotation[:, axis_a, axis_b] = -sin
+        rotation[:, axis_b, axis_a] = sin
+        rotation[:, axis_b, axis_b] = cos
+        return rotation
+
+    def sample_theta(self, batch_size: int, spatial_shape: Tuple[int, int, int]) -> torch.Tensor:
+        # Matrices (B, 3, 4) pour affine_grid ; ses coordonnées sont en ordre (x, y, z) = (W, H, D)
+        sizes = tuple(reversed(spatial_shape))
+
+        flips = torch.where(self._uniform((batch_size, 3), 0, 1) < self.flip_prob, -1.0, 1.0)
+        matrix = torch.diag_embed(flips)
+
+        # Rotation de 90° dans un plan dont les deux côtés ont la même taille (sinon le patch serait étiré)
+        planes = [(a, b) for a, b in ((0, 1), (0, 2), (1, 2)) if sizes[a] == sizes[b]]
+        if planes and self.rot90_prob > 0:
+            # Plan et nombre de quarts de tour tirés par échantillon ; angle nul dans les autres plans
+            chosen_plane = torch.randint(len(planes), (batch_size,), generator=self.generator, device=self.device)
+            quarter_turns = torch.randint(1, 4, (batch_size,), generator=self.generator, device=self.device)
+            apply = self._uniform(batch_size, 0, 1) < self.rot90_prob
+            for i, plane in enumerate(planes):
+                angles = torch.where(apply & (chosen_plane == i), quarter_turns * (math.pi / 2), 0.0)
+                matrix = self._rotation(angles, *plane) @ matrix
+
+        if self.max_rotation > 0:
+            for plane in ((0, 1), (0, 2), (1, 2)):
+                matrix = self._rotation(self._uniform(batch_size, -self.max_rotation, self.max_rotation), *plane) @ matrix
+        if self.max_scale > 0:
+            matrix = torch.diag_embed(self._uniform((batch_size, 3), 1 - self.max_scale, 1 + self.max_scale)) @ matrix
+
+        translation = self._uniform((batch_size, 3, 1), -self.max_translation, self.max_translation)
+        return torch.cat([matrix, translation], dim=2)
+
+    def __call__(self, input_tensor: torch.Tensor, target_tensor: torch.Tensor) -> Tuple[torch.Tensor, torch.Tensor]:
+        batch_size, input_channels = input_tensor.shape[:2]
+        volumes = torch.cat([input_tensor, target_tensor.to(input_tensor.dtype)], dim=1)
+
+        theta = self.sample_theta(batch_size, volumes.shape[2:]).to(volumes.dtype)
+        # align_corners=True : retournements et rotations de 90° tombent exactement sur les voxels
+        grid = F.affine_grid(theta, list(volumes.shape), align_corners=True)
+        volumes = F.grid_sample(volumes, grid, mode="bilinear", padding_mode="border", align_corners=True)
+
+        scale = self._uniform((batch_size, 1, 1, 1, 1), 1 - self.intensity_scale, 1 + self.intensity_scale)
+        shift = self._uniform((batch_size, 1, 1, 1, 1), -self.intensity_shift, self.intensity_shift)
+        volumes = volumes * scale.to(volumes.dtype) + shift.to(volumes.dtype)
+
+        return volumes[:, :input_channels], volumes[:, input_channels:]
+
+    def state_dict(self) -> dict:
+        return {"generator": self.generator.get_state()}
+
+    def load_state_dict(self, state: dict):
+        # L'état d'un torch.Generator, même CUDA, est un ByteTensor CPU
+        self.generator.set_state(state["generator"].cpu())
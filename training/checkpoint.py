@@ -0,0 +1,126 @@
+import os
+import random
+import queue
+import shutil
+import threading
+import numpy as np
+import torch
+from pathlib import Path
+from loguru import logger
+
+
+LATEST_CHECKPOINT = "latest.pt"
+
+
+def capture_rng_state() -> dict:
+    state = {
+        "python": random.getstate(),
+        "numpy": np.random.get_state(),
+        "torch": torch.get_rng_state(),
+    }
+    if torch.cuda.is_available():
+        state["cuda"] = torch.cuda.get_rng_state_all()
+    return state
+
+
+def restore_rng_state(state: dict):
+    random.setstate(state["python"])
+    np.random.set_state(state["numpy"])
+    # set_rng_state n'accepte que des ByteTensor CPU, quel que soit le map_location du checkpoint
+    torch.set_rng_state(state["torch"].cpu())
+    if "cuda" in state and torch.cuda.is_available():
+        torch.cuda.set_rng_state_all([s.cpu() for s in state["cuda"]])
+
+
+def snapshot(obj):
+    # Copie CPU figée : l'entraînement peut continuer à modifier les poids pendant l'écriture
+    if isinstance(obj, torch.Tensor):
+        return obj.detach().to("cpu", copy=True)
+    if isinstance(obj, dict):
+        return {key: snapshot(value) for key, value in obj.items()}
+    if isinstance(obj, (list, tuple)):
+        return type(obj)(snapshot(value) for value in obj)
+    return obj
+
+
+def save_checkpoint(state: dict, path: Path):
+    path = Path(path)
+    path.parent.mkdir(parents=True, exist_ok=True)
+
+    # Écriture atomique : un checkpoint interrompu ne remplace jamais le précédent
+    tmp_path = path.with_name(path.name + ".tmp")
+    with open(tmp_path, "wb") as f:
+        torch.save(state, f)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_path, path)
+
+
+def load_checkpoint(path: Path, map_location="cpu") -> dict:
+    path = Path(path)
+    if path.is_dir():
+        path = path / LATEST_CHECKPOINT
+    if not path.exists():
+        logger.error(f"Checkpoint not found: {path}")
+        raise FileNotFoundError(f"Checkpoint not found: {path}")
+
+    logger.info(f"Loading checkpoint: {path}")
+    return torch.load(path, map_location=map_location, weights_only=False)
+
+
+class AsyncCheckpointWriter:
+    """Écrit les checkpoints sur un thread en arrière-plan.
+
+    Seule la copie CPU de l'état (snapshot) est faite sur le thread d'entraînement ;
+    la sérialisation et l'écriture disque se font pendant les pas suivants.
+    """
+
+    def __init__(self, checkpoint_dir: Path, keep_last: int = 3):
+        self.checkpoint_dir = Path(checkpoint_dir)
+        self.keep_last = keep_last
+        self._queue = queue.Queue(maxsize=1)
+        self._thread = threading.Thread(target=self._run, name="checkpoint-writer", daemon=True)
+        self._thread.start()
+
+    def submit(self, state: dict, filename: str):
+        # Bloque si l'écriture précédente n'est pas terminée : au plus un checkpoint en attente
+        self._queue.put((snapshot(state), filename))
+
+    def _run(self):
+        while True:
+            item = self._queue.get()
+            if item is None:
+                self._queue.task_done()
+                return
+            state, filename = item
+            try:
+                path = self.checkpoint_dir / filename
+                save_checkpoint(state, path)
+                self._update_latest(path)
+                logger.info(f"Checkpoint saved to {path}")
+                self._prune()
+            except Exception as e:
+                logger.exception(f"Failed to write checkpoint {filename}: {e}")
+            finally:
+                self._queue.task_done()
+
+    def _update_latest(self, path: Path):
+        latest_path = self.checkpoint_dir / LATEST_CHECKPOINT
+        tmp_path = latest_path.with_name(latest_path.name + ".tmp")
+        tmp_path.unlink(missing_ok=True)
+        try:
+            os.link(path, tmp_path)
+        except OSError:
+            shutil.copyfile(path, tmp_path)
+        os.replace(tmp_path, latest_path)
+
+    def _prune(self):
+        if not self.keep_last:
+            return
+        checkpoints = sorted(self.checkpoint_dir.glob("checkpoint_epoch_*.pt"))
+        for old_checkpoint in checkpoints[:-self.keep_last]:
+            old_checkpoint.unlink(missing_ok=True)
+
+    def close(self):
+        self._queue.put(None)
+        self._thread.join()
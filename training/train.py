@@ -1,81 +1,368 @@
 from pathlib import Path
+import os
+import sys
+import time
+import datetime
+import contextlib
+import random
+import argparse
 import torch
 import torch.optim as optim
-from torch.nn import BCELoss, L1Loss
-from torch.utils.data import DataLoader
+import torch.distributed as dist
+from torch.nn import BCELoss, L1Loss, SyncBatchNorm
+from torch.nn.parallel import DistributedDataParallel
+from torch.utils.data import DataLoader, DistributedSampler
 from loguru import logger
 import numpy as np
 import nibabel as nib
 
-from datasets.pet_gan_dataset import CtPetGanPatchDataset
+from datasets.pet_gan_dataset import CtPetGanPatchDataset, CtPetGanPatchQueue, seed_worker
 from models.discriminator import Discriminator3D
 from models.generator import Generator3D
+from models.optimization import AUTOCAST_DTYPES, COMPILE_MODES, compile_model
+from utils.profiling import DATA_WAIT_STAGE, enable_profiling, profile_stage
+from training.augmentation import BatchAugmenter
+from evaluation.evaluate import evaluate_cohort, held_out_patients
+from utils.physiological_masking import SEGMENTATION_SUBDIR
+from training.checkpoint import AsyncCheckpointWriter, capture_rng_state, restore_rng_state, load_checkpoint
 
-data_root = Path("data/processed")
-patch_size = (128, 128, 128)
-batch_size = 2
-num_epochs = 100
-lr = 2e-4
-save_interval = 10
+parser = argparse.ArgumentParser(description="Train the 3D PET GAN.")
+parser.add_argument("--data_root", type=Path, default=Path("data/processed"))
+parser.add_argument("--patch_size", type=int, nargs=3, default=(128, 128, 128))
+parser.add_argument("--batch_size", type=int, default=2, help="Micro-batch size per process and forward pass.")
+parser.add_argument("--accumulation_steps", type=int, default=1, help="Micro-batches accumulated per optimizer step (D and G).")
+parser.add_argument("--effective_batch_size", type=int, default=None, help="Samples per optimizer step across all processes; overrides --accumulation_steps.")
+parser.add_argument("--activation_checkpointing", action="store_true", help="Recompute Conv3d activations in the backward pass instead of storing them.")
+parser.add_argument("--checkpoint_segments", type=int, default=2, help="Checkpointed segments per nn.Sequential stack.")
+parser.add_argument("--num_epochs", type=int, default=100)
+parser.add_argument("--lr", type=float, default=2e-4)
+parser.add_argument("--save_interval", type=int, default=10)
+parser.add_argument("--storage", choices=["nifti", "npy", "zarr"], default="nifti", help="'npy' after utils/volume_cache.py::materialize_all_patients, 'zarr' after utils/chunked_store.py::convert_all_patients.")
+parser.add_argument("--sampling_mode", choices=["random", "weighted"], default="random", help="'weighted' draws centres from the precomputed index, see utils/sampling_index.py.")
+parser.add_argument("--use_patch_queue", action="store_true")
+parser.add_argument("--samples_per_volume", type=int, default=16)
+parser.add_argument("--max_resident_volumes", type=int, default=4)
+parser.add_argument("--samples_per_epoch", type=int, default=None, help="Default: len(patients) * samples_per_volume")
+parser.add_argument("--augment", action="store_true", help="Batched on-device augmentation: flips, 90° rotations, small affine, intensity.")
+parser.add_argument("--precision", choices=list(AUTOCAST_DTYPES), default="fp32", help="bf16 for CPU nodes, fp16 (with GradScaler) for GPU nodes.")
+parser.add_argument("--channels_last", action="store_true", help="Use the channels_last_3d memory format for the Conv3d stacks.")
+parser.add_argument("--compile", action="store_true", help="torch.compile the generator and discriminator for training.")
+parser.add_argument("--compile_backend", default="inductor")
+parser.add_argument("--compile_mode", choices=COMPILE_MODES, default="default")
+parser.add_argument("--num_workers", type=int, default=0)
+parser.add_argument("--pin_memory", action=argparse.BooleanOptionalAction, default=None, help="Default: enabled on CUDA.")
+parser.add_argument("--prefetch_factor", type=int, default=2, help="Batches prefetched per worker (num_workers > 0).")
+parser.add_argument("--persistent_workers", action="store_true", help="Keep workers alive between epochs (num_workers > 0).")
+parser.add_argument("--profile", action="store_true", help="Per-stage latency report (data wait, H2D copy, D/G steps, dataset).")
+parser.add_argument("--profile_output", type=Path, default=Path("outputs/profiling/stages"), help="Report path, written as .json and .csv.")
+parser.add_argument("--torch_profile_steps", type=int, nargs=2, metavar=("SKIP", "ACTIVE"), default=None, help="Record a torch.profiler trace of ACTIVE steps after SKIP steps.")
+parser.add_argument("--torch_profile_dir", type=Path, default=Path("outputs/profiling/trace"))
+parser.add_argument("--seed", type=int, default=None)
+parser.add_argument("--deterministic", action="store_true", help="Deterministic kernels, needed for bit-for-bit resume on GPU.")
+parser.add_argument("--checkpoint_dir", type=Path, default=Path("checkpoints"))
+parser.add_argument("--checkpoint_interval", type=int, default=1, help="Checkpoint every N epochs.")
+parser.add_argument("--keep_checkpoints", type=int, default=3)
+parser.add_argument("--eval_interval", type=int, default=None, help="Evaluate on held-out patients every N epochs (excluded from training).")
+parser.add_argument("--eval_patients", type=Path, default=None, help="File listing held-out patient names; default: last --eval_fraction of the cohort.")
+parser.add_argument("--eval_fraction", type=float, default=0.1)
+parser.add_argument("--eval_mask_subdir", default=SEGMENTATION_SUBDIR, help="Organ masks directory inside each held-out patient directory.")
+parser.add_argument("--dist_backend", choices=["nccl", "gloo"], default=None, help="DDP backend under torchrun. Default: nccl on CUDA, gloo otherwise.")
+parser.add_argument("--dist_timeout", type=float, default=60, help="Collective timeout in minutes; must exceed the rank-0 evaluation time with --eval_interval.")
+parser.add_argument("--scaling_baseline", type=float, default=None, help="Single-device throughput (Mvoxels/s) used to report DDP scaling efficiency.")
+parser.add_argument("--resume", type=Path, nargs="?", const=Path("checkpoints"), default=None, help="Checkpoint file or directory (latest.pt) to resume from.")
+args = parser.parse_args()
 
-device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
+data_root = args.data_root
+patch_size = tuple(args.patch_size)
+batch_size = args.batch_size
+num_epochs = args.num_epochs
+lr = args.lr
+save_interval = args.save_interval
+storage = args.storage
+sampling_mode = args.sampling_mode
+use_patch_queue = args.use_patch_queue
+samples_per_volume = args.samples_per_volume
+max_resident_volumes = args.max_resident_volumes
+samples_per_epoch = args.samples_per_epoch
+precision = args.precision
+memory_format = torch.channels_last_3d if args.channels_last else torch.contiguous_format
+
+# Mode DDP si lancé par torchrun (WORLD_SIZE > 1) : un processus par device
+world_size = int(os.environ.get("WORLD_SIZE", 1))
+distributed = world_size > 1
+rank = int(os.environ.get("RANK", 0))
+local_rank = int(os.environ.get("LOCAL_RANK", 0))
+is_main = rank == 0
+if not is_main:
+    # Journal du rang 0 seulement ; les autres rangs ne remontent que les avertissements
+    logger.remove()
+    logger.add(sys.stderr, level="WARNING", format=f"[rank {rank}] {{time:HH:mm:ss}} | {{level}} | {{message}}")
+
+if args.seed is not None:
+    # Graine décalée par rang : tirages de patchs différents ; les poids initiaux viennent du rang 0 (DDP)
+    random.seed(args.seed + rank)
+    np.random.seed(args.seed + rank)
+    torch.manual_seed(args.seed + rank)
+if args.deterministic:
+    os.environ.setdefault("CUBLAS_WORKSPACE_CONFIG", ":4096:8")
+    torch.backends.cudnn.benchmark = False
+    torch.use_deterministic_algorithms(True, warn_only=True)
+
+# Taille de lot effective = micro-lot x accumulation x processus, indépendante de la taille des patchs
+accumulation_steps = args.accumulation_steps
+if args.effective_batch_size is not None:
+    if args.effective_batch_size % (batch_size * world_size):
+        parser.error(f"--effective_batch_size must be a multiple of batch_size x processes ({batch_size * world_size}).")
+    accumulation_steps = args.effective_batch_size // (batch_size * world_size)
+effective_batch_size = batch_size * accumulation_steps * world_size
+
+if torch.cuda.is_available():
+    device = torch.device("cuda", local_rank)
+    torch.cuda.set_device(device)
+else:
+    device = torch.device("cpu")
+if distributed:
+    dist_backend = args.dist_backend or ("nccl" if device.type == "cuda" else "gloo")
+    dist.init_process_group(backend=dist_backend, timeout=datetime.timedelta(minutes=args.dist_timeout))
+    logger.info(f"DDP: {world_size} processes, backend {dist_backend}.")
 if device.type == "cuda":
-    logger.info(f"Using GPU: {torch.cuda.get_device_name(0)}")
+    logger.info(f"Using GPU: {torch.cuda.get_device_name(device)}")
 else:
     logger.warning("CUDA not available — using CPU")
+    if precision == "fp16":
+        logger.warning("fp16 autocast on CPU is slow on most hardware; prefer --precision bf16.")
 
 logger.info("Loading dataset...")
-dataset = CtPetGanPatchDataset(data_root, patch_size=patch_size)
-dataloader = DataLoader(dataset, batch_size=batch_size, shuffle=True)
+dataset = CtPetGanPatchDataset(data_root, patch_size=patch_size, mode=sampling_mode, storage=storage)
+eval_patients = []
+if args.eval_interval:
+    eval_patients = held_out_patients(data_root, args.eval_patients, args.eval_fraction)
+    dataset.patients = [p for p in dataset.patients if p not in eval_patients]
+    logger.info(f"{len(eval_patients)} patients held out for evaluation every {args.eval_interval} epochs.")
 logger.info(f"Loaded {len(dataset)} patients.")
+pin_memory = device.type == "cuda" if args.pin_memory is None else args.pin_memory
+loader_kwargs = {
+    "batch_size": batch_size,
+    "num_workers": args.num_workers,
+    "pin_memory": pin_memory,
+    "worker_init_fn": seed_worker,
+    # Lot final incomplet écarté en mode compilé : une autre taille de lot forcerait une recompilation
+    "drop_last": args.compile,
+}
+if args.num_workers > 0:
+    loader_kwargs["prefetch_factor"] = args.prefetch_factor
+    loader_kwargs["persistent_workers"] = args.persistent_workers
+
+sampler = None
+if use_patch_queue:
+    patch_queue = CtPetGanPatchQueue(dataset, samples_per_volume=samples_per_volume, max_volumes=max_resident_volumes, samples_per_epoch=samples_per_epoch)
+    dataloader = DataLoader(patch_queue, **loader_kwargs)
+    logger.info(f"Patch queue: {samples_per_volume} patches per volume, {max_resident_volumes} resident volumes, {len(patch_queue)} patches per epoch.")
+else:
+    if distributed:
+        sampler = DistributedSampler(dataset, num_replicas=world_size, rank=rank, shuffle=True, seed=args.seed or 0)
+    dataloader = DataLoader(dataset, shuffle=sampler is None, sampler=sampler, **loader_kwargs)
+logger.info(f"DataLoader: {args.num_workers} workers, pin_memory={pin_memory}, prefetch_factor={loader_kwargs.get('prefetch_factor')}, persistent_workers={loader_kwargs.get('persistent_workers', False)}")
 
 in_channels_G = 1
 in_channels_D = in_channels_G + 1
 
-generator = Generator3D(in_channels=in_channels_G).to(device)
-discriminator = Discriminator3D(in_channels=in_channels_D).to(device)
+checkpointing_kwargs = {"use_checkpointing": args.activation_checkpointing, "checkpoint_segments": args.checkpoint_segments}
+generator = Generator3D(in_channels=in_channels_G, **checkpointing_kwargs).to(device, memory_format=memory_format)
+discriminator = Discriminator3D(in_channels=in_channels_D, **checkpointing_kwargs).to(device, memory_format=memory_format)
+
+# Modules DDP/compilés pour les pas d'entraînement ; les state_dict et les aperçus passent par les modules d'origine
+generator_step, discriminator_step = generator, discriminator
+if distributed:
+    if device.type == "cuda":
+        generator = SyncBatchNorm.convert_sync_batchnorm(generator)
+        discriminator = SyncBatchNorm.convert_sync_batchnorm(discriminator)
+    else:
+        logger.warning("SyncBatchNorm needs CUDA; BatchNorm statistics stay per process on CPU.")
+    # broadcast_buffers=False : les statistiques BatchNorm sont synchronisées (SyncBatchNorm) ou restent locales
+    device_ids = [local_rank] if device.type == "cuda" else None
+    generator_step = DistributedDataParallel(generator, device_ids=device_ids, broadcast_buffers=False)
+    discriminator_step = DistributedDataParallel(discriminator, device_ids=device_ids, broadcast_buffers=False)
+if args.compile:
+    generator_step = compile_model(generator_step, args.compile_backend, args.compile_mode)
+    discriminator_step = compile_model(discriminator_step, args.compile_backend, args.compile_mode)
 
 opt_G = optim.Adam(generator.parameters(), lr=lr, betas=(0.5, 0.999))
 opt_D = optim.Adam(discriminator.parameters(), lr=lr, betas=(0.5, 0.999))
 
+# Un GradScaler par optimiseur : les pas D et G ont chacun leur backward et leur échelle
+autocast_dtype = AUTOCAST_DTYPES[precision]
+scaler_D = torch.amp.GradScaler(device.type, enabled=precision == "fp16")
+scaler_G = torch.amp.GradScaler(device.type, enabled=precision == "fp16")
+
+
+def autocast():
+    return torch.autocast(device_type=device.type, dtype=autocast_dtype, enabled=autocast_dtype is not None)
+
+
+def grad_sync(module, sync: bool):
+    # Sans synchronisation (no_sync), les gradients s'accumulent localement ; l'all-reduce n'a lieu qu'au dernier micro-lot
+    ddp_module = getattr(module, "_orig_mod", module)
+    if sync or not isinstance(ddp_module, DistributedDataParallel):
+        return contextlib.nullcontext()
+    return ddp_module.no_sync()
+
+
+# Graine de l'augmentation décalée par rang, comme les autres générateurs aléatoires
+augmenter = BatchAugmenter(device, seed=(args.seed or 0) + rank) if args.augment else None
+
 bce_loss = BCELoss()
 l1_loss = L1Loss()
 
-logger.info("Starting training loop...")
-for epoch in range(num_epochs):
-    for i, (input_tensor, target_tensor) in enumerate(dataloader):
-        input_tensor = input_tensor.to(device)
-        target_tensor = target_tensor.to(device)
+start_epoch = 0
+global_step = 0
+if args.resume is not None:
+    # Chargé sur CPU : les états aléatoires doivent rester des ByteTensor CPU, load_state_dict copie les poids sur le device
+    checkpoint = load_checkpoint(args.resume, map_location="cpu")
+    generator.load_state_dict(checkpoint["generator"])
+    discriminator.load_state_dict(checkpoint["discriminator"])
+    opt_G.load_state_dict(checkpoint["opt_G"])
+    opt_D.load_state_dict(checkpoint["opt_D"])
+    scaler_G.load_state_dict(checkpoint["scaler_G"])
+    scaler_D.load_state_dict(checkpoint["scaler_D"])
+    start_epoch = checkpoint["epoch"]
+    global_step = checkpoint["step"]
+    # Restauré en dernier : la construction des modèles ci-dessus consomme aussi les générateurs aléatoires
+    rng_per_rank = checkpoint.get("rng_per_rank")
+    rng_state = rng_per_rank[rank] if rng_per_rank and len(rng_per_rank) == world_size else checkpoint["rng"]
+    restore_rng_state(rng_state)
+    if augmenter is not None and "augmentation" in rng_state:
+        augmenter.load_state_dict(rng_state["augmentation"])
+    logger.info(f"Resumed from epoch {start_epoch} (step {global_step}).")
+    del checkpoint
 
-        with torch.no_grad():
-            fake = generator(input_tensor)
+checkpoint_writer = AsyncCheckpointWriter(args.checkpoint_dir, keep_last=args.keep_checkpoints) if is_main else None
+
+profiler = None
+if args.profile:
+    profiler = enable_profiling(sync=torch.cuda.synchronize if device.type == "cuda" else None)
+    if args.num_workers > 0:
+        logger.warning("Dataset stages run in DataLoader workers, where profiling is disabled; they are only timed with --num_workers 0. data_wait is still measured.")
+
+torch_profiler = None
+if args.torch_profile_steps is not None:
+    skip_steps, active_steps = args.torch_profile_steps
+    activities = [torch.profiler.ProfilerActivity.CPU]
+    if device.type == "cuda":
+        activities.append(torch.profiler.ProfilerActivity.CUDA)
+    torch_profiler = torch.profiler.profile(
+        activities=activities,
+        schedule=torch.profiler.schedule(wait=max(skip_steps - 1, 0), warmup=1, active=active_steps, repeat=1),
+        on_trace_ready=torch.profiler.tensorboard_trace_handler(str(args.torch_profile_dir)),
+        record_shapes=True,
+        profile_memory=True,
+    )
+    torch_profiler.start()
+
+logger.info(f"Starting training loop (precision: {precision}, memory format: {'channels_last_3d' if args.channels_last else 'contiguous'}, compiled: {args.compile}, activation checkpointing: {args.activation_checkpointing})...")
+logger.info(f"Effective batch size: {effective_batch_size} ({batch_size} per micro-batch x {accumulation_steps} accumulation steps x {world_size} processes), patch size {patch_size}.")
+for epoch in range(start_epoch, num_epochs):
+    epoch_start = time.perf_counter()
+    epoch_voxels = 0
+    if profiler is not None:
+        # Rapport par époque : les mesures ne s'accumulent pas d'une époque à l'autre
+        profiler.reset()
+    if sampler is not None:
+        sampler.set_epoch(epoch)
+
+    data_iter = iter(dataloader)
+    while True:
+        micro_batches = []
+        for _ in range(accumulation_steps):
+            with profile_stage(DATA_WAIT_STAGE):
+                batch = next(data_iter, None)
+            if batch is None:
+                break
+            with profile_stage("train.h2d_copy"):
+                input_tensor, target_tensor = (t.to(device, non_blocking=pin_memory) for t in batch)
+            if augmenter is not None:
+                with profile_stage("train.augment"):
+                    input_tensor, target_tensor = augmenter(input_tensor, target_tensor)
+            micro_batches.append((input_tensor.contiguous(memory_format=memory_format), target_tensor.contiguous(memory_format=memory_format)))
+        if not micro_batches:
+            break
+        num_micro_batches = len(micro_batches)
+        step_samples = sum(input_tensor.shape[0] for input_tensor, _ in micro_batches)
+        epoch_voxels += sum(input_tensor.numel() for input_tensor, _ in micro_batches)
+
+        # Phase D : gradients accumulés sur tous les micro-lots, puis un seul pas d'optimiseur
+        with profile_stage("train.d_step"):
+            opt_D.zero_grad()
+            for i, (input_tensor, target_tensor) in enumerate(micro_batches):
+                with grad_sync(discriminator_step, i == num_micro_batches - 1):
+                    # Les BCELoss sont calculées hors autocast, en float32 (binary_cross_entropy n'est pas sûr en fp16)
+                    with torch.no_grad(), autocast():
+                        fake = generator_step(input_tensor)
 
-        real_pred = discriminator(input_tensor, target_tensor)
-        fake_pred = discriminator(input_tensor, fake)
+                    with autocast():
+                        real_pred = discriminator_step(input_tensor, target_tensor)
+                        fake_pred = discriminator_step(input_tensor, fake)
 
-        loss_D = (
-            bce_loss(real_pred, torch.ones_like(real_pred)) +
-            bce_loss(fake_pred, torch.zeros_like(fake_pred))
-        ) * 0.5
+                    loss_D = (
+                        bce_loss(real_pred.float(), torch.ones_like(real_pred, dtype=torch.float32)) +
+                        bce_loss(fake_pred.float(), torch.zeros_like(fake_pred, dtype=torch.float32))
+                    ) * 0.5
+                    scaler_D.scale(loss_D / num_micro_batches).backward()
 
-        opt_D.zero_grad()
-        loss_D.backward()
-        opt_D.step()
+            scaler_D.step(opt_D)
+            scaler_D.update()
 
-        fake = generator(input_tensor)
-        fake_pred = discriminator(input_tensor, fake)
+        # Phase G : D figé (pas de gradients de poids pour D), même accumulation
+        with profile_stage("train.g_step"):
+            discriminator.requires_grad_(False)
+            opt_G.zero_grad()
+            for i, (input_tensor, target_tensor) in enumerate(micro_batches):
+                with grad_sync(generator_step, i == num_micro_batches - 1):
+                    with autocast():
+                        fake = generator_step(input_tensor)
+                        with grad_sync(discriminator_step, False):
+                            fake_pred = discriminator_step(input_tensor, fake)
 
-        loss_G_adv = bce_loss(fake_pred, torch.ones_like(fake_pred))
-        loss_G_l1 = l1_loss(fake, target_tensor)
-        loss_G = loss_G_adv + 100 * loss_G_l1
+                    loss_G_adv = bce_loss(fake_pred.float(), torch.ones_like(fake_pred, dtype=torch.float32))
+                    loss_G_l1 = l1_loss(fake.float(), target_tensor)
+                    loss_G = loss_G_adv + 100 * loss_G_l1
+                    scaler_G.scale(loss_G / num_micro_batches).backward()
+            discriminator.requires_grad_(True)
 
-        opt_G.zero_grad()
-        loss_G.backward()
-        opt_G.step()
+            scaler_G.step(opt_G)
+            scaler_G.update()
+        global_step += 1
 
-    logger.info(f"[Epoch {epoch+1}/{num_epochs}] Loss_D: {loss_D.item():.4f} | Loss_G: {loss_G.item():.4f}")
+        if profiler is not None:
+            profiler.count_samples(step_samples)
+        if torch_profiler is not None:
+            torch_profiler.step()
 
-    if (epoch + 1) % save_interval == 0:
+    if device.type == "cuda":
+        torch.cuda.synchronize()
+    epoch_time = time.perf_counter() - epoch_start
+
+    losses = torch.stack([loss_D.detach().float(), loss_G.detach().float()])
+    if distributed:
+        # Pertes moyennées sur les rangs ; débit global = voxels de tous les rangs / temps du rang le plus lent
+        dist.all_reduce(losses)
+        losses /= world_size
+        totals = torch.tensor([epoch_voxels, epoch_time], dtype=torch.float64, device=device)
+        dist.all_reduce(totals[0:1])
+        dist.all_reduce(totals[1:2], op=dist.ReduceOp.MAX)
+        epoch_voxels, epoch_time = totals.tolist()
+    throughput = epoch_voxels / epoch_time / 1e6
+
+    logger.info(f"[Epoch {epoch+1}/{num_epochs}] Loss_D: {losses[0].item():.4f} | Loss_G: {losses[1].item():.4f}")
+    logger.info(f"[Epoch {epoch+1}/{num_epochs}] Throughput ({precision}): {throughput:.2f} Mvoxels/s over {epoch_time:.1f}s ({throughput / world_size:.2f} per process)")
+    if distributed and args.scaling_baseline:
+        logger.info(f"[Epoch {epoch+1}/{num_epochs}] Scaling efficiency: {throughput / (world_size * args.scaling_baseline):.1%} of {world_size} x {args.scaling_baseline:.2f} Mvoxels/s")
+    if profiler is not None:
+        # Un rapport par époque et par rang : les étapes de chargement et les attentes diffèrent d'un processus à l'autre
+        report_name = f"{args.profile_output.name}_epoch{epoch+1:03d}" + (f"_rank{rank}" if distributed else "")
+        profiler.report(args.profile_output.with_name(report_name), label=f"epoch {epoch+1}")
+
+    if is_main and (epoch + 1) % save_interval == 0:
         generator.eval()
         with torch.no_grad():
             sample_input = input_tensor[0:1]
@@ -86,7 +373,7 @@ for epoch in range(num_epochs):
         output_dir.mkdir(parents=True, exist_ok=True)
 
         def save_nifti(tensor, filename):
-            array = tensor.squeeze().cpu().numpy()
+            array = tensor.squeeze().float().cpu().numpy()
             nib.save(nib.Nifti1Image(array, affine=np.eye(4)), filename)
 
         save_nifti(sample_input, output_dir / "input_pet.nii.gz")
@@ -95,3 +382,45 @@ for epoch in range(num_epochs):
 
         logger.info(f"Saved visual outputs to {output_dir}")
         generator.train()
+
+    if is_main and eval_patients and (epoch + 1) % args.eval_interval == 0:
+        # Chevauchement réduit et lots de tuiles plus grands : l'évaluation reste courte devant une époque
+        evaluate_cohort(generator, eval_patients, Path("outputs") / "evaluation" / f"epoch_{epoch+1:03d}", patch_size=patch_size, overlap=0.25, tile_batch_size=max(4, batch_size), device=device, mask_subdir=args.eval_mask_subdir)
+        generator.train()
+    if distributed and eval_patients and (epoch + 1) % args.eval_interval == 0:
+        # Les autres rangs attendent ici la fin de l'évaluation du rang 0 (borné par --dist_timeout)
+        dist.barrier()
+
+    if (epoch + 1) % args.checkpoint_interval == 0 or epoch + 1 == num_epochs:
+        # Capturé après les sauvegardes ci-dessus : la reprise repart exactement de cet état
+        rng_state = capture_rng_state()
+        if augmenter is not None:
+            # Générateur de l'augmentation rangé avec les autres états aléatoires, un par rang
+            rng_state["augmentation"] = augmenter.state_dict()
+        rng_per_rank = None
+        if distributed:
+            # Collectif : tous les rangs envoient leur état, seul le rang 0 écrit
+            rng_per_rank = [None] * world_size
+            dist.all_gather_object(rng_per_rank, rng_state)
+        if is_main:
+            checkpoint_writer.submit({
+                "epoch": epoch + 1,
+                "step": global_step,
+                "generator": generator.state_dict(),
+                "discriminator": discriminator.state_dict(),
+                "opt_G": opt_G.state_dict(),
+                "opt_D": opt_D.state_dict(),
+                "scaler_G": scaler_G.state_dict(),
+                "scaler_D": scaler_D.state_dict(),
+                "rng": rng_state,
+                "rng_per_rank": rng_per_rank,
+                "args": vars(args),
+            }, f"checkpoint_epoch_{epoch+1:03d}.pt")
+
+if checkpoint_writer is not None:
+    checkpoint_writer.close()
+if torch_profiler is not None:
+    torch_profiler.stop()
+if distributed:
+    dist.barrier()
+    dist.destroy_process_group()
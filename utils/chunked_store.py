@@ -0,0 +1,196 @@
+import os
+import time
+import base64
+import random
+import shutil
+import tempfile
+import argparse
+import numpy as np
+import nibabel as nib
+from pathlib import Path
+from loguru import logger
+from tqdm import tqdm
+
+
+# Stockage optionnel : zarr (API v2) et numcodecs ne sont importés qu'à l'utilisation
+CHUNKED_SUFFIX = ".zarr"
+DEFAULT_CHUNKS = (64, 64, 64)
+CODECS = ("lz4", "zstd")
+
+
+def _import_zarr():
+    try:
+        import zarr
+        from numcodecs import Blosc
+    except ImportError as e:
+        raise ImportError("The chunked storage backend needs 'zarr<3' and 'numcodecs' (pip install 'zarr<3').") from e
+    return zarr, Blosc
+
+
+def chunked_path_for(path: Path) -> Path:
+    path = Path(path)
+    if path.name.endswith(CHUNKED_SUFFIX):
+        return path
+    return path.with_name(path.name.replace(".nii.gz", CHUNKED_SUFFIX))
+
+
+def save_chunked(array: np.ndarray, affine, header, output_path: Path, chunks=DEFAULT_CHUNKS, codec: str = "lz4", clevel: int = 5) -> Path:
+    """Écrit un volume en blocs compressés indépendants (Blosc), l'affine et l'en-tête NIfTI en attributs.
+
+    Lire un patch ne décompresse que les blocs qu'il recouvre.
+    """
+    if codec not in CODECS:
+        raise ValueError(f"Unknown codec '{codec}'. Must be one of {list(CODECS)}.")
+    zarr, Blosc = _import_zarr()
+
+    output_path = chunked_path_for(output_path)
+    header = header.copy() if header is not None else nib.Nifti1Header()
+    header.set_data_dtype(np.float32)
+    header["scl_slope"] = 1.0
+    header["scl_inter"] = 0.0
+
+    # Écriture dans un dossier temporaire puis renommage, comme les autres sorties du prétraitement
+    tmp_path = output_path.with_name(f".{output_path.name}.tmp")
+    if tmp_path.exists():
+        shutil.rmtree(tmp_path)
+    compressor = Blosc(cname=codec, clevel=clevel, shuffle=Blosc.SHUFFLE)
+    store = zarr.open_array(str(tmp_path), mode="w", shape=array.shape, chunks=tuple(min(c, s) for c, s in zip(chunks, array.shape)), dtype=np.float32, compressor=compressor)
+    store[...] = np.asarray(array, dtype=np.float32)
+    store.attrs["affine"] = np.asarray(affine, dtype=np.float64).tolist()
+    store.attrs["nifti_header"] = base64.b64encode(header.binaryblock).decode("ascii")
+
+    if output_path.exists():
+        shutil.rmtree(output_path)
+    os.replace(tmp_path, output_path)
+    logger.info(f"Image saved to: {output_path} ({codec}, chunks {store.chunks})")
+    return output_path
+
+
+def open_chunked(path: Path):
+    """Tableau zarr en lecture seule : le découpage ne lit que les blocs concernés."""
+    zarr, _ = _import_zarr()
+    chunked_path = chunked_path_for(path)
+    if not chunked_path.exists():
+        logger.error(f"Missing chunked volume: {chunked_path}")
+        raise FileNotFoundError(f"Chunked volume not found: {chunked_path}. Run convert_all_patients first.")
+    return zarr.open_array(str(chunked_path), mode="r")
+
+
+def chunked_affine_header(store) -> tuple[np.ndarray, nib.Nifti1Header]:
+    affine = np.asarray(store.attrs["affine"], dtype=np.float64)
+    header = nib.Nifti1Header(base64.b64decode(store.attrs["nifti_header"]))
+    return affine, header
+
+
+def load_chunked_image(path: Path) -> nib.Nifti1Image:
+    store = open_chunked(path)
+    affine, header = chunked_affine_header(store)
+    return nib.Nifti1Image(store[...], affine, header)
+
+
+class ChannelView:
+    """Ajoute un axe de canal (taille 1) devant un tableau zarr, sans le lire, pour utils/patch.py."""
+
+    def __init__(self, array):
+        self.array = array
+        self.shape = (1, *array.shape)
+
+    def __getitem__(self, key):
+        key = key if isinstance(key, tuple) else (key,)
+        channel, spatial = key[0], key[1:]
+        if channel not in (0, slice(None)):
+            raise IndexError("ChannelView only has a single channel.")
+        data = np.asarray(self.array[spatial], dtype=np.float32)
+        return data if channel == 0 else data[None]
+
+
+def convert_to_chunked(nifti_path: Path, overwrite: bool = False, **kwargs) -> Path:
+    output_path = chunked_path_for(nifti_path)
+    if output_path.exists() and not overwrite:
+        return output_path
+    image = nib.load(nifti_path)
+    return save_chunked(image.get_fdata(dtype=np.float32), image.affine, image.header, output_path, **kwargs)
+
+
+def convert_all_patients(root_dir: Path, filename: str = "PET_preprocessed.nii.gz", overwrite: bool = False, **kwargs):
+    nifti_paths = sorted(p for p in Path(root_dir).glob(f"*/*/{filename}") if not p.parent.parent.name.startswith("."))
+    logger.info(f"Converting {len(nifti_paths)} volumes from {root_dir} to chunked storage")
+
+    for nifti_path in tqdm(nifti_paths, desc="Conversion en blocs"):
+        convert_to_chunked(nifti_path, overwrite=overwrite, **kwargs)
+
+
+def _directory_size(path: Path) -> int:
+    return sum(f.stat().st_size for f in Path(path).rglob("*") if f.is_file())
+
+
+def _synthetic_pet(shape=(192, 192, 320), seed: int = 0) -> nib.Nifti1Image:
+    # Fond nul autour d'un "corps" ellipsoïdal bruité : compressibilité proche d'un PET corps entier
+    rng = np.random.default_rng(seed)
+    grid = np.ogrid[tuple(slice(0, s) for s in shape)]
+    body = sum(((g - s / 2) / (0.4 * s)) ** 2 for g, s in zip(grid, shape)) <= 1.0
+    data = np.where(body, rng.gamma(2.0, 0.5, size=shape), 0.0).astype(np.float32)
+    return nib.Nifti1Image(data, np.diag([2.0, 2.0, 2.0, 1.0]))
+
+
+def benchmark_patch_reads(nifti_path: Path = None, patch_size=(128, 128, 128), num_reads: int = 20, seed: int = 0, codecs=CODECS) -> dict:
+    """Temps de lecture de patchs aléatoires : .nii.gz (décompression gzip) contre stockage en blocs, par codec.
+
+    Sans `nifti_path`, un volume synthétique est utilisé : aucune donnée patient n'est nécessaire.
+    Les copies en blocs sont écrites dans un dossier temporaire.
+    """
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        if nifti_path is None:
+            nifti_path = Path(tmp_dir) / "synthetic_PET.nii.gz"
+            nib.save(_synthetic_pet(), nifti_path)
+        image = nib.load(nifti_path)
+        shape = image.shape
+        rng = random.Random(seed)
+        starts = [tuple(rng.randint(0, max(s - p, 0)) for s, p in zip(shape, patch_size)) for _ in range(num_reads)]
+
+        def read_nifti(start):
+            # Nouveau proxy à chaque lecture : pas de cache gzip entre patchs, comme un worker de DataLoader
+            proxy = nib.load(nifti_path).dataobj
+            return np.asarray(proxy[tuple(slice(s, s + p) for s, p in zip(start, patch_size))], dtype=np.float32)
+
+        readers = {"nifti": read_nifti}
+        results = {"nifti_bytes": Path(nifti_path).stat().st_size}
+        data = image.get_fdata(dtype=np.float32)
+        for codec in codecs:
+            start_time = time.perf_counter()
+            chunked_path = save_chunked(data, image.affine, image.header, Path(tmp_dir) / f"{codec}.nii.gz", codec=codec)
+            results[f"{codec}_write_s"] = time.perf_counter() - start_time
+            results[f"{codec}_bytes"] = _directory_size(chunked_path)
+            readers[codec] = lambda start, path=chunked_path: np.asarray(open_chunked(path)[tuple(slice(s, s + p) for s, p in zip(start, patch_size))], dtype=np.float32)
+        del data
+
+        for name, read in readers.items():
+            start_time = time.perf_counter()
+            for start in starts:
+                read(start)
+            results[f"{name}_ms_per_patch"] = (time.perf_counter() - start_time) / num_reads * 1000
+
+    logger.info(f"Random {patch_size} patch reads ({num_reads}) on a {shape} volume:")
+    logger.info(f"  {'nifti':>6}: {results['nifti_ms_per_patch']:.1f} ms/patch, {results['nifti_bytes'] / 1e6:.1f} MB")
+    for codec in codecs:
+        logger.info(
+            f"  {codec:>6}: {results[f'{codec}_ms_per_patch']:.1f} ms/patch (x{results['nifti_ms_per_patch'] / results[f'{codec}_ms_per_patch']:.1f}), "
+            f"{results[f'{codec}_bytes'] / 1e6:.1f} MB, written in {results[f'{codec}_write_s']:.1f}s"
+        )
+    return results
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Convert preprocessed volumes to chunked compressed storage.")
+    parser.add_argument("root_dir", type=Path, nargs="?", default=Path("data/processed"))
+    parser.add_argument("--filename", default="PET_preprocessed.nii.gz")
+    parser.add_argument("--codec", choices=CODECS, default="lz4")
+    parser.add_argument("--chunk_size", type=int, default=64)
+    parser.add_argument("--overwrite", action="store_true")
+    parser.add_argument("--benchmark", type=Path, nargs="?", const=False, default=None, help="Benchmark random 128^3 patch reads per codec instead of converting, on this .nii.gz or a synthetic volume.")
+    args = parser.parse_args()
+
+    if args.benchmark is not None:
+        benchmark_patch_reads(args.benchmark or None)
+    else:
+        convert_all_patients(args.root_dir, args.filename, overwrite=args.overwrite, chunks=(args.chunk_size,) * 3, codec=args.codec)
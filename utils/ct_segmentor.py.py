@@ -1,6 +1,15 @@
+import os
+import time
+import shutil
 import subprocess
+import tempfile
+import multiprocessing
+import numpy as np
+import nibabel as nib
+from concurrent.futures import ProcessPoolExecutor, as_completed
 from pathlib import Path
 from loguru import logger
+from tqdm import tqdm
 
 
 DEFAULT_ROI_SUBSET = [
@@ -20,8 +29,9 @@ def run_ct_segmentation(image_path: Path, output_dir: Path = None, fast: bool =
         raise FileNotFoundError(f"Image not found: {image_path}")
     
     if output_dir is None:
-        output_dir = "segmentation_output"
-        output_path = image_path.parent / output_dir
+        output_path = image_path.parent / "segmentation_output"
+    else:
+        output_path = Path(output_dir)
 
     output_path.mkdir(parents=True, exist_ok=True)
 
@@ -50,5 +60,226 @@ def run_ct_segmentation(image_path: Path, output_dir: Path = None, fast: bool =
             logger.debug(f"Error details: {e.stderr}")
 
 
+COMPLETION_MARKER = ".complete"
+# "api" : totalsegmentator() dans un worker persistant (prétraitement de TotalSegmentator, poids rechargés par patient)
+# "resident" : prédicteurs nnU-Net gardés en mémoire (ResidentSegmentor), activé seulement après check_segmentation_parity
+SEGMENTATION_ENGINES = ("api", "resident")
+PARITY_MIN_DICE = 0.95
+# Modèles nnU-Net de la tâche "total" de TotalSegmentator (mêmes identifiants et entraîneurs que son API Python)
+TOTAL_FAST_TASK = (297, "nnUNetTrainer_4000epochs_NoMirroring")
+TOTAL_PART_TASKS = ((291, "nnUNetTrainerNoMirroring"), (292, "nnUNetTrainerNoMirroring"), (293, "nnUNetTrainerNoMirroring"),
+                    (294, "nnUNetTrainerNoMirroring"), (295, "nnUNetTrainerNoMirroring"))
+_segmentor = None
+
+
+class ResidentSegmentor:
+    """Prédicteurs nnU-Net de TotalSegmentator chargés une seule fois, réutilisés pour chaque patient.
+
+    L'API totalsegmentator() recharge les poids et reconstruit le prédicteur à chaque appel ;
+    ici, seuls la lecture du CT, l'inférence et l'écriture des masques se répètent. En mode
+    complet, seules les parties du modèle contenant un organe de `roi_subset` sont chargées.
+    Les masques sont écrits comme TotalSegmentator : un `<organe>.nii.gz` par organe.
+
+    Ce chemin contourne le prétraitement de TotalSegmentator (as_closest_canonical, rééchantillonnage,
+    post-traitement) : il n'est utilisé par run_ct_segmentation_batch qu'après une vérification de
+    parité avec la CLI (check_segmentation_parity).
+    """
+
+    def __init__(self, fast: bool = True, roi_subset: list[str] = None, device: str = "cuda"):
+        import torch
+        from nnunetv2.inference.predict_from_raw_data import nnUNetPredictor
+        from totalsegmentator.config import get_weights_dir, setup_nnunet
+        from totalsegmentator.libs import download_pretrained_weights
+        from totalsegmentator.map_to_binary import class_map, class_map_5_parts
+
+        setup_nnunet()
+        roi_subset = set(roi_subset or DEFAULT_ROI_SUBSET)
+        if fast:
+            tasks = [(*TOTAL_FAST_TASK, class_map["total"])]
+        else:
+            # class_map_5_parts suit l'ordre des tâches 291 à 295 (organes, vertèbres, cardiaque, muscles, côtes)
+            tasks = [(task_id, trainer, part_map) for (task_id, trainer), part_map in zip(TOTAL_PART_TASKS, class_map_5_parts.values())]
+
+        self.models = []
+        for task_id, trainer, label_map in tasks:
+            labels = {label: name for label, name in label_map.items() if name in roi_subset}
+            if not labels:
+                continue
+            download_pretrained_weights(task_id)
+            dataset_dir = next(Path(get_weights_dir()).glob(f"Dataset{task_id}_*"))
+
+            predictor = nnUNetPredictor(tile_step_size=0.5, use_gaussian=True, use_mirroring=False, device=torch.device(device), verbose=False, allow_tqdm=False)
+            predictor.initialize_from_trained_model_folder(str(dataset_dir / f"{trainer}__nnUNetPlans__3d_fullres"), use_folds=(0,), checkpoint_name="checkpoint_final.pth")
+            self.models.append((predictor, labels))
+
+        if not self.models:
+            raise ValueError(f"None of the requested ROIs are segmented by TotalSegmentator: {sorted(roi_subset)}")
+        logger.info(f"Loaded {len(self.models)} TotalSegmentator model(s) on {device}.")
+
+    def segment(self, image_path: Path, output_dir: Path):
+        output_dir.mkdir(parents=True, exist_ok=True)
+        for predictor, labels in self.models:
+            # Lecteur du plan nnU-Net : même réorientation à la lecture et à l'écriture des masques
+            reader = predictor.plans_manager.image_reader_writer_class()
+            data, properties = reader.read_images([str(image_path)])
+            segmentation = predictor.predict_single_npy_array(data, properties)
+            for label, name in labels.items():
+                reader.write_seg((segmentation == label).astype(np.uint8), str(output_dir / f"{name}.nii.gz"), properties)
+
+
+def is_segmentation_complete(output_dir: Path) -> bool:
+    return (Path(output_dir) / COMPLETION_MARKER).exists()
+
+
+def _dice(mask_a: np.ndarray, mask_b: np.ndarray) -> float:
+    total = mask_a.sum() + mask_b.sum()
+    return 1.0 if total == 0 else 2.0 * np.logical_and(mask_a, mask_b).sum() / total
+
+
+def check_segmentation_parity(image_path: Path, fast: bool = True, roi_subset: list[str] = None, device: str = "cuda", min_dice: float = PARITY_MIN_DICE) -> dict:
+    """Compare ResidentSegmentor à la CLI (run_ct_segmentation) sur un CT : Dice par organe.
+
+    Lève ValueError si un organe n'atteint pas `min_dice` ou si les masques n'ont pas la même
+    géométrie (forme ou affine) que ceux de la CLI.
+    """
+    selected_rois = roi_subset or DEFAULT_ROI_SUBSET
+    with tempfile.TemporaryDirectory() as tmp:
+        cli_dir, resident_dir = Path(tmp) / "cli", Path(tmp) / "resident"
+        run_ct_segmentation(image_path, cli_dir, fast=fast, roi_subset=selected_rois)
+        ResidentSegmentor(fast=fast, roi_subset=selected_rois, device=device).segment(Path(image_path), resident_dir)
+
+        scores = {}
+        for cli_path in sorted(cli_dir.glob("*.nii.gz")):
+            name = cli_path.name[:-len(".nii.gz")]
+            resident_path = resident_dir / cli_path.name
+            if not resident_path.exists():
+                raise ValueError(f"Resident segmentation is missing {name} for {image_path}.")
+            cli_image, resident_image = nib.load(cli_path), nib.load(resident_path)
+            if cli_image.shape != resident_image.shape or not np.allclose(cli_image.affine, resident_image.affine, atol=1e-3):
+                raise ValueError(f"Resident segmentation of {name} is not on the CLI grid for {image_path}.")
+            scores[name] = _dice(np.asanyarray(cli_image.dataobj) > 0, np.asanyarray(resident_image.dataobj) > 0)
+
+    if not scores:
+        # run_ct_segmentation journalise l'échec de la CLI sans lever : aucune référence, pas de parité
+        raise ValueError(f"The TotalSegmentator CLI produced no masks for {image_path}.")
+    failed = {name: score for name, score in scores.items() if score < min_dice}
+    if failed:
+        raise ValueError(f"Resident segmentation differs from the CLI (Dice < {min_dice}): {failed}")
+    logger.info(f"Resident segmentation matches the CLI on {image_path} (min Dice {min(scores.values()):.3f}).")
+    return scores
+
+
+def _segment_with_api(image_path: Path, output_dir: Path, fast: bool, roi_subset: list[str], device: str):
+    from totalsegmentator.python_api import totalsegmentator
+
+    totalsegmentator(image_path, output_dir, fast=fast, roi_subset=roi_subset, device=device, quiet=True)
+
+
+def _init_segmentation_worker(threads_per_worker: int, fast: bool, roi_subset: list[str], device: str, gpu_queue, engine: str):
+    # Worker persistant : les patients suivants ne paient plus le lancement de Python, les imports ni l'initialisation CUDA
+    global _segmentor
+    import torch
+
+    torch.set_num_threads(threads_per_worker)
+    torch_device = api_device = device
+    if device == "gpu":
+        # Un GPU distinct par worker, tiré de la file remplie par run_ct_segmentation_batch
+        gpu_id = gpu_queue.get()
+        torch_device, api_device = f"cuda:{gpu_id}", f"gpu:{gpu_id}"
+
+    if engine == "resident":
+        _segmentor = ResidentSegmentor(fast=fast, roi_subset=roi_subset, device=torch_device).segment
+    else:
+        import totalsegmentator.python_api  # noqa: F401  (import payé une fois par worker)
+        _segmentor = lambda image_path, output_dir: _segment_with_api(image_path, output_dir, fast, roi_subset, api_device)
+
+
+def _segment_job(image_path: Path, output_dir: Path):
+    start_time = time.perf_counter()
+    tmp_dir = output_dir.parent / f".{output_dir.name}.tmp"
+    try:
+        if tmp_dir.exists():
+            shutil.rmtree(tmp_dir)
+        _segmentor(image_path, tmp_dir)
+        (tmp_dir / COMPLETION_MARKER).write_text(time.strftime("%Y-%m-%dT%H:%M:%S"))
+
+        if output_dir.exists():
+            shutil.rmtree(output_dir)
+        os.replace(tmp_dir, output_dir)
+    except Exception as e:
+        logger.exception(f"Segmentation failed for {image_path}: {e}")
+        return str(image_path), f"{type(e).__name__}: {e}", time.perf_counter() - start_time
+    return str(image_path), None, time.perf_counter() - start_time
+
+
+def run_ct_segmentation_batch(image_paths: list[Path], output_dirs: list[Path] = None, fast: bool = True, roi_subset: list[str] = None, workers: int = 1, threads_per_worker: int = None,
+                              device: str = "gpu", gpu_ids: tuple[int, ...] = (0,), engine: str = "api") -> dict:
+    """Segmente une liste de CT avec des workers persistants, chacun traitant plusieurs patients.
+
+    `engine="api"` passe par totalsegmentator() (même prétraitement que la CLI) ; `engine="resident"`
+    garde les prédicteurs chargés (ResidentSegmentor) si check_segmentation_parity réussit sur le
+    premier CT, sinon repasse en "api". Les dossiers de sortie déjà complets (marqueur .complete)
+    sont ignorés. Sur GPU, chaque worker a son propre device de `gpu_ids` : il n'y a jamais plus
+    de workers que de GPU.
+    """
+    if engine not in SEGMENTATION_ENGINES:
+        raise ValueError(f"Unknown engine: {engine}. Supported engines are {', '.join(SEGMENTATION_ENGINES)}.")
+    image_paths = [Path(p) for p in image_paths]
+    if output_dirs is None:
+        output_dirs = [p.parent / "segmentation_output" for p in image_paths]
+    output_dirs = [Path(d) for d in output_dirs]
+    if len(output_dirs) != len(image_paths):
+        raise ValueError("output_dirs must have one entry per image.")
+
+    selected_rois = roi_subset or DEFAULT_ROI_SUBSET
+    jobs = []
+    for image_path, output_dir in zip(image_paths, output_dirs):
+        if not image_path.exists():
+            logger.error(f"File not found: {image_path}")
+            continue
+        if is_segmentation_complete(output_dir):
+            logger.info(f"Segmentation already complete: {output_dir}. Skipping.")
+            continue
+        jobs.append((image_path, output_dir))
+
+    if engine == "resident" and jobs:
+        # Processus à part : les modèles de la vérification ne restent pas sur le GPU du processus principal
+        parity_device = f"cuda:{gpu_ids[0]}" if device == "gpu" else device
+        with ProcessPoolExecutor(max_workers=1) as executor:
+            try:
+                executor.submit(check_segmentation_parity, jobs[0][0], fast, selected_rois, parity_device).result()
+            except Exception as e:
+                logger.error(f"Parity check failed, falling back to the TotalSegmentator API: {e}")
+                engine = "api"
+
+    gpu_queue = None
+    if device == "gpu":
+        if workers > len(gpu_ids):
+            logger.warning(f"{workers} workers requested for {len(gpu_ids)} GPU(s); using {len(gpu_ids)} (one model set per GPU).")
+            workers = len(gpu_ids)
+        gpu_queue = multiprocessing.Queue()
+        for gpu_id in gpu_ids[:workers]:
+            gpu_queue.put(gpu_id)
+
+    logger.info(f"Segmenting {len(jobs)} CT volumes ({len(image_paths) - len(jobs)} skipped) with {workers} worker(s), engine {engine}...")
+    threads_per_worker = threads_per_worker or max(1, (os.cpu_count() or 1) // workers)
+
+    failures = {}
+    with ProcessPoolExecutor(max_workers=workers, initializer=_init_segmentation_worker, initargs=(threads_per_worker, fast, selected_rois, device, gpu_queue, engine)) as executor:
+        futures = [executor.submit(_segment_job, image_path, output_dir) for image_path, output_dir in jobs]
+        for future in tqdm(as_completed(futures), total=len(futures), desc="Segmentation CT"):
+            name, error, duration = future.result()
+            if error:
+                failures[name] = error
+            else:
+                logger.success(f"Segmented {name} in {duration:.1f}s")
+
+    if failures:
+        logger.error(f"Segmentation failed for {len(failures)} volume(s): {', '.join(sorted(failures))}")
+    return failures
+
+
 # ==== Exemple d'utilisation ====
-run_ct_segmentation(image_path=Path("processed_data/Agathe/CT_baseline_resampled.nii.gz"))   
\ No newline at end of file
+if __name__ == "__main__":
+    ct_paths = sorted(Path("processed_data").glob("*/CT_baseline_resampled.nii.gz"))
+    run_ct_segmentation_batch(ct_paths, workers=1)   
\ No newline at end of file
@@ -1,11 +1,24 @@
 import dicom2nifti
+import os
+import csv
 import shutil
 import re
 import pydicom
 import json
 import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
 from pathlib import Path
 from loguru import logger
+from tqdm import tqdm
+
+from dicom_index import scan_cohort, list_patients, get_patient_series, get_suv_fields
+
+
+REQUIRED_FILES = [
+    "PET_baseline.nii.gz", "PET_normal.nii.gz",
+    "CT_baseline.nii.gz", "CT_normal.nii.gz",
+    "patient_info.json"
+]
 
 
 def classify_dicom(name: str) -> tuple[str, str]:
@@ -108,13 +121,8 @@ def process_all_patients(dicom_root_dir: Path, processed_root_dir: Path = None,
             continue
 
         patient_processed_dir = processed_root_dir / patient_dicom_dir.name
-        required_files = [
-            "PET_baseline.nii.gz", "PET_normal.nii.gz",
-            "CT_baseline.nii.gz", "CT_normal.nii.gz",
-            "patient_info.json"
-        ]
 
-        if all((patient_processed_dir / f).exists() for f in required_files):
+        if all((patient_processed_dir / f).exists() for f in REQUIRED_FILES):
             logger.info(f"Patient {patient_dicom_dir.name} already processed. Skipping.")
             skipped_count += 1
             continue
@@ -137,8 +145,219 @@ def process_all_patients(dicom_root_dir: Path, processed_root_dir: Path = None,
     logger.info(f"Processing complete: {processed_count} patients processed, {skipped_count} skipped. Total time: {total_elapsed:.2f}s\n")
 
 
+def _has_dicom(directory: Path) -> bool:
+    # Parcours paresseux avec arrêt au premier .dcm, au lieu de rglob sur tout l'arbre
+    with os.scandir(directory) as entries:
+        subdirs = []
+        for entry in entries:
+            if entry.is_file() and entry.name.lower().endswith(".dcm"):
+                return True
+            if entry.is_dir():
+                subdirs.append(entry.path)
+    return any(_has_dicom(Path(subdir)) for subdir in subdirs)
+
+
+def _list_series_dirs(patient_dicom_dir: Path) -> list[Path]:
+    series_dirs = []
+    with os.scandir(patient_dicom_dir) as entries:
+        for entry in entries:
+            if entry.is_dir() and "_" in entry.name and _has_dicom(Path(entry.path)):
+                series_dirs.append(Path(entry.path))
+    return sorted(series_dirs)
+
+
+def _convert_series_job(patient: str, series_dir: Path, output_path: Path) -> dict:
+    start_time = time.perf_counter()
+    # Écriture dans un fichier temporaire du même dossier puis renommage atomique
+    tmp_path = output_path.with_name(f".tmp-{output_path.name}")
+    result = {"patient": patient, "series": series_dir.name, "output": str(output_path)}
+    try:
+        dicom2nifti.dicom_series_to_nifti(str(series_dir), str(tmp_path), reorient_nifti=True)
+        os.replace(tmp_path, output_path)
+        result.update(status="converted", error="")
+    except Exception as e:
+        tmp_path.unlink(missing_ok=True)
+        result.update(status="failed", error=f"{type(e).__name__}: {e}")
+    result["seconds"] = time.perf_counter() - start_time
+    return result
+
+
+def _convert_file_list_job(patient: str, series_name: str, dicom_files: list[Path], output_path: Path) -> dict:
+    start_time = time.perf_counter()
+    tmp_path = output_path.with_name(f".tmp-{output_path.name}")
+    result = {"patient": patient, "series": series_name, "output": str(output_path)}
+    try:
+        datasets = [pydicom.dcmread(str(f)) for f in dicom_files]
+        dicom2nifti.convert_dicom.dicom_array_to_nifti(datasets, str(tmp_path), reorient_nifti=True)
+        os.replace(tmp_path, output_path)
+        result.update(status="converted", error="")
+    except Exception as e:
+        tmp_path.unlink(missing_ok=True)
+        result.update(status="failed", error=f"{type(e).__name__}: {e}")
+    result["seconds"] = time.perf_counter() - start_time
+    return result
+
+
+def write_patient_metadata_from_index(index_path: Path, patient: str, output_dir: Path):
+    # Champs SUV lus dans l'index : aucun fichier DICOM n'est relu
+    fields = get_suv_fields(index_path, patient, timepoint="baseline") or get_suv_fields(index_path, patient, timepoint="normal")
+    if not fields or fields["patient_weight"] is None or fields["injected_dose"] is None:
+        logger.error(f"Missing DICOM fields required for SUV calculation for patient {patient}.")
+        raise ValueError("Missing DICOM fields required for SUV calculation.")
+
+    patient_info = {
+        "PatientWeight": fields["patient_weight"],
+        "InjectedDose": fields["injected_dose"]
+    }
+
+    output_json = output_dir / "patient_info.json"
+    with open(output_json, "w") as f:
+        json.dump(patient_info, f, indent=4)
+
+    logger.info(f"Saved patient_info.json to: {output_json}.")
+
+
+def _extract_metadata_job(patient: str, patient_dicom_dir: Path, patient_processed_dir: Path) -> dict:
+    start_time = time.perf_counter()
+    result = {"patient": patient, "series": "patient_info", "output": str(patient_processed_dir / "patient_info.json")}
+    try:
+        extract_patient_metadata(patient_dicom_dir, patient_processed_dir)
+        result.update(status="converted", error="")
+    except Exception as e:
+        result.update(status="failed", error=f"{type(e).__name__}: {e}")
+    result["seconds"] = time.perf_counter() - start_time
+    return result
+
+
+def write_conversion_report(results: list[dict], report_path: Path):
+    report_path.parent.mkdir(parents=True, exist_ok=True)
+    with open(report_path.with_suffix(".json"), "w") as f:
+        json.dump(results, f, indent=4)
+    with open(report_path.with_suffix(".csv"), "w", newline="") as f:
+        writer = csv.DictWriter(f, fieldnames=["patient", "series", "status", "seconds", "output", "error"])
+        writer.writeheader()
+        writer.writerows(results)
+    logger.info(f"Conversion report written to {report_path.with_suffix('.json')}")
+
+
+def process_all_patients_parallel(dicom_root_dir: Path, processed_root_dir: Path = None, already_organized: bool = False, workers: int = None, report_path: Path = None) -> list[dict]:
+    """Convertit toutes les paires (patient, série) en parallèle sur un pool de processus.
+
+    Chaque série est un travail indépendant : un échec n'arrête ni le patient ni la cohorte.
+    Un rapport JSON/CSV avec le temps de chaque série est écrit à la fin.
+    """
+    total_start_time = time.time()
+    workers = workers or os.cpu_count() or 1
+    logger.info(f"Starting parallel processing of all patients with {workers} workers...")
+
+    if processed_root_dir is None:
+        processed_root_dir = dicom_root_dir.parent / "processed"
+    processed_root_dir.mkdir(parents=True, exist_ok=True)
+    if report_path is None:
+        report_path = processed_root_dir / "conversion_report.json"
+
+    jobs = []
+    skipped_count = 0
+    for patient_dicom_dir in sorted(p for p in dicom_root_dir.iterdir() if p.is_dir()):
+        patient = patient_dicom_dir.name
+        patient_processed_dir = processed_root_dir / patient
+
+        if all((patient_processed_dir / f).exists() for f in REQUIRED_FILES):
+            logger.info(f"Patient {patient} already processed. Skipping.")
+            skipped_count += 1
+            continue
+        if not _has_dicom(patient_dicom_dir):
+            logger.warning(f"No DICOM files found in {patient}. Skipping this patient.")
+            continue
+
+        if not already_organized:
+            organize_dicom(patient_dicom_dir)
+
+        patient_processed_dir.mkdir(parents=True, exist_ok=True)
+        for series_dir in _list_series_dirs(patient_dicom_dir):
+            output_path = patient_processed_dir / f"{series_dir.name}.nii.gz"
+            if not output_path.exists():
+                jobs.append((_convert_series_job, patient, series_dir, output_path))
+        if not (patient_processed_dir / "patient_info.json").exists():
+            jobs.append((_extract_metadata_job, patient, patient_dicom_dir, patient_processed_dir))
+
+    results = []
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        futures = [executor.submit(job, *job_args) for job, *job_args in jobs]
+        for future in tqdm(as_completed(futures), total=len(futures), desc="Conversion DICOM"):
+            result = future.result()
+            results.append(result)
+            if result["status"] == "failed":
+                logger.error(f"{result['patient']}/{result['series']} failed: {result['error']}")
+
+    results.sort(key=lambda r: (r["patient"], r["series"]))
+    write_conversion_report(results, report_path)
+
+    failed_count = sum(r["status"] == "failed" for r in results)
+    total_elapsed = time.time() - total_start_time
+    logger.info(f"Processing complete: {len(results) - failed_count} jobs succeeded, {failed_count} failed, {skipped_count} patients skipped. Total time: {total_elapsed:.2f}s\n")
+    return results
+
+
+def process_all_patients_from_index(dicom_root_dir: Path, processed_root_dir: Path = None, index_path: Path = None, workers: int = None, report_path: Path = None) -> list[dict]:
+    """Comme process_all_patients_parallel, mais les séries et les métadonnées viennent de
+    l'index DICOM (utils/dicom_index.py) : pas de réorganisation des fichiers ni de parcours de l'arbre."""
+    total_start_time = time.time()
+    workers = workers or os.cpu_count() or 1
+
+    if processed_root_dir is None:
+        processed_root_dir = dicom_root_dir.parent / "processed"
+    processed_root_dir.mkdir(parents=True, exist_ok=True)
+    if report_path is None:
+        report_path = processed_root_dir / "conversion_report.json"
+
+    index_path = scan_cohort(dicom_root_dir, index_path)
+
+    jobs = []
+    results = []
+    for patient in list_patients(index_path):
+        patient_processed_dir = processed_root_dir / patient
+        if all((patient_processed_dir / f).exists() for f in REQUIRED_FILES):
+            logger.info(f"Patient {patient} already processed. Skipping.")
+            continue
+        patient_processed_dir.mkdir(parents=True, exist_ok=True)
+
+        for series_name, dicom_files in get_patient_series(index_path, patient).items():
+            output_path = patient_processed_dir / f"{series_name}.nii.gz"
+            if not output_path.exists():
+                jobs.append((patient, series_name, dicom_files, output_path))
+
+        if not (patient_processed_dir / "patient_info.json").exists():
+            start_time = time.perf_counter()
+            result = {"patient": patient, "series": "patient_info", "output": str(patient_processed_dir / "patient_info.json")}
+            try:
+                write_patient_metadata_from_index(index_path, patient, patient_processed_dir)
+                result.update(status="converted", error="")
+            except Exception as e:
+                # Ligne d'index absente ou corrompue (KeyError, sqlite3.Error, OSError...) : patient en échec, le lot continue
+                logger.error(f"{patient}/patient_info failed: {type(e).__name__}: {e}")
+                result.update(status="failed", error=f"{type(e).__name__}: {e}")
+            result["seconds"] = time.perf_counter() - start_time
+            results.append(result)
+
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        futures = [executor.submit(_convert_file_list_job, *job) for job in jobs]
+        for future in tqdm(as_completed(futures), total=len(futures), desc="Conversion DICOM"):
+            result = future.result()
+            results.append(result)
+            if result["status"] == "failed":
+                logger.error(f"{result['patient']}/{result['series']} failed: {result['error']}")
+
+    results.sort(key=lambda r: (r["patient"], r["series"]))
+    write_conversion_report(results, report_path)
+
+    failed_count = sum(r["status"] == "failed" for r in results)
+    logger.info(f"Processing complete: {len(results) - failed_count} jobs succeeded, {failed_count} failed. Total time: {time.time() - total_start_time:.2f}s")
+    return results
+
 
 # ========
-dicom_root_dir = Path("data/raw")
-process_all_patients(dicom_root_dir, already_organized=True)
+if __name__ == "__main__":
+    dicom_root_dir = Path("data/raw")
+    process_all_patients_parallel(dicom_root_dir, already_organized=True)
 
@@ -0,0 +1,299 @@
+import os
+import sqlite3
+import time
+import pydicom
+from datetime import datetime, timedelta
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+from loguru import logger
+
+
+INDEX_FILENAME = "dicom_index.sqlite"
+
+HEADER_TAGS = [
+    "SOPInstanceUID", "SeriesInstanceUID", "StudyInstanceUID", "Modality",
+    "SeriesDate", "SeriesTime", "AcquisitionTime", "InstanceNumber",
+    "PatientWeight", "Units", "DecayCorrection", "RadiopharmaceuticalInformationSequence",
+]
+
+MODALITIES = {"PT": "PET", "CT": "CT"}
+
+# Écart maximal entre deux séries TEP consécutives d'une même session (reconstructions AC/NAC, pas de lit)
+SESSION_GAP = timedelta(minutes=30)
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS files (
+    path TEXT PRIMARY KEY,
+    patient TEXT NOT NULL,
+    mtime REAL NOT NULL,
+    size INTEGER NOT NULL,
+    sop_instance_uid TEXT,
+    series_instance_uid TEXT,
+    study_instance_uid TEXT,
+    modality TEXT,
+    series_date TEXT,
+    series_time TEXT,
+    acquisition_time TEXT,
+    instance_number INTEGER,
+    patient_weight REAL,
+    injected_dose REAL,
+    radiopharmaceutical_start_time TEXT,
+    half_life REAL,
+    units TEXT,
+    decay_correction TEXT
+);
+CREATE INDEX IF NOT EXISTS files_series ON files (series_instance_uid);
+CREATE TABLE IF NOT EXISTS series (
+    series_instance_uid TEXT PRIMARY KEY,
+    patient TEXT NOT NULL,
+    modality TEXT,
+    timepoint TEXT,
+    series_date TEXT,
+    acquisition_time TEXT,
+    num_files INTEGER
+);
+"""
+
+
+def open_index(index_path: Path) -> sqlite3.Connection:
+    conn = sqlite3.connect(str(index_path))
+    conn.row_factory = sqlite3.Row
+    conn.executescript(SCHEMA)
+    return conn
+
+
+def _float_or_none(value):
+    try:
+        return float(value) if value not in (None, "") else None
+    except (TypeError, ValueError):
+        return None
+
+
+def read_header(path: str) -> dict:
+    # En-tête seulement : les données pixel ne sont jamais lues
+    ds = pydicom.dcmread(path, stop_before_pixels=True, specific_tags=HEADER_TAGS)
+
+    radiopharm = ds.get("RadiopharmaceuticalInformationSequence")
+    radiopharm = radiopharm[0] if radiopharm else {}
+
+    return {
+        "sop_instance_uid": str(ds.get("SOPInstanceUID", "")),
+        "series_instance_uid": str(ds.get("SeriesInstanceUID", "")),
+        "study_instance_uid": str(ds.get("StudyInstanceUID", "")),
+        "modality": str(ds.get("Modality", "")),
+        "series_date": str(ds.get("SeriesDate", "")),
+        "series_time": str(ds.get("SeriesTime", "")),
+        "acquisition_time": str(ds.get("AcquisitionTime", "")),
+        "instance_number": int(ds.get("InstanceNumber", 0) or 0),
+        "patient_weight": _float_or_none(ds.get("PatientWeight")),
+        "injected_dose": _float_or_none(radiopharm.get("RadionuclideTotalDose")),
+        "radiopharmaceutical_start_time": str(radiopharm.get("RadiopharmaceuticalStartTime", "")),
+        "half_life": _float_or_none(radiopharm.get("RadionuclideHalfLife")),
+        "units": str(ds.get("Units", "")),
+        "decay_correction": str(ds.get("DecayCorrection", "")),
+    }
+
+
+def _list_dicom_files(dicom_root_dir: Path) -> dict:
+    files = {}
+    for patient_dir in sorted(p for p in dicom_root_dir.iterdir() if p.is_dir()):
+        for dirpath, _, filenames in os.walk(patient_dir):
+            for filename in filenames:
+                if filename.lower().endswith(".dcm"):
+                    path = os.path.join(dirpath, filename)
+                    stat = os.stat(path)
+                    files[path] = (patient_dir.name, stat.st_mtime, stat.st_size)
+    return files
+
+
+def scan_cohort(dicom_root_dir: Path, index_path: Path = None, workers: int = 16) -> Path:
+    """Met à jour l'index de la cohorte ; seuls les fichiers nouveaux ou modifiés (mtime, taille) sont relus."""
+    start_time = time.perf_counter()
+    if index_path is None:
+        index_path = dicom_root_dir / INDEX_FILENAME
+    conn = open_index(index_path)
+
+    on_disk = _list_dicom_files(dicom_root_dir)
+    indexed = {row["path"]: (row["mtime"], row["size"]) for row in conn.execute("SELECT path, mtime, size FROM files")}
+
+    removed = [path for path in indexed if path not in on_disk]
+    to_scan = [path for path, (_, mtime, size) in on_disk.items() if indexed.get(path) != (mtime, size)]
+    logger.info(f"DICOM index: {len(on_disk)} files on disk, {len(to_scan)} to scan, {len(removed)} removed.")
+
+    conn.executemany("DELETE FROM files WHERE path = ?", [(path,) for path in removed])
+
+    # Lectures d'en-têtes limitées par les E/S : un pool de threads suffit
+    failures = 0
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        for path, header in zip(to_scan, executor.map(_safe_read_header, to_scan)):
+            if header is None:
+                failures += 1
+                continue
+            patient, mtime, size = on_disk[path]
+            conn.execute(
+                "INSERT OR REPLACE INTO files VALUES (:path, :patient, :mtime, :size, :sop_instance_uid, :series_instance_uid, "
+                ":study_instance_uid, :modality, :series_date, :series_time, :acquisition_time, :instance_number, :patient_weight, "
+                ":injected_dose, :radiopharmaceutical_start_time, :half_life, :units, :decay_correction)",
+                {"path": path, "patient": patient, "mtime": mtime, "size": size, **header},
+            )
+
+    classify_series(conn)
+    conn.commit()
+    conn.close()
+
+    if failures:
+        logger.warning(f"{failures} files could not be read as DICOM.")
+    logger.info(f"DICOM index updated in {time.perf_counter() - start_time:.2f}s: {index_path}")
+    return index_path
+
+
+def _safe_read_header(path: str):
+    try:
+        return read_header(path)
+    except Exception as e:
+        logger.debug(f"Unreadable DICOM header {path}: {e}")
+        return None
+
+
+def _session_datetime(series_date: str, acquisition_time: str):
+    # SeriesDate AAAAMMJJ + AcquisitionTime HHMMSS(.ffffff) ; None si la date manque
+    if not series_date or not series_date.isdigit():
+        return None
+    clock = (acquisition_time or "").split(".")[0]
+    clock = clock.ljust(6, "0")[:6] if clock.isdigit() else "000000"
+    try:
+        return datetime.strptime(series_date[:8] + clock, "%Y%m%d%H%M%S")
+    except ValueError:
+        return None
+
+
+def group_pet_sessions(pet_series: list[dict]) -> list[list[dict]]:
+    """Regroupe les séries TEP d'un patient en sessions, triées dans le temps.
+
+    Une session = un StudyInstanceUID (reconstructions AC/NAC, pas de lit supplémentaires),
+    découpé si deux séries consécutives sont séparées de plus de SESSION_GAP (double point
+    temporel dans une même étude). Sans StudyInstanceUID, seul l'écart temporel est utilisé.
+    """
+    by_study = {}
+    for s in pet_series:
+        by_study.setdefault(s["study_instance_uid"] or "", []).append(s)
+
+    sessions = []
+    for study_uid, study_series in by_study.items():
+        study_sessions, current = [], []
+        for s in sorted((s for s in study_series if s["datetime"] is not None), key=lambda s: s["datetime"]):
+            if current and s["datetime"] - current[-1]["datetime"] > SESSION_GAP:
+                study_sessions.append(current)
+                current = []
+            current.append(s)
+        if current:
+            study_sessions.append(current)
+
+        undated = [s for s in study_series if s["datetime"] is None]
+        if undated:
+            # Séries sans date : rattachées à la première session de leur étude, sinon session à part
+            if study_uid and study_sessions:
+                study_sessions[0].extend(undated)
+            else:
+                study_sessions.append(undated)
+        sessions.extend(study_sessions)
+
+    def start(session):
+        datetimes = [s["datetime"] for s in session if s["datetime"] is not None]
+        return (min(datetimes) if datetimes else datetime.max, min(s["series_instance_uid"] for s in session))
+
+    return sorted(sessions, key=start)
+
+
+def classify_series(conn: sqlite3.Connection):
+    """Classe les séries par contenu (Modality, StudyInstanceUID, SeriesDate, AcquisitionTime) plutôt que par nom de fichier.
+
+    Par patient, les séries TEP sont regroupées en sessions (group_pet_sessions) triées dans le temps :
+    la première est 'baseline', la suivante 'normal', même si les deux ont lieu le même jour.
+    Chaque CT prend le point temporel de la session TEP de la même étude, la plus proche dans le
+    temps s'il y en a plusieurs ; sans étude commune, la session la plus proche en date et heure.
+    """
+    conn.execute("DELETE FROM series")
+    rows = conn.execute(
+        "SELECT series_instance_uid, patient, modality, MIN(study_instance_uid) AS study_instance_uid, MIN(series_date) AS series_date, "
+        "MIN(acquisition_time) AS acquisition_time, COUNT(*) AS num_files "
+        "FROM files GROUP BY series_instance_uid, patient, modality"
+    ).fetchall()
+
+    by_patient = {}
+    for row in rows:
+        series = dict(row)
+        series["datetime"] = _session_datetime(series["series_date"], series["acquisition_time"])
+        by_patient.setdefault(series["patient"], []).append(series)
+
+    for patient, series_list in by_patient.items():
+        pet_sessions = group_pet_sessions([s for s in series_list if s["modality"] == "PT"])
+        timepoints = {}
+        for i, session in enumerate(pet_sessions):
+            for s in session:
+                timepoints[s["series_instance_uid"]] = "baseline" if i == 0 else "normal" if i == 1 else f"timepoint_{i}"
+
+        for s in series_list:
+            if s["series_instance_uid"] in timepoints:
+                timepoint = timepoints[s["series_instance_uid"]]
+            elif pet_sessions:
+                # CT : sessions de la même étude en priorité, puis la plus proche en date et heure
+                candidates = [p for p in pet_sessions if s["study_instance_uid"] and any(x["study_instance_uid"] == s["study_instance_uid"] for x in p)] or pet_sessions
+                nearest = candidates[0]
+                if s["datetime"] is not None:
+                    dated = [(p, x["datetime"]) for p in candidates for x in p if x["datetime"] is not None]
+                    if dated:
+                        nearest = min(dated, key=lambda item: abs((item[1] - s["datetime"]).total_seconds()))[0]
+                timepoint = timepoints[nearest[0]["series_instance_uid"]]
+            else:
+                timepoint = "unknown"
+            conn.execute(
+                "INSERT INTO series VALUES (?, ?, ?, ?, ?, ?, ?)",
+                (s["series_instance_uid"], patient, MODALITIES.get(s["modality"], "unknown"), timepoint, s["series_date"], s["acquisition_time"], s["num_files"]),
+            )
+
+
+def list_patients(index_path: Path) -> list[str]:
+    conn = open_index(index_path)
+    patients = [row["patient"] for row in conn.execute("SELECT DISTINCT patient FROM series ORDER BY patient")]
+    conn.close()
+    return patients
+
+
+def get_patient_series(index_path: Path, patient: str) -> dict:
+    """Renvoie {'PET_baseline': [fichiers triés par InstanceNumber], 'CT_baseline': [...], ...}."""
+    conn = open_index(index_path)
+    series = {}
+    for row in conn.execute("SELECT series_instance_uid, modality, timepoint, num_files FROM series WHERE patient = ? ORDER BY num_files DESC, series_instance_uid", (patient,)):
+        name = f"{row['modality']}_{row['timepoint']}"
+        if name in series:
+            # Plusieurs séries pour le même couple : on garde la plus complète
+            logger.warning(f"Patient {patient}: several {name} series, keeping the largest.")
+            continue
+        series[name] = [
+            Path(r["path"]) for r in conn.execute(
+                "SELECT path FROM files WHERE series_instance_uid = ? ORDER BY instance_number", (row["series_instance_uid"],)
+            )
+        ]
+    conn.close()
+    return series
+
+
+def get_suv_fields(index_path: Path, patient: str, timepoint: str = "baseline") -> dict:
+    conn = open_index(index_path)
+    row = conn.execute(
+        "SELECT f.patient_weight, f.injected_dose, f.radiopharmaceutical_start_time, f.half_life, f.units, f.decay_correction, "
+        "f.series_time, f.acquisition_time FROM files f JOIN series s ON f.series_instance_uid = s.series_instance_uid "
+        "WHERE s.patient = ? AND s.modality = 'PET' AND s.timepoint = ? LIMIT 1",
+        (patient, timepoint),
+    ).fetchone()
+    conn.close()
+    return dict(row) if row else {}
+
+
+# ==== Exemple d'utilisation ====
+if __name__ == "__main__":
+    dicom_root = Path("data/raw")
+    index = scan_cohort(dicom_root)
+    for patient in list_patients(index):
+        logger.info(f"{patient}: {sorted(get_patient_series(index, patient))}")
@@ -3,7 +3,10 @@ import nibabel as nib
 import SimpleITK as sitk
 import ants
 import tempfile
+import time
+import argparse
 import os
+from loguru import logger
 
 
 def nib_to_sitk(nib_image: nib.Nifti1Image) -> sitk.Image:
@@ -41,7 +44,46 @@ def sitk_to_nib(sitk_image: sitk.Image) -> nib.Nifti1Image:
     return nib.Nifti1Image(array.astype(np.float32), affine)
 
 
+# Nibabel travaille en RAS, ITK/ANTs en LPS : on inverse les deux premiers axes physiques
+LPS_TO_RAS = np.diag([-1.0, -1.0, 1.0])
+
+
 def nib_to_ants(nib_img: nib.Nifti1Image) -> ants.ANTsImage:
+    array = nib_img.get_fdata(dtype=np.float32)
+
+    affine = nib_img.affine
+    spacing = np.sqrt((affine[:3, :3] ** 2).sum(axis=0))
+    direction = LPS_TO_RAS @ (affine[:3, :3] / spacing)
+    origin = LPS_TO_RAS @ affine[:3, 3]
+
+    return ants.from_numpy(array, origin=tuple(origin), spacing=tuple(spacing), direction=direction)
+
+
+def ants_to_nib(ants_img: ants.ANTsImage) -> nib.Nifti1Image:
+    array = ants_img.numpy().astype(np.float32, copy=False)
+
+    spacing = np.array(ants_img.spacing)
+    origin = np.array(ants_img.origin)
+    direction = np.array(ants_img.direction).reshape(3, 3)
+
+    affine = np.eye(4)
+    affine[:3, :3] = LPS_TO_RAS @ direction * spacing
+    affine[:3, 3] = LPS_TO_RAS @ origin
+
+    nib_img = nib.Nifti1Image(array, affine)
+    nib_img.set_qform(affine, code=1)
+    nib_img.set_sform(affine, code=1)
+    return nib_img
+
+
+def sitk_to_ants(sitk_image: sitk.Image) -> ants.ANTsImage:
+    # SimpleITK et ANTs partagent la convention LPS : seul l'ordre des axes du tableau change
+    array = sitk.GetArrayViewFromImage(sitk_image).transpose(2, 1, 0).astype(np.float32)
+    direction = np.array(sitk_image.GetDirection()).reshape(3, 3)
+    return ants.from_numpy(array, origin=sitk_image.GetOrigin(), spacing=sitk_image.GetSpacing(), direction=direction)
+
+
+def _nib_to_ants_via_file(nib_img: nib.Nifti1Image) -> ants.ANTsImage:
     with tempfile.NamedTemporaryFile(suffix=".nii.gz", delete=False) as tmp_file:
         tmp_path = tmp_file.name
         nib.save(nib_img, str(tmp_path))
@@ -53,7 +95,7 @@ def nib_to_ants(nib_img: nib.Nifti1Image) -> ants.ANTsImage:
     return ants_img
 
 
-def ants_to_nib(ants_img: ants.ANTsImage) -> nib.Nifti1Image:
+def _ants_to_nib_via_file(ants_img: ants.ANTsImage) -> nib.Nifti1Image:
     with tempfile.NamedTemporaryFile(suffix=".nii.gz", delete=False) as tmp_file:
         tmp_path = tmp_file.name
         ants.image_write(ants_img, tmp_path)
@@ -68,8 +110,72 @@ def ants_to_nib(ants_img: ants.ANTsImage) -> nib.Nifti1Image:
 
     return nib.Nifti1Image(data, affine, header)
 
-image_path = "data/processed/Agathe/PET_baseline.nii.gz"
-ants_image = ants.image_read(image_path)
-nib_image = ants_to_nib(ants_image)
 
+def check_ants_conversion_parity(nib_img: nib.Nifti1Image, atol: float = 1e-4) -> bool:
+    """Compare les conversions en mémoire avec l'ancien aller-retour par fichier temporaire."""
+    in_memory = nib_to_ants(nib_img)
+    via_file = _nib_to_ants_via_file(nib_img)
+
+    checks = {
+        "array": np.allclose(in_memory.numpy(), via_file.numpy(), atol=atol),
+        "spacing": np.allclose(in_memory.spacing, via_file.spacing, atol=atol),
+        "origin": np.allclose(in_memory.origin, via_file.origin, atol=atol),
+        "direction": np.allclose(in_memory.direction, via_file.direction, atol=atol),
+    }
+
+    back_in_memory = ants_to_nib(via_file)
+    back_via_file = _ants_to_nib_via_file(via_file)
+    checks["back_array"] = np.allclose(back_in_memory.get_fdata(), back_via_file.get_fdata(), atol=atol)
+    checks["back_affine"] = np.allclose(back_in_memory.affine, back_via_file.affine, atol=atol)
+
+    for name, ok in checks.items():
+        if not ok:
+            logger.error(f"ANTs conversion parity check failed on: {name}")
+    return all(checks.values())
+
+
+def benchmark_ants_conversion(nib_img: nib.Nifti1Image, repeats: int = 5) -> dict:
+    timings = {}
+    ants_img = nib_to_ants(nib_img)
+    for name, func, arg in [
+        ("nib_to_ants", nib_to_ants, nib_img),
+        ("nib_to_ants_via_file", _nib_to_ants_via_file, nib_img),
+        ("ants_to_nib", ants_to_nib, ants_img),
+        ("ants_to_nib_via_file", _ants_to_nib_via_file, ants_img),
+    ]:
+        start_time = time.perf_counter()
+        for _ in range(repeats):
+            func(arg)
+        timings[name] = (time.perf_counter() - start_time) / repeats
+        logger.info(f"{name}: {timings[name] * 1000:.1f} ms")
+    return timings
+
+
+def synthetic_nifti(shape=(192, 192, 320), spacing=(2.04, 2.04, 3.27), seed: int = 0) -> nib.Nifti1Image:
+    """Volume aléatoire à la géométrie non triviale : axes obliques, voxels anisotropes et
+    orientation LPS (deux premiers axes inversés), comme un PET exporté par le scanner."""
+    angle_z, angle_x = np.radians(12.0), np.radians(-7.0)
+    rotation_z = np.array([[np.cos(angle_z), -np.sin(angle_z), 0], [np.sin(angle_z), np.cos(angle_z), 0], [0, 0, 1]])
+    rotation_x = np.array([[1, 0, 0], [0, np.cos(angle_x), -np.sin(angle_x)], [0, np.sin(angle_x), np.cos(angle_x)]])
 
+    affine = np.eye(4)
+    affine[:3, :3] = LPS_TO_RAS @ rotation_z @ rotation_x * np.asarray(spacing)
+    affine[:3, 3] = (183.4, 201.7, -912.5)
+
+    data = np.random.default_rng(seed).random(shape, dtype=np.float32) * 20.0
+    nib_img = nib.Nifti1Image(data, affine)
+    nib_img.set_qform(affine, code=1)
+    nib_img.set_sform(affine, code=1)
+    return nib_img
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Parity check and micro-benchmark of the in-memory nibabel <-> ANTs converters.")
+    parser.add_argument("image_path", type=str, nargs="?", default=None, help="NIfTI to benchmark on (default: synthetic oblique volume).")
+    parser.add_argument("--repeats", type=int, default=5)
+    args = parser.parse_args()
+
+    nib_image = nib.load(args.image_path) if args.image_path else synthetic_nifti()
+    if check_ants_conversion_parity(nib_image):
+        logger.success("In-memory ANTs conversions match the temp-file round trip.")
+    benchmark_ants_conversion(nib_image, repeats=args.repeats)
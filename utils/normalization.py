@@ -6,6 +6,8 @@ import nibabel as nib
 from pathlib import Path
 from loguru import logger
 
+from chunked_store import save_chunked
+
 
 def load_pet_metadata(json_file: Path) -> tuple[float, float]:
     with open(json_file, 'r') as f:
@@ -22,15 +24,22 @@ def load_pet_metadata(json_file: Path) -> tuple[float, float]:
     return weight_kg, dose_bq
 
 
-def save_image(array: np.ndarray, affine, header, output_path: Path):
+STORAGES = ("nifti", "zarr")
+
+
+def save_image(array: np.ndarray, affine, header, output_path: Path, storage: str = "nifti"):
+    # "zarr" : blocs 64³ compressés (utils/chunked_store.py), écrits à côté sous <nom>.zarr
+    if storage == "zarr":
+        save_chunked(array, affine, header, output_path)
+        return
+    if storage != "nifti":
+        raise ValueError(f"Unknown storage '{storage}'. Must be one of {list(STORAGES)}.")
     nifti_img = nib.Nifti1Image(array.astype(np.float32), affine, header)
     nib.save(nifti_img, str(output_path))
     logger.info(f"Image saved to: {output_path}")
 
 
-def convert_pet_to_suv(pet_image: nib.Nifti1Image, weight_kg: float, dose_bq: float) -> nib.Nifti1Image:
-    logger.info("Computing SUV from PET image...")
-
+def suv_factor(weight_kg: float, dose_bq: float) -> float:
     if weight_kg == 0.0:
         logger.error("Invalid patient weight: cannot be zero.")
         raise ValueError("Patient weight must be non-zero to compute SUV.")
@@ -41,16 +50,110 @@ def convert_pet_to_suv(pet_image: nib.Nifti1Image, weight_kg: float, dose_bq: fl
     dose_mbq = dose_bq / 1_000_000  # Convert Bq to MBq
     weight_g = weight_kg * 1000     # Convert kg to g
 
-    suv_factor = dose_mbq / weight_g
+    return dose_mbq / weight_g
+
+
+def convert_pet_to_suv(pet_image: nib.Nifti1Image, weight_kg: float, dose_bq: float) -> nib.Nifti1Image:
+    logger.info("Computing SUV from PET image...")
 
     pet_data = pet_image.get_fdata()
-    suv_data = pet_data * suv_factor
+    suv_data = pet_data * suv_factor(weight_kg, dose_bq)
 
     return nib.Nifti1Image(suv_data.astype(np.float32), pet_image.affine, pet_image.header)
 
 
+def _chunk_slices(length: int, chunk_size: int):
+    for start in range(0, length, chunk_size):
+        yield slice(start, min(start + chunk_size, length))
+
+
+def _apply_chunked(data: np.ndarray, out: np.ndarray, func, chunk_size: int) -> np.ndarray:
+    # Bloc par bloc le long du premier axe : seuls des temporaires de la taille d'un bloc sont alloués
+    if out is None:
+        out = data
+    for chunk in _chunk_slices(data.shape[0], chunk_size):
+        block = np.array(data[chunk], dtype=np.float32)
+        func(block)
+        out[chunk] = block
+    return out
+
+
+def histogram_quantile(hist: np.ndarray, edges: np.ndarray, q: float) -> float:
+    """Quantile (0-100) estimé à partir d'un histogramme ; erreur bornée par la largeur d'un bin."""
+    cumulative = np.cumsum(hist, dtype=np.float64)
+    target = q / 100.0 * cumulative[-1]
+    i = int(np.searchsorted(cumulative, target, side="left"))
+    i = min(i, len(hist) - 1)
+    below = cumulative[i - 1] if i > 0 else 0.0
+    fraction = (target - below) / hist[i] if hist[i] > 0 else 0.0
+    return float(edges[i] + fraction * (edges[i + 1] - edges[i]))
+
+
+def streaming_minmax(data: np.ndarray, chunk_size: int = 16) -> tuple[float, float]:
+    min_val, max_val = np.inf, -np.inf
+    for chunk in _chunk_slices(data.shape[0], chunk_size):
+        block = data[chunk]
+        min_val = min(min_val, float(block.min()))
+        max_val = max(max_val, float(block.max()))
+    return min_val, max_val
+
+
+def streaming_percentile(data: np.ndarray, q: float, bins: int = 4096, chunk_size: int = 16) -> float:
+    """Percentile en deux passes par blocs (min/max puis histogramme), sans tri ni copie du volume."""
+    min_val, max_val = streaming_minmax(data, chunk_size)
+    if max_val <= min_val:
+        return min_val
+
+    hist = np.zeros(bins, dtype=np.int64)
+    for chunk in _chunk_slices(data.shape[0], chunk_size):
+        hist += np.histogram(data[chunk], bins=bins, range=(min_val, max_val))[0]
+    edges = np.linspace(min_val, max_val, bins + 1)
+    return histogram_quantile(hist, edges, q)
+
 
-def normalize_suv_image(suv_image: nib.Nifti1Image, mode: str = "scale", scale_max: float = 20.0) -> nib.Nifti1Image:
+def convert_pet_to_suv_array(pet_data: np.ndarray, weight_kg: float, dose_bq: float, out: np.ndarray = None, chunk_size: int = 16) -> np.ndarray:
+    factor = np.float32(suv_factor(weight_kg, dose_bq))
+    return _apply_chunked(pet_data, out, lambda block: np.multiply(block, factor, out=block), chunk_size)
+
+
+def normalize_suv_array(suv_data: np.ndarray, mode: str = "scale", scale_max: float = 20.0, out: np.ndarray = None, chunk_size: int = 16, percentile_bins: int = 4096, stats: dict = None) -> np.ndarray:
+    """Variante de normalize_suv_image en float32, par blocs et sans copie pleine taille.
+
+    Sans `out`, le tableau est normalisé sur place ; avec `out`, l'entrée peut être un memmap
+    en lecture seule. En mode percentile, le p99 est estimé par histogramme (`percentile_bins`
+    bins, erreur inférieure à un bin) ; `percentile_bins=None` garde le calcul exact.
+    `stats` (utils/volume_stats.py, par volume ou cohorte) évite toute passe de statistiques.
+    """
+    if mode == "scale":
+        upper, offset = scale_max, 0.0
+
+    elif mode == "percentile":
+        if stats is not None:
+            upper = stats["quantiles"]["99"]
+        elif percentile_bins is None:
+            upper = float(np.percentile(suv_data, 99))
+        else:
+            upper = streaming_percentile(suv_data, 99, bins=percentile_bins, chunk_size=chunk_size)
+        offset = 0.0
+
+    elif mode == "minmax":
+        min_val, max_val = (stats["min"], stats["max"]) if stats is not None else streaming_minmax(suv_data, chunk_size)
+        if max_val - min_val > 0:
+            return _apply_chunked(suv_data, out, lambda block: np.divide(np.subtract(block, min_val, out=block), max_val - min_val, out=block), chunk_size)
+        logger.warning("SUV image has constant value; skipping normalization.")
+        return _apply_chunked(suv_data, out, lambda block: block.fill(0), chunk_size)
+
+    else:
+        raise ValueError(f"Unknown normalization mode: {mode}")
+
+    def normalize_block(block):
+        np.clip(block, offset, upper, out=block)
+        block /= upper
+
+    return _apply_chunked(suv_data, out, normalize_block, chunk_size)
+
+
+def normalize_suv_image(suv_image: nib.Nifti1Image, mode: str = "scale", scale_max: float = 20.0, stats: dict = None) -> nib.Nifti1Image:
 
     logger.info(f"Normalizing SUV image with mode: {mode}")
     suv_data = suv_image.get_fdata()
@@ -60,13 +163,16 @@ def normalize_suv_image(suv_image: nib.Nifti1Image, mode: str = "scale", scale_m
         suv_data = suv_data / scale_max
 
     elif mode == "percentile":
-        p99 = np.percentile(suv_data, 99)
+        p99 = stats["quantiles"]["99"] if stats is not None else np.percentile(suv_data, 99)
         suv_data = np.clip(suv_data, 0, p99)
         suv_data = suv_data / p99
 
     elif mode == "minmax":
-        min_val = suv_data.min()
-        max_val = suv_data.max()
+        if stats is not None:
+            min_val, max_val = stats["min"], stats["max"]
+        else:
+            min_val = suv_data.min()
+            max_val = suv_data.max()
         if max_val - min_val > 0:
             suv_data = (suv_data - min_val) / (max_val - min_val)
         else:
@@ -79,6 +185,14 @@ def normalize_suv_image(suv_image: nib.Nifti1Image, mode: str = "scale", scale_m
     return nib.Nifti1Image(suv_data.astype(np.float32), suv_image.affine, suv_image.header)
 
 
+def normalize_ct_array(ct_data: np.ndarray, clip_min: int = -200, clip_max: int = 300, out: np.ndarray = None, chunk_size: int = 16) -> np.ndarray:
+    def normalize_block(block):
+        np.clip(block, clip_min, clip_max, out=block)
+        block -= clip_min
+        block /= (clip_max - clip_min)
+
+    return _apply_chunked(ct_data, out, normalize_block, chunk_size)
+
 
 def normalize_ct_image(ct_image: nib.Nifti1Image, clip_min: int = -200, clip_max: int = 300) -> nib.Nifti1Image:
     logger.info(f"Normalizing CT image with windowing [{clip_min}, {clip_max}]")
@@ -87,4 +201,4 @@ def normalize_ct_image(ct_image: nib.Nifti1Image, clip_min: int = -200, clip_max
     ct_data = np.clip(ct_data, clip_min, clip_max)
     ct_data = (ct_data - clip_min) / (clip_max - clip_min)
 
-    return nib.Nifti1Image(ct_data.astype(np.float32), ct_image.affine, ct_image.header)
\ No newline at end of file
+    return nib.Nifti1Image(ct_data.astype(np.float32), ct_image.affine, ct_image.header)
@@ -1,30 +1,62 @@
 import random
+import numpy as np
 import torch
 from typing import Tuple
 from loguru import logger
+from utils.profiling import profile_stage
 
 
-def get_random_patch(input_tensor: torch.Tensor, target_tensor: torch.Tensor, patch_size: Tuple[int, int, int]) -> Tuple[torch.Tensor, torch.Tensor]:
+def _check_patch_size(shape, patch_size: Tuple[int, int, int]):
     pd, ph, pw = patch_size
-    _, D, H, W = input_tensor.shape
+    _, D, H, W = shape
 
     if D < pd or H < ph or W < pw:
         logger.error(f"Volume trop petit pour un patch de taille {patch_size} (volume: {(D, H, W)})")
         raise ValueError("Patch size is too large for the given volume.")
 
-    margin_d, margin_h, margin_w = pd // 2, ph // 2, pw // 2
-    center_d = random.randint(margin_d, D - margin_d - 1)
-    center_h = random.randint(margin_h, H - margin_h - 1)
-    center_w = random.randint(margin_w, W - margin_w - 1)
 
-    d0 = center_d - margin_d
-    h0 = center_h - margin_h
-    w0 = center_w - margin_w
+def crop_patch(input_tensor: torch.Tensor, target_tensor: torch.Tensor, center: Tuple[int, int, int], patch_size: Tuple[int, int, int]) -> Tuple[torch.Tensor, torch.Tensor]:
+    pd, ph, pw = patch_size
+    d0 = center[0] - pd // 2
+    h0 = center[1] - ph // 2
+    w0 = center[2] - pw // 2
 
-    
     input_patch = input_tensor[:, d0:d0 + pd, h0:h0 + ph, w0:w0 + pw]
     target_patch = target_tensor[:, d0:d0 + pd, h0:h0 + ph, w0:w0 + pw]
-    print(input_tensor.shape, target_tensor.shape)
-    print(target_patch.shape, input_patch.shape)
-
     return input_patch, target_patch
+
+
+def get_random_patch(input_tensor: torch.Tensor, target_tensor: torch.Tensor, patch_size: Tuple[int, int, int]) -> Tuple[torch.Tensor, torch.Tensor]:
+    pd, ph, pw = patch_size
+    _, D, H, W = input_tensor.shape
+    _check_patch_size(input_tensor.shape, patch_size)
+
+    with profile_stage("patch.get_random_patch"):
+        margin_d, margin_h, margin_w = pd // 2, ph // 2, pw // 2
+        center_d = random.randint(margin_d, D - margin_d - 1)
+        center_h = random.randint(margin_h, H - margin_h - 1)
+        center_w = random.randint(margin_w, W - margin_w - 1)
+
+        return crop_patch(input_tensor, target_tensor, (center_d, center_h, center_w), patch_size)
+
+
+def get_weighted_patch(input_tensor: torch.Tensor, target_tensor: torch.Tensor, patch_size: Tuple[int, int, int], sampling_index: dict) -> Tuple[torch.Tensor, torch.Tensor]:
+    """Tire un centre selon la distribution précalculée (voir utils/sampling_index.py), en O(log n)."""
+    _check_patch_size(input_tensor.shape, patch_size)
+    if tuple(int(s) for s in sampling_index["shape"]) != tuple(input_tensor.shape[1:]):
+        # Index construit sur un autre volume (prétraitement relancé depuis) : ses centres ne sont plus valides
+        logger.error(f"Sampling index shape {tuple(sampling_index['shape'])} does not match volume shape {tuple(input_tensor.shape[1:])}")
+        raise ValueError("Stale sampling index; rebuild it with utils/sampling_index.py.")
+
+    with profile_stage("patch.get_weighted_patch"):
+        centres = sampling_index["centres"]
+        stride = int(sampling_index["stride"])
+        i = min(int(np.searchsorted(sampling_index["cdf"], random.random(), side="right")), len(centres) - 1)
+
+        center = []
+        for axis, size in enumerate(input_tensor.shape[1:]):
+            margin = patch_size[axis] // 2
+            coord = int(centres[i, axis]) + random.randrange(stride)
+            center.append(min(max(coord, margin), size - margin - 1))
+
+        return crop_patch(input_tensor, target_tensor, center, patch_size)
@@ -1,4 +1,5 @@
 import os
+import json
 import nibabel as nib
 import numpy as np
 from pathlib import Path
@@ -18,9 +19,88 @@ ORGANS_THRESHOLDS = {
     "colon": 3.5,
 }
 
+# Étiquettes 1..N dans l'ordre de ORGANS_THRESHOLDS, 0 = fond
+ORGAN_LABELS = {organ: label for label, organ in enumerate(ORGANS_THRESHOLDS, start=1)}
+LABEL_MAP_FILENAME = "organ_labels.nii.gz"
+LABEL_MAP_SIDECAR = "organ_labels.json"
+# Dossier des masques TotalSegmentator dans chaque patient, tel qu'écrit par utils/ct_segmentor.py.py
+SEGMENTATION_SUBDIR = "segmentation_output"
 
-def generate_physiological_mask(ct_path: Path, mask_dir: Path) -> nib.Nifti1Image:
+
+def _label_map_sources(mask_dir: Path) -> dict:
+    # (mtime_ns, taille) de chaque masque source : une nouvelle segmentation invalide la carte en cache
+    sources = {}
+    for organ in ORGAN_LABELS:
+        organ_path = mask_dir / f"{organ}.nii.gz"
+        if organ_path.exists():
+            stat = organ_path.stat()
+            sources[organ] = [stat.st_mtime_ns, stat.st_size]
+    return sources
+
+
+def build_organ_label_map(mask_dir: Path, overwrite: bool = False) -> nib.Nifti1Image:
+    """Fusionne une fois les masques TotalSegmentator en une carte d'étiquettes uint8,
+    mise en cache à côté de la segmentation.
+
+    Les organes de TotalSegmentator ne se chevauchent pas ; en cas de recouvrement,
+    l'organe le plus loin dans ORGANS_THRESHOLDS l'emporte. La carte est reconstruite si
+    la liste des organes ou l'un des masques sources (mtime, taille) a changé.
+    """
+    label_path = mask_dir / LABEL_MAP_FILENAME
+    sidecar_path = mask_dir / LABEL_MAP_SIDECAR
+    sidecar = {"labels": ORGAN_LABELS, "sources": _label_map_sources(mask_dir)}
+
+    if label_path.exists() and sidecar_path.exists() and not overwrite:
+        with open(sidecar_path, "r") as f:
+            if json.load(f) == sidecar:
+                return nib.load(label_path)
+        logger.info(f"Organ list or masks changed since {label_path.name} was built; rebuilding.")
+
+    labels = None
+    reference = None
+    for organ, label in ORGAN_LABELS.items():
+        organ_path = mask_dir / f"{organ}.nii.gz"
+        if not organ_path.exists():
+            logger.warning(f"Missing mask for organ: {organ} -> {organ_path}")
+            continue
+        organ_image = nib.load(organ_path)
+        if labels is None:
+            labels = np.zeros(organ_image.shape, dtype=np.uint8)
+            reference = organ_image
+        # dataobj lu dans son type natif (uint8) : pas de copie float64
+        labels[np.asanyarray(organ_image.dataobj) > 0] = label
+
+    if labels is None:
+        logger.error(f"No organ masks found in {mask_dir}")
+        raise FileNotFoundError(f"No organ masks found in {mask_dir}")
+
+    label_image = nib.Nifti1Image(labels, reference.affine, reference.header)
+    label_image.set_data_dtype(np.uint8)
+    label_image.header["scl_slope"] = 1.0
+    label_image.header["scl_inter"] = 0.0
+
+    tmp_path = mask_dir / f".tmp-{LABEL_MAP_FILENAME}"
+    nib.save(label_image, tmp_path)
+    os.replace(tmp_path, label_path)
+    with open(sidecar_path, "w") as f:
+        json.dump(sidecar, f, indent=4)
+
+    logger.info(f"Built organ label map with {len(ORGAN_LABELS)} organs: {label_path}")
+    return label_image
+
+
+def load_organ_labels(mask_dir: Path) -> np.ndarray:
+    return np.asanyarray(build_organ_label_map(mask_dir).dataobj)
+
+
+def generate_physiological_mask(ct_path: Path, mask_dir: Path, use_label_map: bool = True) -> nib.Nifti1Image:
     ct_image = nib.load(ct_path)
+
+    if use_label_map:
+        mask = (load_organ_labels(mask_dir) > 0).astype(np.uint8)
+        logger.info(f"Generated combined physiological mask for: {ct_path.name}")
+        return nib.Nifti1Image(mask, ct_image.affine, ct_image.header)
+
     mask = np.zeros(ct_image.shape, dtype=np.uint8)
 
     for organ in ORGANS_THRESHOLDS:
@@ -41,15 +121,35 @@ def save_mask_image(mask_image: nib.Nifti1Image, output_path: Path):
     logger.success(f"Saved physiological mask to: {output_path}")
 
 
-def suppress_physiological_uptake_on_pet(pet_path: Path, mask_dir: Path, output_path: Path):
+def suppress_physiological_uptake_on_pet(pet_path: Path, mask_dir: Path, output_path: Path, use_label_map: bool = True, mean_noise: float = None):
+    # `mean_noise` : sinon "background_noise_mean" du fichier annexe du PET (utils/volume_stats.py), sinon estimée ici
     logger.info(f"Applying physiological suppression on PET: {pet_path.name}")
     tep_image = nib.load(pet_path)
-    tep_data = tep_image.get_fdata()
-
-    filtered_voxels = tep_data[(tep_data > 0) & (tep_data <= 20)]
-    mean_noise = np.mean(filtered_voxels)
+    tep_data = tep_image.get_fdata(dtype=np.float32) if use_label_map else tep_image.get_fdata()
+
+    if mean_noise is None:
+        # Import local : le module est aussi importé en utils.physiological_masking (evaluation/), sans les modules voisins
+        from volume_stats import find_volume_stats
+        stats = find_volume_stats(pet_path)
+        if stats is not None:
+            mean_noise = stats["background_noise_mean"]
+    if mean_noise is None:
+        filtered_voxels = tep_data[(tep_data > 0) & (tep_data <= 20)]
+        mean_noise = np.mean(filtered_voxels, dtype=np.float64)
     logger.debug(f"Estimated physiological noise: {mean_noise:.3f}")
 
+    if use_label_map:
+        # Une seule lecture des étiquettes puis une passe vectorisée : divisor_lut[labels]
+        divisor_lut = np.ones(len(ORGAN_LABELS) + 1, dtype=np.float32)
+        for organ, label in ORGAN_LABELS.items():
+            divisor_lut[label] = ORGANS_THRESHOLDS[organ] * mean_noise
+        tep_data /= divisor_lut[load_organ_labels(mask_dir)]
+
+        masked_img = nib.Nifti1Image(tep_data, tep_image.affine, tep_image.header)
+        nib.save(masked_img, output_path)
+        logger.success(f"Saved PET with physiological uptake suppressed to: {output_path}")
+        return
+
     for organ, divisor in ORGANS_THRESHOLDS.items():
         organ_path = mask_dir / f"{organ}.nii.gz"
         if not organ_path.exists():
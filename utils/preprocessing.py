@@ -1,21 +1,66 @@
 from pathlib import Path
+import os
 import re
+import time
+import shutil
+import argparse
+from concurrent.futures import ProcessPoolExecutor, as_completed
+import numpy as np
 import nibabel as nib
+import SimpleITK as sitk
 from tqdm import tqdm
 from loguru import logger
 
-from resampling import change_spacing, resample_like
-from registration import register_image_to_reference
+from resampling import change_spacing, resample_like, isotropic_grid, resample_sitk
+from image_conversion import LPS_TO_RAS
+from registration import register_image_to_reference, estimate_transform, set_registration_threads, REGISTRATION_MODES
 from normalization import (
     convert_pet_to_suv,
     save_image,
+    STORAGES,
     normalize_ct_image,
     normalize_suv_image,
     load_pet_metadata,
+    convert_pet_to_suv_array,
+    normalize_ct_array,
+    normalize_suv_array,
+    suv_factor,
 )
+from volume_stats import COHORT_STATS_FILENAME, find_volume_stats, load_cohort_stats
+from sampling_index import SAMPLING_INDEX_FILENAME, build_sampling_index, save_sampling_index
+from chunked_store import CHUNKED_SUFFIX, save_chunked
 
 
-def preprocess_patient(pet_baseline_path: Path, ct_baseline_path: Path, pet_normal_path: Path, metadata_json_path: Path, output_dir: Path):
+REQUIRED_FILES = {
+    "PET_baseline_preprocessed.nii.gz",
+    "PET_normal_preprocessed.nii.gz",
+    "CT_baseline_preprocessed.nii.gz"
+}
+COMPLETION_MARKER = ".complete"
+TRANSFORM_CACHE_SUFFIX = "_transform_cache"
+SUV_MODES = ("scale", "percentile", "minmax")
+
+
+def suv_normalization_stats(pet_path: Path, weight_kg: float, dose_bq: float, suv_mode: str = "scale", cohort_stats: dict = None) -> dict:
+    """Statistiques SUV précalculées (utils/volume_stats.py) pour normaliser `pet_path` sans le relire.
+
+    Statistiques de la cohorte si fournies, sinon le fichier annexe du PET converti s'il a été
+    calculé en SUV avec le même facteur ; None sinon (les statistiques sont alors recalculées).
+    Elles décrivent le volume avant rééchantillonnage : l'interpolation linéaire garde min/max
+    dans les mêmes bornes, le p99 reste une approximation.
+    """
+    if suv_mode == "scale":
+        return None
+    if cohort_stats is not None:
+        return cohort_stats
+    stats = find_volume_stats(pet_path, scale=suv_factor(weight_kg, dose_bq))
+    if stats is None:
+        logger.info(f"No SUV statistics for {pet_path.name}; computing them during normalization.")
+    return stats
+
+
+def preprocess_patient(pet_baseline_path: Path, ct_baseline_path: Path, pet_normal_path: Path, metadata_json_path: Path, output_dir: Path, registration_mode: str = "full", transform_cache_dir: Path = None, storage: str = "nifti",
+                       suv_mode: str = "scale", cohort_stats: dict = None):
     pet_baseline = nib.load(pet_baseline_path)
     pet_normal = nib.load(pet_normal_path)   
     ct_baseline = nib.load(ct_baseline_path)
@@ -24,7 +69,7 @@ def preprocess_patient(pet_baseline_path: Path, ct_baseline_path: Path, pet_norm
     pet_normal_iso = change_spacing(pet_normal, new_spacing=1.5, interpolator="linear")
     ct_baseline_iso = change_spacing(ct_baseline, new_spacing=1.5, interpolator="linear", default_pixel_value=-1000)
 
-    pet_normal_aligned = register_image_to_reference(pet_normal_iso, pet_baseline_iso, transform_type="Rigid")
+    pet_normal_aligned = register_image_to_reference(pet_normal_iso, pet_baseline_iso, transform_type="Rigid", mode=registration_mode, cache_dir=transform_cache_dir)
 
     ct_baseline_resampled = resample_like(ct_baseline_iso, pet_baseline_iso, interpolator="linear", default_pixel_value=-1000)
     pet_normal_resampled = resample_like(pet_normal_aligned, pet_baseline_iso, interpolator="linear")
@@ -34,19 +79,91 @@ def preprocess_patient(pet_baseline_path: Path, ct_baseline_path: Path, pet_norm
     suv_normal = convert_pet_to_suv(pet_normal_resampled, weight_kg, dose_bq)
 
     ct_baseline_normalized = normalize_ct_image(ct_baseline_resampled, clip_min=-200, clip_max=300)
-    suv_baseline_normalized = normalize_suv_image(suv_baseline, mode="scale", scale_max=20.0)
-    suv_normal_normalized = normalize_suv_image(suv_normal, mode="scale", scale_max=20.0)
+    baseline_stats = suv_normalization_stats(pet_baseline_path, weight_kg, dose_bq, suv_mode, cohort_stats)
+    normal_stats = suv_normalization_stats(pet_normal_path, weight_kg, dose_bq, suv_mode, cohort_stats)
+    suv_baseline_normalized = normalize_suv_image(suv_baseline, mode=suv_mode, scale_max=20.0, stats=baseline_stats)
+    suv_normal_normalized = normalize_suv_image(suv_normal, mode=suv_mode, scale_max=20.0, stats=normal_stats)
 
     reset_nifti_scaling(ct_baseline_normalized)
     reset_nifti_scaling(suv_baseline_normalized)
     reset_nifti_scaling(suv_normal_normalized)
 
-    save_image(ct_baseline_normalized.get_fdata(), ct_baseline_normalized.affine, ct_baseline_normalized.header, output_dir / "CT_baseline_preprocessed.nii.gz")
-    save_image(suv_baseline_normalized.get_fdata(), suv_baseline_normalized.affine, suv_baseline_normalized.header, output_dir / "PET_baseline_preprocessed.nii.gz")
-    save_image(suv_normal_normalized.get_fdata(), suv_normal_normalized.affine, suv_normal_normalized.header, output_dir / "PET_normal_preprocessed.nii.gz")
+    save_image(ct_baseline_normalized.get_fdata(), ct_baseline_normalized.affine, ct_baseline_normalized.header, output_dir / "CT_baseline_preprocessed.nii.gz", storage=storage)
+    save_image(suv_baseline_normalized.get_fdata(), suv_baseline_normalized.affine, suv_baseline_normalized.header, output_dir / "PET_baseline_preprocessed.nii.gz", storage=storage)
+    save_image(suv_normal_normalized.get_fdata(), suv_normal_normalized.affine, suv_normal_normalized.header, output_dir / "PET_normal_preprocessed.nii.gz", storage=storage)
+
+    sampling_index = build_sampling_index(suv_baseline_normalized.get_fdata(dtype=np.float32), source="suv")
+    save_sampling_index(sampling_index, output_dir / SAMPLING_INDEX_FILENAME)
+
+
+def save_sitk_array(array: np.ndarray, reference: sitk.Image, output_path: Path, storage: str = "nifti"):
+    if storage == "zarr":
+        # Même disposition que nibabel : tableau en [x,y,z] et affine RAS
+        spacing = np.array(reference.GetSpacing())
+        direction = np.array(reference.GetDirection()).reshape(3, 3)
+        affine = np.eye(4)
+        affine[:3, :3] = LPS_TO_RAS @ (direction * spacing)
+        affine[:3, 3] = LPS_TO_RAS @ np.array(reference.GetOrigin())
+        save_chunked(array.transpose(2, 1, 0), affine, None, output_path)
+        return
+
+    image = sitk.GetImageFromArray(array)
+    image.CopyInformation(reference)
+    sitk.WriteImage(image, str(output_path), useCompression=True)
+    logger.info(f"Image saved to: {output_path}")
+
+
+def preprocess_patient_in_memory(pet_baseline_path: Path, ct_baseline_path: Path, pet_normal_path: Path, metadata_json_path: Path, output_dir: Path, registration_mode: str = "full", transform_cache_dir: Path = None, spacing: float = 1.5, storage: str = "nifti",
+                                 suv_mode: str = "scale", cohort_stats: dict = None):
+    """Même traitement que preprocess_patient, mais les images restent en SimpleITK float32
+    du chargement à l'écriture.
+
+    Chaque image n'est rééchantillonnée qu'une fois : le CT et le PET normal sont projetés
+    directement sur la grille isotrope du PET baseline, le recalage rigide étant appliqué
+    dans la même passe.
+    """
+    pet_baseline = sitk.ReadImage(str(pet_baseline_path), sitk.sitkFloat32)
+    pet_baseline_iso = resample_sitk(pet_baseline, isotropic_grid(pet_baseline, spacing), interpolator="linear")
+    del pet_baseline
+
+    pet_normal = sitk.ReadImage(str(pet_normal_path), sitk.sitkFloat32)
+    transform = estimate_transform(pet_normal, pet_baseline_iso, transform_type="Rigid", mode=registration_mode, cache_dir=transform_cache_dir)
+    pet_normal_resampled = resample_sitk(pet_normal, pet_baseline_iso, transform=transform, interpolator="linear")
+    del pet_normal
+
+    ct_baseline = sitk.ReadImage(str(ct_baseline_path), sitk.sitkFloat32)
+    ct_baseline_resampled = resample_sitk(ct_baseline, pet_baseline_iso, interpolator="linear", default_pixel_value=-1000)
+    del ct_baseline
+
+    weight_kg, dose_bq = load_pet_metadata(metadata_json_path)
+
+    # GetArrayFromImage renvoie une copie float32 : toutes les opérations suivantes se font sur place
+    ct_data = normalize_ct_array(sitk.GetArrayFromImage(ct_baseline_resampled), clip_min=-200, clip_max=300)
+    save_sitk_array(ct_data, pet_baseline_iso, output_dir / "CT_baseline_preprocessed.nii.gz", storage=storage)
+    del ct_data, ct_baseline_resampled
+
+    suv_normal = convert_pet_to_suv_array(sitk.GetArrayFromImage(pet_normal_resampled), weight_kg, dose_bq)
+    normal_stats = suv_normalization_stats(pet_normal_path, weight_kg, dose_bq, suv_mode, cohort_stats)
+    save_sitk_array(normalize_suv_array(suv_normal, mode=suv_mode, scale_max=20.0, stats=normal_stats), pet_baseline_iso, output_dir / "PET_normal_preprocessed.nii.gz", storage=storage)
+    del suv_normal, pet_normal_resampled
+
+    suv_baseline = convert_pet_to_suv_array(sitk.GetArrayFromImage(pet_baseline_iso), weight_kg, dose_bq)
+    normalize_suv_array(suv_baseline, mode=suv_mode, scale_max=20.0, stats=suv_normalization_stats(pet_baseline_path, weight_kg, dose_bq, suv_mode, cohort_stats))
+    save_sitk_array(suv_baseline, pet_baseline_iso, output_dir / "PET_baseline_preprocessed.nii.gz", storage=storage)
 
+    # Tableau SimpleITK en [z,y,x] : l'index d'échantillonnage est construit en [x,y,z] comme nibabel
+    sampling_index = build_sampling_index(suv_baseline.transpose(2, 1, 0), source="suv")
+    save_sampling_index(sampling_index, output_dir / SAMPLING_INDEX_FILENAME)
 
-def preprocess_patient_from_dir(patient_dir: Path, output_dir: Path):
+
+PIPELINES = {
+    "nibabel": preprocess_patient,
+    "sitk": preprocess_patient_in_memory,
+}
+
+
+def preprocess_patient_from_dir(patient_dir: Path, output_dir: Path, pipeline: str = "nibabel", registration_mode: str = "full", transform_cache_dir: Path = None, storage: str = "nifti",
+                                suv_mode: str = "scale", cohort_stats: dict = None):
     logger.info(f"Launching preprocessing for patient: {patient_dir.name}")
     
     pet_baseline_path = patient_dir / "PET_baseline.nii.gz"
@@ -59,38 +176,103 @@ def preprocess_patient_from_dir(patient_dir: Path, output_dir: Path):
             logger.error(f"Missing file: {file_path}")
             raise FileNotFoundError(f"Expected file not found: {file_path}")
 
-    preprocess_patient(pet_baseline_path, ct_baseline_path, pet_normal_path, metadata_path, output_dir)
+    if pipeline not in PIPELINES:
+        raise ValueError(f"Unknown pipeline '{pipeline}'. Must be one of {list(PIPELINES)}.")
+
+    PIPELINES[pipeline](
+        pet_baseline_path, ct_baseline_path, pet_normal_path, metadata_path, output_dir, registration_mode=registration_mode,
+        transform_cache_dir=transform_cache_dir, storage=storage, suv_mode=suv_mode, cohort_stats=cohort_stats,
+    )
     logger.info(f"Successfully preprocessing for patient {patient_dir.name}")
 
 
-def preprocess_all_patients(root_processed_dir: Path, output_dir: Path = None):
+def is_patient_complete(patient_processed_dir: Path) -> bool:
+    if not (patient_processed_dir / COMPLETION_MARKER).exists():
+        return False
+    # Sorties .nii.gz ou .zarr selon le stockage choisi
+    outputs = {f.name.replace(CHUNKED_SUFFIX, ".nii.gz") for f in patient_processed_dir.iterdir()}
+    return REQUIRED_FILES.issubset(outputs)
+
+
+def preprocess_patient_atomic(patient_dir: Path, output_dir: Path, pipeline: str = "nibabel", registration_mode: str = "full", transform_cache_dir: Path = None, storage: str = "nifti",
+                              suv_mode: str = "scale", cohort_stats: dict = None) -> Path:
+    # Écrit dans un dossier temporaire puis renomme : un crash ne laisse jamais de dossier patient à moitié écrit
+    patient_processed_dir = output_dir / patient_dir.name
+    tmp_dir = output_dir / f".{patient_dir.name}.tmp"
+    if tmp_dir.exists():
+        shutil.rmtree(tmp_dir)
+    tmp_dir.mkdir(parents=True)
+
+    preprocess_patient_from_dir(patient_dir, tmp_dir, pipeline=pipeline, registration_mode=registration_mode, transform_cache_dir=transform_cache_dir, storage=storage, suv_mode=suv_mode, cohort_stats=cohort_stats)
+    (tmp_dir / COMPLETION_MARKER).write_text(time.strftime("%Y-%m-%dT%H:%M:%S"))
+
+    if patient_processed_dir.exists():
+        shutil.rmtree(patient_processed_dir)
+    os.replace(tmp_dir, patient_processed_dir)
+    return patient_processed_dir
+
+
+def _preprocess_patient_job(patient_dir: Path, output_dir: Path, pipeline: str = "nibabel", registration_mode: str = "full", transform_cache_dir: Path = None, storage: str = "nifti",
+                            suv_mode: str = "scale", cohort_stats: dict = None):
+    start_time = time.perf_counter()
+    try:
+        preprocess_patient_atomic(patient_dir, output_dir, pipeline=pipeline, registration_mode=registration_mode, transform_cache_dir=transform_cache_dir, storage=storage, suv_mode=suv_mode, cohort_stats=cohort_stats)
+    except Exception as e:
+        logger.exception(f"Preprocessing failed for patient {patient_dir.name}: {e}")
+        return patient_dir.name, f"{type(e).__name__}: {e}", time.perf_counter() - start_time
+    return patient_dir.name, None, time.perf_counter() - start_time
+
+
+def _init_worker(threads_per_worker: int):
+    os.environ["OMP_NUM_THREADS"] = str(threads_per_worker)
+    set_registration_threads(threads_per_worker)
+
+
+def preprocess_all_patients(root_processed_dir: Path, output_dir: Path = None, workers: int = 1, threads_per_worker: int = None, pipeline: str = "nibabel", registration_mode: str = "full", cache_transforms: bool = True, storage: str = "nifti",
+                            suv_mode: str = "scale", use_cohort_stats: bool = False):
     logger.info(f"Processing all patients in: {root_processed_dir}")
 
     if output_dir is None:
         output_dir = root_processed_dir.parent / "preprocessed"
     output_dir.mkdir(parents=True, exist_ok=True)
 
-    required_files = {
-        "PET_baseline_preprocessed.nii.gz",
-        "PET_normal_preprocessed.nii.gz",
-        "CT_baseline_preprocessed.nii.gz"
-    }
+    # Liste les dossiers patients à traiter (les dossiers cachés sont des sorties temporaires)
+    patient_dirs = [p for p in root_processed_dir.iterdir() if p.is_dir() and not p.name.startswith(".")]
+    pending_dirs = [p for p in patient_dirs if not is_patient_complete(output_dir / p.name)]
+    logger.info(f"{len(patient_dirs) - len(pending_dirs)} patients already complete, {len(pending_dirs)} to process with {workers} worker(s).")
 
-    # Liste les dossiers patients à traiter
-    patient_dirs = [p for p in root_processed_dir.iterdir() if p.is_dir()]
+    # Les transformations estimées sont réutilisées tant que les images d'entrée ne changent pas ;
+    # le cache est rangé à côté du dossier de sortie, pas dedans, pour n'être jamais pris pour un patient
+    transform_cache_dir = output_dir.parent / f"{output_dir.name}{TRANSFORM_CACHE_SUFFIX}" if cache_transforms else None
+    # Normalisation percentile/minmax : statistiques de cohorte (cohort_stats.json) ou fichiers annexes par volume
+    if suv_mode not in SUV_MODES:
+        raise ValueError(f"Unknown SUV normalization mode '{suv_mode}'. Must be one of {list(SUV_MODES)}.")
+    cohort_stats = load_cohort_stats(root_processed_dir) if use_cohort_stats and suv_mode != "scale" else None
+    job_options = (pipeline, registration_mode, transform_cache_dir, storage, suv_mode, cohort_stats)
 
-    for patient_dir in tqdm(patient_dirs, desc="Prétraitement des patients"):
-        patient_processed_dir = output_dir / patient_dir.name
-        patient_processed_dir.mkdir(parents=True, exist_ok=True)
-
-        if required_files.issubset({f.name for f in patient_processed_dir.glob("*.nii.gz")}):
-            continue
-
-        logger.info(f"Preprocessing patient: {patient_dir.name}")
-        preprocess_patient_from_dir(patient_dir, patient_processed_dir)
-
-    logger.info("Full preprocessing completed for all patients.")
+    failures = {}
+    if workers <= 1:
+        if threads_per_worker:
+            _init_worker(threads_per_worker)
+        for patient_dir in tqdm(pending_dirs, desc="Prétraitement des patients"):
+            name, error, _ = _preprocess_patient_job(patient_dir, output_dir, *job_options)
+            if error:
+                failures[name] = error
+    else:
+        threads_per_worker = threads_per_worker or max(1, (os.cpu_count() or 1) // workers)
+        with ProcessPoolExecutor(max_workers=workers, initializer=_init_worker, initargs=(threads_per_worker,)) as executor:
+            futures = [executor.submit(_preprocess_patient_job, patient_dir, output_dir, *job_options) for patient_dir in pending_dirs]
+            for future in tqdm(as_completed(futures), total=len(futures), desc="Prétraitement des patients"):
+                name, error, duration = future.result()
+                if error:
+                    failures[name] = error
+                else:
+                    logger.info(f"Patient {name} preprocessed in {duration:.1f}s")
 
+    if failures:
+        logger.error(f"Preprocessing failed for {len(failures)} patient(s): {', '.join(sorted(failures))}")
+    logger.info(f"Full preprocessing completed: {len(pending_dirs) - len(failures)} processed, {len(failures)} failed.")
+    return failures
 
 
 def reset_nifti_scaling(nifti_img):
@@ -100,4 +282,21 @@ def reset_nifti_scaling(nifti_img):
 
 
 if __name__ == "__main__":
-    preprocess_all_patients(Path("data/processed"))
+    parser = argparse.ArgumentParser(description="Preprocess all patients (resampling, registration, SUV normalization).")
+    parser.add_argument("input_dir", type=Path, nargs="?", default=Path("data/processed"))
+    parser.add_argument("--output-dir", type=Path, default=None)
+    parser.add_argument("--workers", type=int, default=1, help="Number of patients processed in parallel.")
+    parser.add_argument("--threads-per-worker", type=int, default=None, help="ITK/ANTs threads per worker (default: cpu_count // workers).")
+    parser.add_argument("--pipeline", choices=list(PIPELINES), default="nibabel", help="'sitk' keeps images in SimpleITK and resamples each image once.")
+    parser.add_argument("--registration-mode", choices=list(REGISTRATION_MODES), default="full", help="'fast' uses coarser shrink factors and fewer iterations.")
+    parser.add_argument("--no-transform-cache", action="store_true", help="Always re-estimate registrations.")
+    parser.add_argument("--storage", choices=list(STORAGES), default="nifti", help="'zarr' writes 64^3 LZ4-compressed chunks instead of .nii.gz.")
+    parser.add_argument("--suv-mode", choices=list(SUV_MODES), default="scale", help="'percentile' and 'minmax' reuse the .stats.json sidecars from utils/volume_stats.py when present.")
+    parser.add_argument("--cohort-stats", action="store_true", help=f"Normalize with the cohort-wide {COHORT_STATS_FILENAME} instead of per-volume statistics.")
+    args = parser.parse_args()
+
+    preprocess_all_patients(
+        args.input_dir, args.output_dir, workers=args.workers, threads_per_worker=args.threads_per_worker,
+        pipeline=args.pipeline, registration_mode=args.registration_mode, cache_transforms=not args.no_transform_cache, storage=args.storage,
+        suv_mode=args.suv_mode, use_cohort_stats=args.cohort_stats,
+    )
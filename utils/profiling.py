@@ -0,0 +1,117 @@
+import csv
+import json
+import time
+import contextlib
+import numpy as np
+from pathlib import Path
+from collections import defaultdict
+from loguru import logger
+
+
+DATA_WAIT_STAGE = "data_wait"
+_NULL_CONTEXT = contextlib.nullcontext()
+_PROFILER = None
+
+
+class StageProfiler:
+    """Collecte la latence de chaque étape (chargement, extraction de patch, pas D/G...)."""
+
+    def __init__(self, sync=None):
+        self.sync = sync
+        self.reset()
+
+    def reset(self):
+        # Nouvelle fenêtre de mesure (une époque) : latences, échantillons et temps écoulé repartent de zéro
+        self.durations = defaultdict(list)
+        self.num_samples = 0
+        self.start_time = time.perf_counter()
+
+    @contextlib.contextmanager
+    def stage(self, name: str):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            # Sur GPU, on attend la fin des noyaux pour attribuer le temps à la bonne étape
+            if self.sync is not None:
+                self.sync()
+            self.record(name, time.perf_counter() - start)
+
+    def record(self, name: str, seconds: float):
+        self.durations[name].append(seconds)
+
+    def count_samples(self, n: int):
+        self.num_samples += n
+
+    def summary(self) -> dict:
+        elapsed = time.perf_counter() - self.start_time
+        stages = {}
+        for name, values in self.durations.items():
+            values = np.asarray(values)
+            p50, p95, p99 = np.percentile(values, [50, 95, 99])
+            stages[name] = {
+                "count": int(values.size),
+                "total_s": float(values.sum()),
+                "mean_ms": float(values.mean() * 1000),
+                "p50_ms": float(p50 * 1000),
+                "p95_ms": float(p95 * 1000),
+                "p99_ms": float(p99 * 1000),
+            }
+
+        data_wait = stages.get(DATA_WAIT_STAGE, {}).get("total_s", 0.0)
+        return {
+            "elapsed_s": elapsed,
+            "num_samples": self.num_samples,
+            "samples_per_s": self.num_samples / elapsed if elapsed > 0 else 0.0,
+            "data_wait_ratio": data_wait / elapsed if elapsed > 0 else 0.0,
+            "stages": stages,
+        }
+
+    def report(self, output_path: Path = None, label: str = None) -> dict:
+        summary = self.summary()
+        summary["label"] = label
+        logger.info(
+            f"Profiling{f' ({label})' if label else ''}: {summary['samples_per_s']:.2f} samples/s | "
+            f"data wait {summary['data_wait_ratio']:.1%} / compute {1 - summary['data_wait_ratio']:.1%}"
+        )
+        for name, stats in sorted(summary["stages"].items()):
+            logger.info(
+                f"  {name:<28} n={stats['count']:<6} p50={stats['p50_ms']:.1f}ms "
+                f"p95={stats['p95_ms']:.1f}ms p99={stats['p99_ms']:.1f}ms total={stats['total_s']:.1f}s"
+            )
+
+        if output_path is not None:
+            output_path = Path(output_path)
+            output_path.parent.mkdir(parents=True, exist_ok=True)
+            with open(output_path.with_suffix(".json"), "w") as f:
+                json.dump(summary, f, indent=4)
+            with open(output_path.with_suffix(".csv"), "w", newline="") as f:
+                writer = csv.writer(f)
+                writer.writerow(["stage", "count", "total_s", "mean_ms", "p50_ms", "p95_ms", "p99_ms"])
+                for name, stats in sorted(summary["stages"].items()):
+                    writer.writerow([name, stats["count"], stats["total_s"], stats["mean_ms"], stats["p50_ms"], stats["p95_ms"], stats["p99_ms"]])
+        return summary
+
+
+def enable_profiling(sync=None) -> StageProfiler:
+    global _PROFILER
+    _PROFILER = StageProfiler(sync=sync)
+    return _PROFILER
+
+
+def disable_profiling():
+    # Appelé dans les workers du DataLoader : forkés après enable_profiling, ils héritent du profiler
+    # et de sa synchronisation CUDA, interdite dans un processus forké. Leurs mesures ne remonteraient pas.
+    global _PROFILER
+    _PROFILER = None
+
+
+def get_profiler() -> StageProfiler:
+    return _PROFILER
+
+
+def profile_stage(name: str):
+    # Sans profiler actif, un contexte vide partagé : coût négligeable dans les boucles chaudes
+    if _PROFILER is None:
+        return _NULL_CONTEXT
+    return _PROFILER.stage(name)
@@ -1,28 +1,111 @@
+import os
 import ants
 import time
+import shutil
+import hashlib
+import numpy as np
 import nibabel as nib
 from pathlib import Path
 from loguru import logger
-from image_conversion import nib_to_ants, ants_to_nib
+import SimpleITK as sitk
+from image_conversion import nib_to_ants, ants_to_nib, sitk_to_ants
 
 
-def register_image_to_reference(image_source: nib.Nifti1Image, target_image: nib.Nifti1Image, transform_type: str = "Rigid"):
-    moving = nib_to_ants(image_source)
-    fixed = nib_to_ants(target_image)
+LINEAR_TRANSFORMS = ("Translation", "Rigid", "Similarity", "Affine", "QuickRigid", "DenseRigid", "BOLDRigid", "AffineFast", "BOLDAffine")
+
+# Paramètres ants.registration par mode ; "fast" : pyramide plus grossière et moins d'itérations
+REGISTRATION_MODES = {
+    "full": {},
+    "fast": {
+        "aff_shrink_factors": (8, 4, 2),
+        "aff_smoothing_sigmas": (3, 2, 1),
+        "aff_iterations": (500, 250, 50),
+        "aff_random_sampling_rate": 0.1,
+    },
+}
+
+
+def set_registration_threads(num_threads: int):
+    # ITK lit cette variable à sa première utilisation dans le processus : à appeler avant le premier recalage
+    os.environ["ITK_GLOBAL_DEFAULT_NUMBER_OF_THREADS"] = str(num_threads)
+    sitk.ProcessObject.SetGlobalDefaultNumberOfThreads(num_threads)
+
+
+def _transform_cache_key(fixed: ants.ANTsImage, moving: ants.ANTsImage, transform_type: str, mode: str) -> str:
+    digest = hashlib.blake2b(digest_size=20)
+    for image in (fixed, moving):
+        digest.update(np.ascontiguousarray(image.numpy(), dtype=np.float32).tobytes())
+        digest.update(np.asarray([*image.spacing, *image.origin, *np.ravel(image.direction)], dtype=np.float64).tobytes())
+    digest.update(f"{transform_type}:{mode}".encode())
+    return digest.hexdigest()
+
+
+def _register(fixed: ants.ANTsImage, moving: ants.ANTsImage, transform_type: str, mode: str, cache_dir: Path = None, num_threads: int = None, warp: bool = True):
+    """Lance ants.registration, ou réutilise la transformation en cache pour les mêmes images.
+
+    Renvoie (chemin de la transformation, image mobile recalée ou None si `warp` est faux
+    et que la transformation vient du cache).
+    """
+    if mode not in REGISTRATION_MODES:
+        raise ValueError(f"Unknown registration mode '{mode}'. Must be one of {list(REGISTRATION_MODES)}.")
+    if num_threads:
+        set_registration_threads(num_threads)
+
+    cache_path = None
+    if cache_dir is not None and transform_type in LINEAR_TRANSFORMS:
+        cache_path = Path(cache_dir) / f"{_transform_cache_key(fixed, moving, transform_type, mode)}.mat"
+        if cache_path.exists():
+            logger.info(f"Reusing cached {transform_type} transform: {cache_path.name}")
+            if not warp:
+                return cache_path, None
+            warped = ants.apply_transforms(fixed=fixed, moving=moving, transformlist=[str(cache_path)])
+            return cache_path, warped
 
-    logger.info(f"Registering post to pre using {transform_type} transform...")
+    logger.info(f"Registering post to pre using {transform_type} transform ({mode} mode)...")
     start_time = time.perf_counter()
 
-    registration = ants.registration(fixed=fixed, moving=moving, type_of_transform=transform_type)
+    registration = ants.registration(fixed=fixed, moving=moving, type_of_transform=transform_type, **REGISTRATION_MODES[mode])
 
     duration = time.perf_counter() - start_time
-    logger.info(f"Registration completed in {duration:.2f} seconds")
+    similarity = ants.image_similarity(fixed, registration["warpedmovout"], metric_type="MattesMutualInformation")
+    logger.info(f"Registration completed in {duration:.2f} seconds (Mattes MI: {similarity:.4f})")
 
-    aligned_image = registration["warpedmovout"]
+    transform_path = Path(registration["fwdtransforms"][0])
+    if cache_path is not None:
+        cache_path.parent.mkdir(parents=True, exist_ok=True)
+        tmp_path = cache_path.with_name(f".tmp-{os.getpid()}-{cache_path.name}")
+        shutil.copyfile(transform_path, tmp_path)
+        os.replace(tmp_path, cache_path)
+        transform_path = cache_path
+
+    return transform_path, registration["warpedmovout"]
+
+
+def register_image_to_reference(image_source: nib.Nifti1Image, target_image: nib.Nifti1Image, transform_type: str = "Rigid", mode: str = "full", cache_dir: Path = None, num_threads: int = None):
+    moving = nib_to_ants(image_source)
+    fixed = nib_to_ants(target_image)
+
+    _, aligned_image = _register(fixed, moving, transform_type, mode, cache_dir, num_threads)
     aligned_image_nib = ants_to_nib(aligned_image)
     return aligned_image_nib
 
 
+def estimate_transform(moving_image: sitk.Image, fixed_image: sitk.Image, transform_type: str = "Rigid", mode: str = "full", cache_dir: Path = None, num_threads: int = None) -> sitk.Transform:
+    """Estime la transformation (espace fixe -> espace mobile) sans rééchantillonner l'image mobile.
+
+    La transformation est renvoyée au format SimpleITK pour être appliquée par
+    resampling.resample_sitk dans la même passe que le changement de grille.
+    """
+    if transform_type not in LINEAR_TRANSFORMS:
+        raise ValueError(f"Transform type '{transform_type}' is not linear; use register_image_to_reference instead.")
+
+    moving = sitk_to_ants(moving_image)
+    fixed = sitk_to_ants(fixed_image)
+
+    transform_path, _ = _register(fixed, moving, transform_type, mode, cache_dir, num_threads, warp=False)
+    return sitk.ReadTransform(str(transform_path))
+
+
 # ====== Example usage ======
 if __name__ == "__main__":
     dir_path = Path("data/preprocessed/")
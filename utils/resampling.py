@@ -68,6 +68,51 @@ def resample_like(source_image: nib.Nifti1Image, target_image: nib.Nifti1Image,
     return sitk_to_nib(resampled_sitk)
 
 
+def isotropic_grid(image: sitk.Image, new_spacing: float = 1.0) -> dict:
+    original_spacing = image.GetSpacing()
+    original_size = image.GetSize()
+    new_size = [int(round(osz * ospc / new_spacing)) for osz, ospc in zip(original_size, original_spacing)]
+
+    return {
+        "size": new_size,
+        "spacing": [new_spacing] * 3,
+        "origin": image.GetOrigin(),
+        "direction": image.GetDirection(),
+    }
+
+
+def resample_sitk(image: sitk.Image, grid, transform: sitk.Transform = None, interpolator: str = "linear", default_pixel_value: float = 0.0) -> sitk.Image:
+    """Rééchantillonne une image SimpleITK en une seule passe sur `grid`.
+
+    `grid` est soit une image de référence, soit un dict produit par isotropic_grid. Une
+    transformation (ex. recalage) peut être appliquée dans la même passe, ce qui évite
+    d'enchaîner changement d'espacement, recalage et resample_like.
+    """
+    interp_map = {
+        "linear": sitk.sitkLinear,
+        "nearest": sitk.sitkNearestNeighbor,
+        "bspline": sitk.sitkBSpline
+    }
+
+    if interpolator not in interp_map:
+        raise ValueError(f"Unknown interpolator '{interpolator}'. Must be one of {list(interp_map)}.")
+
+    resampler = sitk.ResampleImageFilter()
+    if isinstance(grid, sitk.Image):
+        resampler.SetReferenceImage(grid)
+    else:
+        resampler.SetSize(grid["size"])
+        resampler.SetOutputSpacing(grid["spacing"])
+        resampler.SetOutputOrigin(grid["origin"])
+        resampler.SetOutputDirection(grid["direction"])
+    resampler.SetInterpolator(interp_map[interpolator])
+    resampler.SetDefaultPixelValue(default_pixel_value)
+    resampler.SetOutputPixelType(sitk.sitkFloat32)
+    resampler.SetTransform(transform if transform is not None else sitk.Transform(3, sitk.sitkIdentity))
+
+    return resampler.Execute(image)
+
+
 # ==== EXEMPLE D'UTILISATION ====
 if __name__ == "__main__":
     source_img_path = Path("processed_data/Agathe/CT_baseline.nii.gz")
@@ -0,0 +1,102 @@
+import numpy as np
+import nibabel as nib
+from pathlib import Path
+from loguru import logger
+from tqdm import tqdm
+
+
+SAMPLING_INDEX_FILENAME = "sampling_index.npz"
+
+
+def organ_union_mask(mask_dir: Path, organs, shape) -> np.ndarray:
+    mask = np.zeros(shape, dtype=bool)
+    for organ in organs:
+        organ_path = mask_dir / f"{organ}.nii.gz"
+        if not organ_path.exists():
+            logger.warning(f"Missing mask for organ: {organ} -> {organ_path}")
+            continue
+        organ_image = nib.load(organ_path)
+        if tuple(organ_image.shape) != tuple(shape):
+            logger.error(f"Mask {organ_path} has shape {organ_image.shape}, expected {tuple(shape)}")
+            raise ValueError(f"Organ mask {organ_path} is not on the PET grid; resample the segmentation first.")
+        mask |= np.asanyarray(organ_image.dataobj) > 0
+    return mask
+
+
+def build_sampling_index(pet_data: np.ndarray, source: str = "suv", threshold: float = 0.05, stride: int = 4, organ_mask: np.ndarray = None) -> dict:
+    """Construit l'index des centres de patch candidats et leur distribution cumulée.
+
+    Les centres sont pris sur une grille de pas `stride` pour garder l'index compact ;
+    le tirage ajoute un décalage aléatoire dans la cellule.
+    """
+    coarse = np.asarray(pet_data[::stride, ::stride, ::stride], dtype=np.float32)
+
+    if source == "body":
+        weights = (coarse > threshold).astype(np.float32)
+    elif source == "suv":
+        weights = np.where(coarse > threshold, coarse, 0.0).astype(np.float32)
+    elif source == "organs":
+        if organ_mask is None:
+            raise ValueError("Source 'organs' requires an organ_mask.")
+        weights = organ_mask[::stride, ::stride, ::stride].astype(np.float32)
+    else:
+        raise ValueError(f"Unknown sampling source: {source}. Supported sources are 'body', 'suv' and 'organs'.")
+
+    flat = np.flatnonzero(weights)
+    if flat.size == 0:
+        logger.warning("Empty sampling map; falling back to uniform centres.")
+        weights = np.ones_like(weights)
+        flat = np.arange(weights.size)
+
+    centres = np.stack(np.unravel_index(flat, weights.shape), axis=1).astype(np.int32) * stride
+    cdf = np.cumsum(weights.ravel()[flat], dtype=np.float64)
+    cdf /= cdf[-1]
+
+    return {"centres": centres, "cdf": cdf, "stride": np.int32(stride), "shape": np.array(pet_data.shape, dtype=np.int32)}
+
+
+def save_sampling_index(index: dict, output_path: Path):
+    np.savez(output_path, **index)
+    logger.info(f"Sampling index saved to: {output_path} ({len(index['centres'])} centres)")
+
+
+def load_sampling_index(index_path: Path) -> dict:
+    with np.load(index_path) as data:
+        return {key: data[key] for key in data.files}
+
+
+def build_all_sampling_indices(root_dir: Path, filename: str = "baseline/PET_preprocessed.nii.gz", source: str = "suv", threshold: float = 0.05, stride: int = 4, overwrite: bool = False,
+                               mask_subdir: str = None, organs: list[str] = None):
+    """Construit l'index de chaque patient ; avec source="organs", le masque est l'union des
+    organes de `organs` (par défaut ceux de ORGANS_THRESHOLDS) lus dans `<patient>/<mask_subdir>`
+    (par défaut SEGMENTATION_SUBDIR, le dossier écrit par utils/ct_segmentor.py.py)."""
+    if source == "organs":
+        # Import local : utils/preprocessing.py importe ce module à plat, sans le paquet utils
+        from utils.physiological_masking import ORGANS_THRESHOLDS, SEGMENTATION_SUBDIR
+        organs = list(ORGANS_THRESHOLDS) if organs is None else organs
+        mask_subdir = mask_subdir or SEGMENTATION_SUBDIR
+
+    patient_dirs = sorted(p for p in Path(root_dir).iterdir() if not p.name.startswith(".") and (p / filename).exists())
+    logger.info(f"Building sampling indices for {len(patient_dirs)} patients in {root_dir}")
+
+    for patient_dir in tqdm(patient_dirs, desc="Index d'échantillonnage"):
+        output_path = patient_dir / SAMPLING_INDEX_FILENAME
+        if output_path.exists() and not overwrite:
+            continue
+        pet_data = nib.load(patient_dir / filename).get_fdata(dtype=np.float32)
+
+        organ_mask = None
+        if source == "organs":
+            mask_dir = patient_dir / mask_subdir
+            if not mask_dir.is_dir():
+                logger.error(f"Missing segmentation folder: {mask_dir}")
+                raise FileNotFoundError(f"Segmentation folder not found: {mask_dir}")
+            organ_mask = organ_union_mask(mask_dir, organs, pet_data.shape)
+
+        index = build_sampling_index(pet_data, source=source, threshold=threshold, stride=stride, organ_mask=organ_mask)
+        save_sampling_index(index, output_path)
+
+
+# ==== Exemple d'utilisation ====
+if __name__ == "__main__":
+    build_all_sampling_indices(Path("data/processed"), source="suv")
@@ -0,0 +1,60 @@
+import numpy as np
+import nibabel as nib
+from pathlib import Path
+from loguru import logger
+from tqdm import tqdm
+
+
+CACHE_DTYPES = {
+    "float32": np.float32,
+    "float16": np.float16,
+}
+
+
+def cache_path_for(nifti_path: Path) -> Path:
+    nifti_path = Path(nifti_path)
+    return nifti_path.with_name(nifti_path.name.replace(".nii.gz", ".npy"))
+
+
+def materialize_volume(nifti_path: Path, dtype: str = "float32", overwrite: bool = False) -> Path:
+    if dtype not in CACHE_DTYPES:
+        raise ValueError(f"Unknown cache dtype '{dtype}'. Must be one of {list(CACHE_DTYPES)}.")
+
+    output_path = cache_path_for(nifti_path)
+    if output_path.exists() and not overwrite:
+        return output_path
+
+    image = nib.load(nifti_path)
+    data = image.get_fdata(dtype=np.float32)
+
+    # Écriture dans un fichier temporaire puis renommage : un cache à moitié écrit n'est jamais lu
+    tmp_path = output_path.with_name(output_path.name + ".tmp")
+    cache = np.lib.format.open_memmap(tmp_path, mode="w+", dtype=CACHE_DTYPES[dtype], shape=data.shape)
+    cache[...] = data
+    cache.flush()
+    del cache
+    tmp_path.replace(output_path)
+
+    logger.info(f"Materialized {nifti_path.name} -> {output_path} ({dtype})")
+    return output_path
+
+
+def materialize_all_patients(root_dir: Path, filename: str = "PET_preprocessed.nii.gz", dtype: str = "float32", overwrite: bool = False):
+    nifti_paths = sorted(p for p in Path(root_dir).glob(f"*/*/{filename}") if not p.parent.parent.name.startswith("."))
+    logger.info(f"Materializing {len(nifti_paths)} volumes from {root_dir} as raw {dtype}")
+
+    for nifti_path in tqdm(nifti_paths, desc="Materialisation des volumes"):
+        materialize_volume(nifti_path, dtype=dtype, overwrite=overwrite)
+
+
+def load_cached_volume(nifti_path: Path) -> np.memmap:
+    npy_path = cache_path_for(nifti_path)
+    if not npy_path.exists():
+        logger.error(f"Missing materialized volume: {npy_path}")
+        raise FileNotFoundError(f"Materialized volume not found: {npy_path}. Run materialize_all_patients first.")
+    return np.load(npy_path, mmap_mode="r")
+
+
+# ==== Exemple d'utilisation ====
+if __name__ == "__main__":
+    materialize_all_patients(Path("data/processed"), dtype="float32")
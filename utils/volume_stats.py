@@ -0,0 +1,226 @@
+import json
+import numpy as np
+import nibabel as nib
+from pathlib import Path
+from loguru import logger
+from tqdm import tqdm
+
+from normalization import histogram_quantile, normalize_suv_array, save_image, suv_factor, load_pet_metadata, convert_pet_to_suv_array
+
+
+QUANTILES = (1, 5, 50, 95, 99, 99.5)
+COHORT_STATS_FILENAME = "cohort_stats.json"
+METADATA_FILENAME = "patient_info.json"
+# PET convertis par utils/dicom_convert_tools.py, avant prétraitement
+PET_FILENAMES = ("PET_baseline.nii.gz", "PET_normal.nii.gz")
+
+
+def stats_path_for(volume_path: Path) -> Path:
+    volume_path = Path(volume_path)
+    return volume_path.with_name(volume_path.name.replace(".nii.gz", "").replace(".npy", "") + ".stats.json")
+
+
+def compute_volume_stats(data: np.ndarray, hist_range=(0.0, 50.0), bins: int = 5000, noise_range=(0.0, 20.0), chunk_size: int = 16, scale: float = 1.0) -> dict:
+    """Toutes les statistiques d'un volume en une seule lecture par blocs.
+
+    Les valeurs sont multipliées par `scale` avant le calcul (facteur SUV pour un PET brut).
+    L'histogramme a des bornes fixes (`hist_range`) pour pouvoir être sommé entre patients ;
+    les valeurs hors bornes sont comptées à part. Le bruit de fond est la moyenne des voxels
+    dans ]noise_range[0], noise_range[1]], comme dans suppress_physiological_uptake_on_pet.
+    """
+    hist = np.zeros(bins, dtype=np.int64)
+    min_val, max_val = np.inf, -np.inf
+    total, total_sq, count = 0.0, 0.0, 0
+    underflow, overflow = 0, 0
+    noise_sum, noise_count = 0.0, 0
+
+    for start in range(0, data.shape[0], chunk_size):
+        block = np.asarray(data[start:start + chunk_size], dtype=np.float32)
+        if scale != 1.0:
+            block = block * np.float32(scale)
+        min_val = min(min_val, float(block.min()))
+        max_val = max(max_val, float(block.max()))
+        total += float(block.sum(dtype=np.float64))
+        total_sq += float(np.square(block, dtype=np.float64).sum())
+        count += block.size
+
+        hist += np.histogram(block, bins=bins, range=hist_range)[0]
+        underflow += int(np.count_nonzero(block < hist_range[0]))
+        overflow += int(np.count_nonzero(block > hist_range[1]))
+
+        noise = block[(block > noise_range[0]) & (block <= noise_range[1])]
+        noise_sum += float(noise.sum(dtype=np.float64))
+        noise_count += noise.size
+
+    mean = total / count
+    stats = {
+        "shape": list(data.shape),
+        "scale": scale,
+        "count": count,
+        "min": min_val,
+        "max": max_val,
+        "mean": mean,
+        "std": float(np.sqrt(max(total_sq / count - mean ** 2, 0.0))),
+        "background_noise_mean": noise_sum / noise_count if noise_count else 0.0,
+        "background_noise_count": noise_count,
+        "histogram": {"range": list(hist_range), "counts": hist.tolist(), "underflow": underflow, "overflow": overflow},
+    }
+    stats["quantiles"] = _quantiles(stats)
+    return stats
+
+
+def _quantiles(stats: dict) -> dict:
+    histogram = stats["histogram"]
+    counts = np.asarray(histogram["counts"], dtype=np.int64)
+    # Débordements rangés dans les bins extrêmes : le quantile reste borné par min/max
+    counts[0] += histogram["underflow"]
+    counts[-1] += histogram["overflow"]
+    edges = np.linspace(*histogram["range"], len(counts) + 1)
+
+    quantiles = {}
+    for q in QUANTILES:
+        value = histogram_quantile(counts, edges, q)
+        quantiles[str(q)] = float(min(max(value, stats["min"]), stats["max"]))
+    return quantiles
+
+
+def load_volume(volume_path: Path) -> np.ndarray:
+    volume_path = Path(volume_path)
+    npy_path = volume_path.with_name(volume_path.name.replace(".nii.gz", ".npy"))
+    if npy_path.exists():
+        return np.load(npy_path, mmap_mode="r")
+    return nib.load(volume_path).get_fdata(dtype=np.float32)
+
+
+def compute_and_save_stats(volume_path: Path, overwrite: bool = False, metadata_path: Path = None, **kwargs) -> dict:
+    # Avec `metadata_path` (patient_info.json), les statistiques sont en SUV : même unité pour toute la cohorte
+    scale = suv_factor(*load_pet_metadata(metadata_path)) if metadata_path is not None else 1.0
+    output_path = stats_path_for(volume_path)
+    if not overwrite:
+        stats = find_volume_stats(volume_path, scale)
+        if stats is not None:
+            return stats
+
+    stats = compute_volume_stats(load_volume(volume_path), scale=scale, **kwargs)
+    stats["source"] = str(volume_path)
+    with open(output_path, "w") as f:
+        json.dump(stats, f)
+    logger.info(f"Volume statistics saved to: {output_path}")
+    return stats
+
+
+def load_volume_stats(stats_path: Path) -> dict:
+    stats_path = Path(stats_path)
+    if not stats_path.name.endswith(".stats.json"):
+        stats_path = stats_path_for(stats_path)
+    with open(stats_path, "r") as f:
+        return json.load(f)
+
+
+def find_volume_stats(volume_path: Path, scale: float = 1.0) -> dict:
+    """Statistiques annexes du volume si elles existent et ont été calculées avec le même facteur, sinon None."""
+    stats_path = stats_path_for(volume_path)
+    if not stats_path.exists():
+        return None
+    stats = load_volume_stats(stats_path)
+    if not np.isclose(stats.get("scale", 1.0), scale, rtol=1e-6):
+        logger.debug(f"Ignoring {stats_path.name}: computed with scale {stats.get('scale', 1.0)}, expected {scale}")
+        return None
+    return stats
+
+
+def load_cohort_stats(root_dir: Path) -> dict:
+    stats_path = Path(root_dir) / COHORT_STATS_FILENAME
+    if not stats_path.exists():
+        logger.error(f"Missing cohort statistics: {stats_path}")
+        raise FileNotFoundError(f"Cohort statistics not found: {stats_path}. Run utils/volume_stats.py::compute_cohort_stats first.")
+    with open(stats_path, "r") as f:
+        return json.load(f)
+
+
+def aggregate_cohort_stats(volume_stats: list[dict]) -> dict:
+    """Combine les statistiques par volume sans relire les données (histogrammes sommés)."""
+    if not volume_stats:
+        raise ValueError("No volume statistics to aggregate.")
+    ranges = {tuple(s["histogram"]["range"]) for s in volume_stats}
+    if len(ranges) != 1 or len({len(s["histogram"]["counts"]) for s in volume_stats}) != 1:
+        raise ValueError("Volume statistics use different histogram bins; recompute them with the same settings.")
+
+    count = sum(s["count"] for s in volume_stats)
+    total = sum(s["mean"] * s["count"] for s in volume_stats)
+    total_sq = sum((s["std"] ** 2 + s["mean"] ** 2) * s["count"] for s in volume_stats)
+    noise_count = sum(s["background_noise_count"] for s in volume_stats)
+    noise_sum = sum(s["background_noise_mean"] * s["background_noise_count"] for s in volume_stats)
+    mean = total / count
+
+    stats = {
+        "num_volumes": len(volume_stats),
+        "count": count,
+        "min": min(s["min"] for s in volume_stats),
+        "max": max(s["max"] for s in volume_stats),
+        "mean": mean,
+        "std": float(np.sqrt(max(total_sq / count - mean ** 2, 0.0))),
+        "background_noise_mean": noise_sum / noise_count if noise_count else 0.0,
+        "background_noise_count": noise_count,
+        "histogram": {
+            "range": list(ranges.pop()),
+            "counts": np.sum([s["histogram"]["counts"] for s in volume_stats], axis=0).tolist(),
+            "underflow": sum(s["histogram"]["underflow"] for s in volume_stats),
+            "overflow": sum(s["histogram"]["overflow"] for s in volume_stats),
+        },
+    }
+    stats["quantiles"] = _quantiles(stats)
+    return stats
+
+
+def _metadata_path(volume_path: Path, suv: bool) -> Path:
+    return Path(volume_path).parent / METADATA_FILENAME if suv else None
+
+
+def _cohort_volumes(root_dir: Path, pattern: str = None) -> list[Path]:
+    patterns = [pattern] if pattern is not None else [f"*/{name}" for name in PET_FILENAMES]
+    return sorted(p for pattern in patterns for p in Path(root_dir).glob(pattern) if not p.parent.name.startswith("."))
+
+
+def compute_cohort_stats(root_dir: Path, pattern: str = None, suv: bool = True, overwrite: bool = False, **kwargs) -> dict:
+    """Statistiques de chaque volume (fichier annexe) puis de la cohorte.
+
+    Par défaut (`pattern=None`) : les PET de PET_FILENAMES de chaque patient, ramenés en SUV
+    avec le `patient_info.json` du patient.
+    """
+    volume_paths = _cohort_volumes(root_dir, pattern)
+    logger.info(f"Computing statistics for {len(volume_paths)} volumes in {root_dir}")
+
+    volume_stats = [
+        compute_and_save_stats(path, overwrite=overwrite, metadata_path=_metadata_path(path, suv), **kwargs)
+        for path in tqdm(volume_paths, desc="Statistiques des volumes")
+    ]
+    cohort_stats = aggregate_cohort_stats(volume_stats)
+
+    output_path = Path(root_dir) / COHORT_STATS_FILENAME
+    with open(output_path, "w") as f:
+        json.dump(cohort_stats, f)
+    logger.info(f"Cohort statistics saved to: {output_path} (p99 = {cohort_stats['quantiles']['99']:.3f})")
+    return cohort_stats
+
+
+def normalize_cohort(root_dir: Path, pattern: str = None, suv: bool = True, mode: str = "percentile", suffix: str = "_cohort_normalized", **kwargs) -> dict:
+    """Normalisation commune à toute la cohorte (p99 ou min/max de la cohorte).
+
+    Les statistiques viennent des fichiers annexes : chaque volume n'est relu qu'une fois,
+    pour être converti en SUV (si `suv`) puis normalisé.
+    """
+    cohort_stats = compute_cohort_stats(root_dir, pattern, suv=suv, **kwargs)
+    for volume_path in tqdm(_cohort_volumes(root_dir, pattern), desc="Normalisation de la cohorte"):
+        image = nib.load(volume_path)
+        data = image.get_fdata(dtype=np.float32)
+        if suv:
+            convert_pet_to_suv_array(data, *load_pet_metadata(_metadata_path(volume_path, suv)))
+        data = normalize_suv_array(data, mode=mode, stats=cohort_stats)
+        save_image(data, image.affine, image.header, volume_path.with_name(volume_path.name.replace(".nii.gz", f"{suffix}.nii.gz")))
+    return cohort_stats
+
+
+# ==== Exemple d'utilisation ====
+if __name__ == "__main__":
+    normalize_cohort(Path("data/processed"), mode="percentile")